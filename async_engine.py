@@ -0,0 +1,527 @@
+"""
+asyncio export engine
+
+Note(s):
+    1. Requires Python 3.5 and aiohttp
+    2. Alternative to Exporter.run() (get_stats.py --async).  Every
+       (query, window) pair is scheduled on one event loop.  Datadog
+       queries and Influx writes are plain HTTP requests sharing a single
+       aiohttp connection pool, and a semaphore bounds the number of
+       windows in flight (from their fetch until they are written).
+    3. A query's windows are fetched concurrently but written in time
+       order, and nothing is written after a window that failed: the
+       next run resumes from the last point in Influx, so a later window
+       written past a failed one would leave a gap for good.
+    4. Datadog time series query API:
+         https://docs.datadoghq.com/api/?lang=python#query-time-series-points
+       Influx HTTP API:
+         https://docs.influxdata.com/influxdb/v1.7/tools/api/
+    5. A window's lines are written in batches of the (adaptive) Influx
+       batch size, as by InfluxHelper, one batch at a time.
+    6. Once a window is written each of its series is committed to the
+       checkpoint store (as by InfluxHelper), so a later run of either
+       engine resumes from it.
+    7. A batch Influx fails goes to the write-ahead spool (spool_dir, see
+       spool.py), as do the batches after it while the spool holds
+       anything.  There is no drainer thread: what is spooled is
+       replayed at the start of the next run (of either engine).
+    8. Queries with a rollup (see rollup.py) fail here, and additional
+       Influx sinks (see sinks.py) are not supported.
+    9. Datadog queries go through a ratelimit.RequestScheduler, as by
+       Dogger: the same rate limit settings, and rate limited (429) and
+       transient failures are retried the same way.
+
+"""
+import asyncio
+from collections import deque
+import time
+
+import aiohttp
+
+import constants
+import dedup
+import dogger
+import get_stats
+import influx_help
+import line_protocol
+import pointlist
+import ratelimit
+import spool
+import watermarks
+
+
+class AsyncRequestFailed(Exception):
+    """ An async Datadog or Influx request failed """
+
+
+class AsyncDatadogClient(object):
+    """
+    Minimal async client for the Datadog time series query API
+    """
+    def __init__(self, session, api_host, api_key, app_key, scheduler):
+        """
+        :param session: shared aiohttp.ClientSession
+        :param api_host: Datadog API URL (scheme and host)
+        :param api_key: Datadog API key
+        :param app_key: Datadog application key
+        :param scheduler: ratelimit.RequestScheduler for the queries
+        """
+        super().__init__()
+        self.session = session
+        self.scheduler = scheduler
+        self.url = api_host.rstrip('/') + '/api/v1/query'
+        self.headers = {'DD-API-KEY': api_key or '',
+                        'DD-APPLICATION-KEY': app_key or ''}
+
+    async def query(self, start, end, query):
+        """
+        Run a time series query, scheduled and retried by the scheduler.
+
+        :param start: window start (epoch seconds)
+        :param end: window end (epoch seconds)
+        :param query: the datadog query
+        :return: the decoded response (see dogger.py)
+        """
+        return await self.scheduler.call_async(self.query_once, start, end,
+                                               query)
+
+    async def query_once(self, start, end, query):
+        """
+        Run one time series query (no scheduling or retries).  Raises
+        ratelimit.RateLimited if the request was rate limited,
+        dogger.DatadogServerError for server errors and
+        AsyncRequestFailed for other errors, as Dogger.send_query().
+
+        :return: the decoded response
+        """
+        params = {'from': str(start), 'to': str(end), 'query': query}
+        async with self.session.get(self.url, params=params,
+                                    headers=self.headers) as resp:
+            self.scheduler.update(resp.headers)
+            if resp.status < 400:
+                result = await resp.json(content_type=None)
+                if isinstance(result, dict) and result.get('errors'):
+                    reason = str(result['errors'])
+                    if 'rate limit' in reason.lower():
+                        raise ratelimit.RateLimited(
+                            reason, ratelimit.retry_after(resp.headers))
+                    raise AsyncRequestFailed(reason)
+                return result
+            reason = (await resp.text())[:500]
+            if resp.status == 429 or 'rate limit' in reason.lower():
+                raise ratelimit.RateLimited(
+                    reason, ratelimit.retry_after(resp.headers))
+            if resp.status >= 500:
+                raise dogger.DatadogServerError('{}: {}'.format(resp.status,
+                                                                reason))
+            raise AsyncRequestFailed("Datadog query HTTP {}: {}".format(
+                resp.status, reason))
+
+
+class AsyncInfluxClient(object):
+    """
+    Minimal async client for the Influx 1.x HTTP API
+    """
+    def __init__(self, session, host, port, database, username=None,
+                 password=None, precision=constants.DEFAULT_INFLUX_PRECISION):
+        """
+        :param session: shared aiohttp.ClientSession
+        :param host: Influx host name
+        :param port: Influx port number
+        :param database: Influx database name
+        :param username: Influx user (optional)
+        :param password: Influx password (optional)
+        :param precision: timestamp precision of the written lines
+        """
+        super().__init__()
+        self.session = session
+        self.precision = precision
+        self.url = 'http://{}:{}'.format(host, port)
+        self.database = database
+        self.auth = {}
+        if username:
+            self.auth = {'u': username, 'p': password or ''}
+
+    async def query(self, influx_query):
+        """
+        Run an InfluxQL query.
+
+        :param influx_query: the query
+        :return: the decoded response
+        """
+        params = dict(self.auth, q=influx_query, db=self.database, epoch='ms')
+        async with self.session.get(self.url + '/query',
+                                    params=params) as resp:
+            if resp.status != 200:
+                raise AsyncRequestFailed("Influx query HTTP {}: {}".format(
+                    resp.status, await resp.text()))
+            return await resp.json(content_type=None)
+
+    async def write(self, lines):
+        """
+        Write line protocol lines.
+
+        :param lines: list of line protocol strings
+        """
+        params = dict(self.auth, db=self.database, precision=self.precision)
+        async with self.session.post(self.url + '/write', params=params,
+                                     data='\n'.join(lines)) as resp:
+            if resp.status != 204:
+                raise AsyncRequestFailed("Influx write HTTP {}: {}".format(
+                    resp.status, await resp.text()))
+
+    async def get_metric_start_time(self, metric):
+        """
+        Get the start time (last timestamp written) for the given metric.
+
+        :param metric: measurement name
+        :return: start time (epoch seconds)
+        """
+        result = await self.query('SELECT LAST(*) FROM "{}"'.format(metric))
+        try:
+            return int(result['results'][0]['series'][0]['values'][0][0] / 1000)
+        except (KeyError, IndexError, TypeError) as exn:
+            raise AsyncRequestFailed("No start time for {}: {}".format(metric,
+                                                                      exn))
+
+
+    async def get_watermarks(self, metrics):
+        """
+        Get the last timestamp per (metric, foundry) for all the given
+        metrics with a single grouped query.
+
+        :param metrics: list of metric (measurement) names
+        :return: watermarks.Watermarks (empty, not loaded, on failure)
+        """
+        if not metrics:
+            return watermarks.Watermarks()
+        try:
+            result = await self.query(watermarks.last_query(metrics))
+            return watermarks.Watermarks.from_result(result['results'][0])
+        except (AsyncRequestFailed, aiohttp.ClientError,
+                KeyError, IndexError, TypeError):
+            return watermarks.Watermarks()
+
+
+class AsyncExporter(get_stats.Exporter):
+    """
+    Exporter running all queries and windows on an asyncio event loop.
+    """
+    def make_clients(self):
+        """
+        The async clients need a running loop, they are created by
+        run_async().
+        """
+        self.semaphore = None
+        self.dd_client = None
+        self.influx_client = None
+        self.sizer = None
+        self.encoder = None
+        self.spool = None
+        return None, None
+
+    def run(self):
+        """
+        Exporter main entry point.
+
+        :return: status code (1 fail, 0 success)
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async())
+        finally:
+            loop.close()
+
+    async def run_async(self):
+        """
+        Load the query and foundation files and export every query.
+
+        :return: status code (1 fail, 0 success)
+        """
+        config = self.load_config()
+        if config is None:
+            return 1
+        foundation_info, queries = config
+        if self.params.get('influx_sinks'):
+            self.logger.error("Additional Influx sinks are not supported by "
+                              "the async engine")
+            return 1
+
+        self.checkpoints = self.open_checkpoints()
+        if self.params.get('spool_dir'):
+            self.spool = spool.Spool(self.params['spool_dir'], self.params.get(
+                'spool_segment_bytes', constants.DEFAULT_SPOOL_SEGMENT_BYTES))
+        try:
+            results = await self.export_all(foundation_info, queries)
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+            if self.checkpoints is not None:
+                self.checkpoints.close()
+
+        self.log_summary(results)
+        return 0 if all(res.ok for res in results) else 1
+
+    async def export_all(self, foundation_info, queries):
+        """
+        Export every query on a shared HTTP session.
+
+        :return: list of QueryResult
+        """
+        concurrency = int(self.params.get('async_concurrency',
+                                          constants.DEFAULT_ASYNC_CONCURRENCY))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.dd_client = AsyncDatadogClient(
+                session,
+                self.params.get('datadog_api_host',
+                                constants.DEFAULT_DATADOG_API_HOST),
+                self.params.get('datadog_api_key'),
+                self.params.get('datadog_app_key'),
+                ratelimit.RequestScheduler(
+                    self.params.get('datadog_rate_limit',
+                                    constants.DEFAULT_DATADOG_RATE_LIMIT),
+                    self.params.get('datadog_rate_period',
+                                    constants.DEFAULT_DATADOG_RATE_PERIOD),
+                    burst=self.params.get('datadog_rate_burst',
+                                          constants.DEFAULT_DATADOG_RATE_BURST),
+                    max_retries=self.params.get(
+                        'datadog_max_retries',
+                        constants.DEFAULT_DATADOG_MAX_RETRIES),
+                    retry_on=dogger.transient_errors() + (
+                        aiohttp.ClientError, asyncio.TimeoutError),
+                    share=self.params.get('datadog_rate_share', 1.0)))
+            self.influx_client = AsyncInfluxClient(
+                session,
+                self.params['influx_host'],
+                self.params['influx_port'],
+                self.params['influx_database'],
+                self.params.get('influx_user'),
+                self.params.get('influx_password'),
+                self.params.get('influx_precision',
+                                constants.DEFAULT_INFLUX_PRECISION))
+            self.sizer = influx_help.AdaptiveBatchSize(
+                self.params.get('influx_batch_size',
+                                constants.DEFAULT_INFLUX_BATCH_SIZE),
+                self.params.get('influx_batch_min',
+                                constants.DEFAULT_INFLUX_BATCH_MIN),
+                self.params.get('influx_batch_max',
+                                constants.DEFAULT_INFLUX_BATCH_MAX),
+                self.params.get('influx_write_latency',
+                                constants.DEFAULT_INFLUX_WRITE_LATENCY))
+            self.encoder = line_protocol.LineEncoder(self.sizer.size)
+            if self.spool is not None and self.spool.pending:
+                await self.drain_spool()
+            self.watermarks = await self.influx_client.get_watermarks(
+                [query['metric'] for query in queries
+                 if isinstance(query, dict) and 'metric' in query])
+            return await asyncio.gather(*[
+                self.timed_query_async(qnbr, query, foundation_info)
+                for qnbr, query in enumerate(queries, 1)])
+
+    async def drain_spool(self):
+        """
+        Replay what earlier runs spooled, oldest segment first.  After a
+        failure the rest stays spooled (and new batches go behind it).
+        """
+        while True:
+            path = self.spool.next_segment()
+            if path is None:
+                return
+            records = self.spool.records(path)
+            try:
+                for lines in records:
+                    await self.influx_client.write(lines)
+            except (AsyncRequestFailed, aiohttp.ClientError,
+                    asyncio.TimeoutError) as exn:
+                self.logger.warning("Spool replay failed: %s", exn)
+                return
+            finally:
+                records.close()
+            self.spool.remove(path)
+            self.logger.info("Spool: replayed %s", path)
+
+    async def timed_query_async(self, qnbr, query, foundation_info):
+        """
+        Run one query, isolating its failures from the other queries.
+
+        :return: QueryResult summary for the query
+        """
+        metric = query.get('metric') if isinstance(query, dict) else None
+        started = time.time()
+        try:
+            nseries = await self.run_query_async(qnbr, query, foundation_info)
+        except KeyError as exn:
+            self.logger.error('Error: query %d missing required key: %s',
+                              qnbr, exn)
+            return get_stats.QueryResult(qnbr, metric, False,
+                                         time.time() - started, 0,
+                                         'missing key {}'.format(exn))
+        except Exception as exn:
+            self.logger.error('Error: query %d (%s) failed: %s',
+                              qnbr, metric, exn)
+            return get_stats.QueryResult(qnbr, metric, False,
+                                         time.time() - started, 0, str(exn))
+        return get_stats.QueryResult(qnbr, metric, True,
+                                     time.time() - started, nseries, None)
+
+    async def run_query_async(self, qnbr, query, foundation_info):
+        """
+        Export a single metric/query pair, all windows concurrently.
+
+        :return: number of series sent
+        """
+        self.logger.info("[%d] Starting work on query pair %s", qnbr, query)
+        metric = query['metric']
+        dd_query = query['query']
+        if query.get('rollup'):
+            raise ValueError("rollups are not supported by the async engine")
+
+        series_start = self.watermarks.start_time(
+            metric, self.params.get('watermark_max_lag',
+                                    constants.DEFAULT_WATERMARK_MAX_LAG
+                                    * constants.SEC_PER_HOUR))
+        if series_start is None and self.watermarks.loaded:
+            series_start = self.params['START_TIMESTAMP']
+        elif series_start is None:
+            async with self.semaphore:
+                try:
+                    series_start = await self.influx_client.get_metric_start_time(metric)
+                except (AsyncRequestFailed, aiohttp.ClientError) as exn:
+                    series_start = self.params['START_TIMESTAMP']
+                    self.logger.debug("Start time query failed (%s), setting "
+                                      "start time %d", exn, series_start)
+
+        return await self.export_windows(metric, dd_query,
+                                         self.windows(series_start),
+                                         foundation_info)
+
+    async def export_windows(self, metric, query, windows, foundation_info):
+        """
+        Fetch a query's windows, up to 'async_concurrency' ahead, and
+        write them in order.  Raises AsyncRequestFailed for the first
+        failed window; the windows after it are not written.
+
+        :param windows: list of (start, end) pairs, in time order
+        :return: number of series sent
+        """
+        ahead = max(1, int(self.params.get('async_concurrency',
+                                           constants.DEFAULT_ASYNC_CONCURRENCY)))
+        deduper = dedup.Deduplicator(self.watermarks, self.dedup_stats)
+        windows = iter(windows)
+        pending = deque()       # ((start, end), fetch task), each holding
+                                # a semaphore slot
+        nseries = 0
+        try:
+            while True:
+                # only the next window to write may wait for a slot, the
+                # others are fetched ahead when one is free
+                while len(pending) < ahead and not (pending and
+                                                    self.semaphore.locked()):
+                    window = next(windows, None)
+                    if window is None:
+                        break
+                    await self.semaphore.acquire()
+                    self.logger.debug("Datadog query %d - %d: %s",
+                                      window[0], window[1], query)
+                    pending.append((window, asyncio.ensure_future(
+                        self.dd_client.query(window[0], window[1], query))))
+                if not pending:
+                    return nseries
+                (start, end), fetch = pending.popleft()
+                try:
+                    try:
+                        result = await fetch
+                    except Exception as exn:
+                        raise AsyncRequestFailed("Window {} - {} failed: {}".format(
+                            start, end, exn))
+                    nseries += await self.write_window(metric, result, deduper,
+                                                       foundation_info)
+                finally:
+                    self.semaphore.release()
+        finally:
+            for _, fetch in pending:
+                fetch.cancel()
+                # a fetch that already failed: its error is not wanted
+                fetch.add_done_callback(
+                    lambda task: task.cancelled() or task.exception())
+                self.semaphore.release()
+
+    def windows(self, start_time):
+        """
+        Split [start_time, now] into Datadog query windows.
+
+        :param start_time: earliest time to export
+        :return: list of (start, end) pairs
+        """
+        now = int(time.time())
+        time_range = self.params['datadog_time_range']
+        return [(start, min(start + time_range, now))
+                for start in range(start_time, now, time_range)]
+
+    async def write_window(self, metric, result, deduper, foundation_info):
+        """
+        Write one fetched Datadog window to Influx, then commit its
+        series.
+
+        :param result: the decoded Datadog response
+        :param deduper: dedup.Deduplicator of the query
+        :return: number of series sent
+        """
+        nseries = 0
+        precision = self.influx_client.precision
+        lines = []
+        last = {}           # foundry: last timestamp written (ms)
+        for series in result.get('series') or []:
+            foundry = series['scope'].split(":")[1]
+            foundry, tags = self.get_foundation_object(foundry,
+                                                       foundation_info)
+            if foundry is None:
+                continue
+            points = deduper.trim(metric, foundry,
+                                  pointlist.Series.from_points(
+                                      series['pointlist'], tags))
+            if not points:
+                continue
+            for batch in self.encoder.column_batches(
+                    self.encoder.prefix(metric, foundry, tags),
+                    *points.columns(precision)):
+                lines.extend(batch)
+                while len(lines) >= self.encoder.batch_size:
+                    size = self.encoder.batch_size
+                    await self.write_batch(lines[:size])
+                    del lines[:size]
+            last[foundry] = max(last.get(foundry, 0), int(points[-1][0]))
+            nseries += 1
+        if lines:
+            await self.write_batch(lines)
+        for foundry, timestamp in last.items():
+            if self.checkpoints is not None:
+                self.checkpoints.record(metric, foundry, timestamp)
+            self.watermarks.advance(metric, foundry, timestamp)
+        return nseries
+
+    async def write_batch(self, lines):
+        """
+        Write one batch, adapting the batch size to the write latency,
+        or spool it if Influx fails or the spool already has a backlog.
+
+        :param lines: list of line protocol strings
+        """
+        if self.spool is not None and self.spool.pending:
+            self.spool.append(lines)
+            return
+        started = time.time()
+        try:
+            await self.influx_client.write(lines)
+        except Exception as exn:
+            self.sizer.observe(len(lines), error=True)
+            if self.spool is None:
+                raise
+            self.logger.warning("Influx write failed, spooling: %s", exn)
+            self.spool.append(lines)
+        else:
+            self.sizer.observe(len(lines), time.time() - started)
+        finally:
+            self.encoder.batch_size = self.sizer.size
@@ -0,0 +1,246 @@
+"""
+Historical backfill
+
+Note(s):
+    1. Requires Python 3
+    2. get_stats.py --backfill FROM TO splits the time range into chunks
+       of backfill_chunk seconds per (query, chunk) and exports the chunks
+       on a pool of backfill_workers processes.  The chunks are
+       independent: each one fetches its own Datadog windows and writes
+       every point in its range (watermarks are not applied).
+    3. Each completed chunk is recorded in the checkpoint store, so
+       running the same backfill again after an interruption only does
+       the chunks that did not complete.  Without a checkpoint store
+       (checkpoint_file '') there is no resume.
+    4. Backfilled points do not move the export checkpoints: chunks
+       finish out of order, and a checkpoint must not skip a gap.
+    5. The run ends with a throughput report (chunks, points, points per
+       second, per metric totals).
+    6. A query's rollup (see rollup.py) is applied per chunk.  A chunk
+       starts at the start of its first bucket and only writes the
+       buckets that end in it.
+    7. Every worker process has its own Datadog request scheduler, so
+       the rate limit and burst are split between the workers: together
+       they stay within the org's allowance.
+
+"""
+import calendar
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+
+import constants
+import get_stats
+import rollup
+
+from commonpy.logger import Logger
+from commonpy.parameters import SysParams
+
+# Outcome of one backfill chunk
+ChunkResult = namedtuple('ChunkResult',
+                         ['metric', 'query', 'start', 'end', 'ok', 'points',
+                          'elapsed', 'error'])
+
+_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+# Per worker process exporter and foundation index, set up on first use
+_WORKER = {}
+
+
+def parse_time(value):
+    """
+    Parse a backfill time: epoch seconds or a UTC date/time.
+
+    :param value: '1479945600', '2016-11-24' or '2016-11-24T06:00[:00]'
+    :return: epoch seconds
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for fmt in _TIME_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError("Bad backfill time: {}".format(value))
+
+
+def split_range(start, end, size):
+    """
+    Split [start, end) into chunks of at most size seconds.
+
+    :return: list of (start, end)
+    """
+    size = max(1, int(size))
+    return [(chunk, min(chunk + size, end)) for chunk in range(start, end, size)]
+
+
+def run_chunk(params, metric, query, start, end, query_rollup=None):
+    """
+    Export one chunk (runs in a worker process).  The process' exporter is
+    created on its first chunk and reused for the rest.
+
+    :param params: the parent's parameters
+    :param metric: the metric being selected
+    :param query: the datadog query
+    :param start: chunk start (epoch seconds)
+    :param end: chunk end (epoch seconds)
+    :param query_rollup: the query's rollup.Rollup, or None
+    :return: ChunkResult
+    """
+    if not _WORKER:
+        SysParams().update(params)
+        exporter = get_stats.Exporter()
+        _WORKER['exporter'] = exporter
+        _WORKER['foundations'] = exporter.load_foundations(
+            params['foundations_file'])
+    exporter = _WORKER['exporter']
+    helper = exporter.helper
+
+    points = [0]
+    def send(*args):
+        points[0] += helper.send_points(*args) or 0
+
+    errors = exporter.datadog.errors + helper.errors
+    started = time.time()
+    try:
+        exporter.fetch_results(start, metric, query, _WORKER['foundations'],
+                               send, end_time=end, query_rollup=query_rollup)
+    except Exception as exn:
+        return ChunkResult(metric, query, start, end, False, points[0],
+                           time.time() - started, str(exn))
+    failed = exporter.datadog.errors + helper.errors - errors
+    return ChunkResult(metric, query, start, end, not failed, points[0],
+                       time.time() - started,
+                       '{} failed requests'.format(failed) if failed else None)
+
+
+class Backfill(object):
+    """
+    Backfill a time range on a process pool.
+    """
+    def __init__(self, start, end):
+        """
+        :param start: range start (epoch seconds)
+        :param end: range end (epoch seconds)
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.params = SysParams().params
+        self.start = int(start)
+        self.end = int(end)
+        self.workers = int(self.params.get('backfill_workers',
+                                           constants.DEFAULT_BACKFILL_WORKERS))
+        self.chunk = int(self.params.get('backfill_chunk',
+                                         constants.DEFAULT_BACKFILL_CHUNK
+                                         * constants.SEC_PER_HOUR))
+
+    def worker_params(self):
+        """
+        Get the parameters for the worker processes, with the Datadog
+        rate limit and burst split between them.
+
+        :return: parameter dictionary
+        """
+        workers = max(1, self.workers)
+        params = dict(self.params)
+        params['datadog_rate_limit'] = float(params.get(
+            'datadog_rate_limit', constants.DEFAULT_DATADOG_RATE_LIMIT)) / workers
+        params['datadog_rate_burst'] = max(1, int(params.get(
+            'datadog_rate_burst', constants.DEFAULT_DATADOG_RATE_BURST)) // workers)
+        # the rate limit headers give the whole org's allowance
+        params['datadog_rate_share'] = 1.0 / workers
+        return params
+
+    def chunks(self, queries, checkpoints=None):
+        """
+        List the chunks still to do.
+
+        :param queries: query dictionaries
+        :param checkpoints: checkpoint.CheckpointStore with the completed
+                            chunks, or None
+        :return: list of (metric, query, start, end)
+        """
+        todo = []
+        for query in queries:
+            try:
+                metric, dd_query = query['metric'], query['query']
+                rollup.Rollup.from_query(query)
+            except (KeyError, TypeError, ValueError):
+                self.logger.error("Backfill: skipping bad query %s", query)
+                continue
+            done = (checkpoints.done_chunks(metric, dd_query)
+                    if checkpoints is not None else [])
+            for start, end in split_range(self.start, self.end, self.chunk):
+                if not any(first <= start and end <= last
+                           for first, last in done):
+                    todo.append((metric, dd_query, start, end))
+        return todo
+
+    def report(self, results, elapsed, skipped):
+        """
+        Log the throughput report.
+        """
+        points = sum(res.points for res in results)
+        failed = [res for res in results if not res.ok]
+        self.logger.info("Backfill: %d chunks in %.1fs (%d failed, %d "
+                         "already done)", len(results), elapsed, len(failed),
+                         skipped)
+        self.logger.info("Backfill: %d points, %.1f points/s, %.2f chunks/s",
+                         points, points / elapsed if elapsed else 0.0,
+                         len(results) / elapsed if elapsed else 0.0)
+        per_metric = defaultdict(lambda: [0, 0])
+        for res in results:
+            per_metric[res.metric][0] += 1
+            per_metric[res.metric][1] += res.points
+        for metric in sorted(per_metric):
+            self.logger.info("Backfill: %s: %d chunks, %d points", metric,
+                             *per_metric[metric])
+        for res in failed:
+            self.logger.error("Backfill: %s %d - %d failed: %s", res.metric,
+                              res.start, res.end, res.error)
+
+    def run(self):
+        """
+        Run the backfill.
+
+        :return: status code (1 fail, 0 success)
+        """
+        exporter = get_stats.Exporter()
+        queries = exporter.load_json_file(self.params['queries_file'])
+        try:
+            queries = queries['queries']
+        except KeyError as exn:
+            self.logger.error('Error loading queries file. Missing key: %s', exn)
+            return 1
+
+        checkpoints = exporter.open_checkpoints()
+        try:
+            total = len(split_range(self.start, self.end, self.chunk)) * len(queries)
+            todo = self.chunks(queries, checkpoints)
+            self.logger.info("Backfill %d - %d: %d chunks on %d processes",
+                             self.start, self.end, len(todo), self.workers)
+            started = time.time()
+            results = []
+            params = self.worker_params()
+            rollups = rollup.parse_rollups(queries)
+            with ProcessPoolExecutor(max_workers=max(1, self.workers)) as pool:
+                futures = [pool.submit(run_chunk, params, *chunk,
+                                       query_rollup=rollups.get(chunk[0]))
+                           for chunk in todo]
+                for future in as_completed(futures):
+                    res = future.result()
+                    results.append(res)
+                    if res.ok and checkpoints is not None:
+                        checkpoints.record_chunk(res.metric, res.query,
+                                                 res.start, res.end, res.points)
+                    self.logger.info("Backfill: %s %d - %d %s, %d points "
+                                     "(%d/%d)", res.metric, res.start, res.end,
+                                     'done' if res.ok else 'FAILED',
+                                     res.points, len(results), len(todo))
+            self.report(results, time.time() - started, total - len(todo))
+        finally:
+            if checkpoints is not None:
+                checkpoints.close()
+        return 0 if all(res.ok for res in results) else 1
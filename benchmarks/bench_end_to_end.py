@@ -0,0 +1,182 @@
+"""
+Benchmark: end to end exporter run against local Datadog and Influx
+stand-ins
+
+Usage:
+    python -m benchmarks.bench_end_to_end [-f FOUNDRIES] [-q QUERIES]
+        [-d DAYS] [-i INTERVAL] [--datadog-latency S] [--influx-latency S]
+        [--engine threads|async] [options]
+
+Note(s):
+    1. Requires Python 3 and the exporter's requirements
+    2. Starts FakeDatadog and FakeInflux (see fake_servers.py), writes a
+       foundations and a queries file for them and runs the Exporter (or
+       the asyncio AsyncExporter) end to end, as get_stats.py would.
+    3. Reports wall time, points/sec, Datadog and Influx API calls, bytes
+       on the wire and the peak RSS of the process.
+    4. Checkpoints, the spool and the Datadog cache are off, and the
+       Datadog rate limit is lifted, unless asked for.
+    5. --sinks adds FakeInflux instances as additional Influx sinks
+       (threads engine), with their own --sink-latency.
+
+"""
+import argparse
+from contextlib import ExitStack
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_servers import FakeDatadog, FakeInflux
+from commonpy.logger import Logger
+from commonpy.parameters import SysParams
+
+
+def write_files(directory, foundries, nqueries):
+    """
+    Write the foundations and queries files.
+
+    :return: (foundations file, queries file)
+    """
+    foundations = {'foundations': [{'foundry': foundry,
+                                    'environment': 'bench',
+                                    'dc': 'dc{}'.format(nbr % 3),
+                                    'region': 'region {}'.format(nbr % 5),
+                                    'context': 'EIT'}
+                                   for nbr, foundry in enumerate(foundries)]}
+    queries = {'queries': [{'metric': 'bench.metric.{}'.format(nbr),
+                            'query': 'avg:bench.metric.{}{{*}}by{{foundry}}'
+                                     .format(nbr)}
+                           for nbr in range(nqueries)]}
+    paths = (os.path.join(directory, 'foundations.json'),
+             os.path.join(directory, 'queries.json'))
+    for path, payload in zip(paths, (foundations, queries)):
+        with open(path, 'w') as out:
+            json.dump(payload, out)
+    return paths
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process (MB).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def main():
+    """
+    Run the exporter against the stand-ins and print a report.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--foundries", type=int, default=20,
+                        help="foundries (series per query window)")
+    parser.add_argument("-q", "--queries", type=int, default=4,
+                        help="metric queries")
+    parser.add_argument("-d", "--days", type=float, default=7,
+                        help="days of history to export")
+    parser.add_argument("-i", "--interval", type=int, default=60,
+                        help="seconds between points")
+    parser.add_argument("--datadog-latency", type=float, default=0.05,
+                        help="Datadog response delay (seconds)")
+    parser.add_argument("--influx-latency", type=float, default=0.005,
+                        help="Influx write delay (seconds)")
+    parser.add_argument("--sinks", type=int, default=0,
+                        help="additional Influx sinks")
+    parser.add_argument("--sink-latency", type=float,
+                        help="additional sinks' write delay (seconds, "
+                             "default the Influx one)")
+    parser.add_argument("--engine", choices=['threads', 'async'],
+                        default='threads', help="export engine")
+    parser.add_argument("-t", "--time-range", type=float, default=24,
+                        help="Datadog window (hours)")
+    parser.add_argument("--window-mode", choices=['fixed', 'adaptive'],
+                        default='fixed', help="Datadog window sizing")
+    parser.add_argument("--datadog-response-mode",
+                        choices=['buffered', 'streaming'], default='buffered',
+                        help="read Datadog responses whole or series by series")
+    parser.add_argument("-n", "--query-workers", type=int, default=4,
+                        help="queries run concurrently")
+    parser.add_argument("--pipeline-writers", type=int, default=1,
+                        help="Influx writer threads per query")
+    parser.add_argument("-b", "--influx-batch-size", type=int, default=5000,
+                        help="points per Influx write (initial)")
+    parser.add_argument("--log-level", default='WARNING',
+                        help="exporter log level")
+    args = parser.parse_args()
+    Logger(level=args.log_level)
+
+    workdir = tempfile.mkdtemp(prefix='bench-e2e-')
+    foundries = ['bench-{:03d}'.format(nbr) for nbr in range(args.foundries)]
+    foundations_file, queries_file = write_files(workdir, foundries,
+                                                 args.queries)
+    now = int(time.time())
+    try:
+        with FakeDatadog(foundries, args.interval,
+                         args.datadog_latency) as datadog, \
+             FakeInflux(args.influx_latency) as influx, ExitStack() as stack:
+            sink_latency = (args.sink_latency if args.sink_latency is not None
+                            else args.influx_latency)
+            extra = [stack.enter_context(FakeInflux(sink_latency))
+                     for _ in range(args.sinks)]
+            params = SysParams()
+            params.update({
+                'foundations_file': foundations_file,
+                'queries_file': queries_file,
+                'START_TIMESTAMP': int(now - args.days * 86400),
+                'datadog_time_range': int(args.time_range * 3600),
+                'datadog_api_key': 'bench', 'datadog_app_key': 'bench',
+                'datadog_api_host': datadog.url,
+                'datadog_rate_limit': 10 ** 9, 'datadog_rate_period': 1,
+                'datadog_rate_burst': 10 ** 6,
+                'datadog_cache_dir': '',
+                'datadog_response_mode': args.datadog_response_mode,
+                'influx_host': influx.address[0],
+                'influx_port': influx.address[1],
+                'influx_database': 'bench', 'influx_user': '',
+                'influx_password': '', 'influx_timeout': 30,
+                'influx_batch_size': args.influx_batch_size,
+                'checkpoint_file': '', 'spool_dir': '',
+                'window_mode': args.window_mode,
+                'query_workers': args.query_workers,
+                'pipeline_writers': args.pipeline_writers,
+                'async_concurrency': args.query_workers * 4,
+                'influx_sinks': [{'name': 'sink{}'.format(nbr),
+                                  'host': sink.address[0],
+                                  'port': sink.address[1]}
+                                 for nbr, sink in enumerate(extra)],
+            })
+            if args.engine == 'async':
+                import async_engine
+                exporter = async_engine.AsyncExporter()
+            else:
+                import get_stats
+                exporter = get_stats.Exporter()
+
+            started = time.perf_counter()
+            status = exporter.run()
+            elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir)
+
+    print("{} engine, {} queries x {} foundries, {} days at {}s".format(
+        args.engine, args.queries, args.foundries, args.days, args.interval))
+    print("status {}, wall time {:.2f}s".format(status, elapsed))
+    print("points: {:,} served, {:,} written, {:,.0f} points/sec".format(
+        datadog.points, influx.points, influx.points / elapsed))
+    print("Datadog: {:,} calls, {:.2f} MB out".format(
+        datadog.requests, datadog.bytes_out / 1e6))
+    print("Influx:  {:,} calls ({:,} writes), {:.2f} MB in".format(
+        influx.requests, influx.writes, influx.bytes_in / 1e6))
+    for nbr, sink in enumerate(extra):
+        print("sink{}:   {:,} points, {:,} writes".format(nbr, sink.points,
+                                                        sink.writes))
+    print("peak RSS: {:.1f} MB".format(peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    main()
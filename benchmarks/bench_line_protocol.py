@@ -0,0 +1,148 @@
+"""
+Benchmark: line protocol batch encoder vs the SeriesHelper write path
+
+Usage:
+    python -m benchmarks.bench_line_protocol [-n POINTS] [-s SERIES]
+
+Note(s):
+    1. Requires Python 3 and influxdb
+    2. Both paths run against a stub client which records the request
+       body instead of sending it, so the figures are encode CPU time and
+       body size only.
+
+"""
+import argparse
+import json
+import time
+
+import influxdb
+from influxdb.line_protocol import make_lines
+
+import line_protocol
+import pointlist
+
+TAGS = {'foundry': 'px-prd01', 'environment': 'production',
+        'dc': 'Polaris', 'region': 'px-01', 'context': 'EIT'}
+
+
+class StubClient(object):
+    """
+    Stand-in for InfluxDBClient: keeps the size of what would be sent.
+    """
+    def __init__(self):
+        self.nbytes = 0
+        self.nbytes_json = 0
+
+    def write_points(self, points, time_precision=None, protocol='json', **kwargs):
+        if protocol == 'line':
+            body = '\n'.join(points) + '\n'
+        else:
+            body = make_lines({'points': points}, time_precision)
+            self.nbytes_json += len(json.dumps(points))
+        self.nbytes += len(body.encode('utf-8'))
+        return True
+
+
+def make_points(npoints):
+    """
+    Synthetic Datadog point list ([ms timestamp, value]).
+    """
+    start = 1500000000000.0
+    return [[start + nbr * 20000, nbr * 1.25] for nbr in range(npoints)]
+
+
+def series_helper_path(client, metric, points):
+    """
+    The previous send_points(): one SeriesHelper object per point,
+    committed 150 points at a time.
+    """
+    class SeriesHelper(influxdb.SeriesHelper):
+        class Meta:
+            fields = ['value', 'time']
+            tags = list(TAGS)
+            bulk_size = 150
+            autocommit = True
+    SeriesHelper.Meta.client = client
+    SeriesHelper.Meta.series_name = metric
+    for point in points:
+        point_time, point_value = point[0:2]
+        SeriesHelper(time=int(point_time) * 1000000, value=point_value, **TAGS)
+    SeriesHelper.commit()
+
+
+def line_protocol_path(client, encoder, metric, points):
+    """
+    The line protocol encoder path used by send_points().
+    """
+    prefix = encoder.prefix(metric, TAGS['foundry'], TAGS)
+    for batch in encoder.batches(prefix, points):
+        client.write_points(batch, time_precision='ms', protocol='line')
+
+
+def column_path(client, encoder, metric, points):
+    """
+    Columns conversion (NumPy when installed) then encoding.
+    """
+    prefix = encoder.prefix(metric, TAGS['foundry'], TAGS)
+    times, values = pointlist.to_columns(points)
+    for batch in encoder.column_batches(prefix, times, values):
+        client.write_points(batch, time_precision='ms', protocol='line')
+
+
+def timed(func, *args):
+    """
+    Run func(*args), return the elapsed (wall) time.
+    """
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    """
+    Run both paths over the same synthetic series and print a report.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--points", type=int, default=20000,
+                        help="points per series")
+    parser.add_argument("-s", "--series", type=int, default=10,
+                        help="number of series")
+    parser.add_argument("-b", "--batch-size", type=int, default=5000,
+                        help="line protocol batch size")
+    args = parser.parse_args()
+
+    points = make_points(args.points)
+    total = args.points * args.series
+
+    helper_client = StubClient()
+    helper_time = sum(timed(series_helper_path, helper_client, 'bench', points)
+                      for _ in range(args.series))
+
+    line_client = StubClient()
+    encoder = line_protocol.LineEncoder(args.batch_size)
+    line_time = sum(timed(line_protocol_path, line_client, encoder, 'bench',
+                          points)
+                    for _ in range(args.series))
+
+    column_client = StubClient()
+    column_time = sum(timed(column_path, column_client, encoder, 'bench',
+                            points)
+                      for _ in range(args.series))
+
+    print("{} series x {} points".format(args.series, args.points))
+    print("{:<16} {:>10} {:>14} {:>12}".format('path', 'seconds',
+                                                'points/sec', 'body MB'))
+    columns = 'columns ({})'.format('numpy' if pointlist.numpy else 'python')
+    for name, elapsed, client in (('SeriesHelper', helper_time, helper_client),
+                                  ('line protocol', line_time, line_client),
+                                  (columns, column_time, column_client)):
+        print("{:<16} {:>10.3f} {:>14,.0f} {:>12.2f}".format(
+            name, elapsed, total / elapsed, client.nbytes / 1e6))
+    print("SeriesHelper JSON point list: {:.2f} MB".format(
+        helper_client.nbytes_json / 1e6))
+    print("speedup: {:.1f}x (line protocol), {:.1f}x ({})".format(
+        helper_time / line_time, helper_time / column_time, columns))
+
+
+if __name__ == "__main__":
+    main()
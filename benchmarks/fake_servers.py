@@ -0,0 +1,190 @@
+"""
+Local stand-ins for the Datadog query API and the Influx HTTP API
+
+Note(s):
+    1. Requires Python 3
+    2. FakeDatadog answers GET /api/v1/query with synthetic series: one
+       per foundry, one point every 'interval' seconds over the asked
+       window, after 'latency' seconds.
+    3. FakeInflux accepts POST /write (counting lines and bytes, after
+       'latency' seconds) and answers GET /query with empty results, so
+       every metric starts from START_TIMESTAMP.
+    4. Both count requests and bytes in and out.  They run on a thread
+       each (ThreadingMixIn, one thread per connection) until stop().
+
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+import time
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Request handler base: counting, replies.
+    """
+    protocol_version = 'HTTP/1.1'
+    fake = None         # the owning FakeServer, set per server class
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.fake.count(bytes_out=len(body))
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.fake.count(bytes_in=len(body))
+        return body
+
+    def args(self):
+        url = urlparse(self.path)
+        return url.path, {key: val[0] for key, val in parse_qs(url.query).items()}
+
+
+class FakeServer(object):
+    """
+    A stand-in HTTP server on a local port.
+    """
+    handler = _Handler
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: seconds to wait before answering
+        """
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+        handler = type('Handler', (self.handler,), {'fake': self})
+        self.server = _Server(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.address)
+
+    def count(self, requests=0, bytes_in=0, bytes_out=0):
+        with self._lock:
+            self.requests += requests
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _DatadogHandler(_Handler):
+    def do_GET(self):
+        path, args = self.args()
+        self.fake.count(requests=1)
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if path != '/api/v1/query':
+            return self.reply(404)
+        body = self.fake.response(args.get('query', ''),
+                                  int(args['from']), int(args['to']))
+        self.reply(200, body)
+
+
+class FakeDatadog(FakeServer):
+    """
+    Synthetic Datadog time series query API.
+    """
+    handler = _DatadogHandler
+
+    def __init__(self, foundries, interval=20, latency=0.0):
+        """
+        :param foundries: foundry names to return a series for
+        :param interval: seconds between points
+        :param latency: seconds to wait before answering
+        """
+        super().__init__(latency)
+        self.foundries = list(foundries)
+        self.interval = max(1, int(interval))
+        self.points = 0
+
+    def response(self, query, start, end):
+        """
+        Build the (encoded) response for a window.
+        """
+        first = -(-start // self.interval) * self.interval
+        stamps = range(first, end + 1, self.interval)
+        series = [{'scope': 'foundry:{}'.format(foundry),
+                   'metric': query, 'interval': self.interval,
+                   'length': len(stamps),
+                   'pointlist': [[stamp * 1000.0, (stamp % 997) * 0.5 + nbr]
+                                 for stamp in stamps]}
+                  for nbr, foundry in enumerate(self.foundries)]
+        with self._lock:
+            self.points += len(stamps) * len(self.foundries)
+        return json.dumps({'status': 'ok', 'res_type': 'time_series',
+                           'series': series, 'query': query,
+                           'from_date': start * 1000,
+                           'to_date': end * 1000}).encode()
+
+
+class _InfluxHandler(_Handler):
+    def do_GET(self):
+        path, _ = self.args()
+        self.fake.count(requests=1)
+        if path != '/query':
+            return self.reply(404)
+        self.reply(200, json.dumps({'results': [{'statement_id': 0}]}).encode())
+
+    def do_POST(self):
+        path, _ = self.args()
+        self.fake.count(requests=1)
+        body = self.read_body()
+        if path == '/query':
+            return self.reply(200, json.dumps(
+                {'results': [{'statement_id': 0}]}).encode())
+        if path != '/write':
+            return self.reply(404)
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        self.fake.wrote(body.count(b'\n') + (not body.endswith(b'\n')))
+        self.reply(204)
+
+
+class FakeInflux(FakeServer):
+    """
+    Influx HTTP API stand-in: /write and /query.
+    """
+    handler = _InfluxHandler
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.writes = 0
+        self.points = 0
+
+    def wrote(self, lines):
+        with self._lock:
+            self.writes += 1
+            self.points += lines
@@ -0,0 +1,185 @@
+"""
+Export checkpoint store
+
+Note(s):
+    1. Requires Python 3 (sqlite3)
+    2. Records the last timestamp (ms) successfully committed to Influx
+       per (metric, foundry) in a local SQLite database.  The database is
+       in WAL mode with synchronous=FULL so a recorded checkpoint has been
+       fsync'd and survives a crash or restart.
+    3. Runs read their watermarks from here first and only ask Influx
+       (SELECT LAST(*)) for metrics the store knows nothing about.
+    4. The store also keeps the adaptive window size chosen per Datadog
+       query (see windowing.py) from one run to the next.
+    5. Completed backfill chunks (see backfill.py) are recorded so an
+       interrupted backfill resumes where it stopped.
+
+"""
+import sqlite3
+import threading
+
+from commonpy.logger import Logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    metric TEXT NOT NULL,
+    foundry TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (metric, foundry)
+);
+CREATE TABLE IF NOT EXISTS windows (
+    query TEXT NOT NULL PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill (
+    metric TEXT NOT NULL,
+    query TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (metric, query, start, end)
+);
+"""
+
+
+class CheckpointStore(object):
+    """
+    Durable (metric, foundry) high-water mark store.
+    """
+    def __init__(self, path):
+        """
+        Open (creating if needed) the checkpoint database.
+
+        :param path: database file name
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def record(self, metric, foundry, timestamp):
+        """
+        Record a committed timestamp.  Checkpoints only move forward.
+
+        :param metric: metric (measurement) name
+        :param foundry: foundry name
+        :param timestamp: last committed timestamp (ms)
+        """
+        timestamp = int(timestamp)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT OR IGNORE INTO checkpoints '
+                                   '(metric, foundry, timestamp) '
+                                   'VALUES (?, ?, ?)',
+                                   (metric, foundry, timestamp))
+                self._conn.execute('UPDATE checkpoints SET timestamp = ? '
+                                   'WHERE metric = ? AND foundry = ? '
+                                   'AND timestamp < ?',
+                                   (timestamp, metric, foundry, timestamp))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def get(self, metric, foundry):
+        """
+        Get one checkpoint.
+
+        :return: timestamp (ms), or None if there is none
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT timestamp FROM checkpoints '
+                                     'WHERE metric = ? AND foundry = ?',
+                                     (metric, foundry)).fetchone()
+        return row[0] if row else None
+
+    def load(self, metrics):
+        """
+        Get the checkpoints for a list of metrics.
+
+        :param metrics: metric (measurement) names
+        :return: dictionary of (metric, foundry): timestamp (ms)
+        """
+        metrics = list(metrics)
+        if not metrics:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT metric, foundry, timestamp FROM checkpoints '
+                'WHERE metric IN ({})'.format(', '.join('?' * len(metrics))),
+                metrics).fetchall()
+        return {(metric, foundry): timestamp
+                for metric, foundry, timestamp in rows}
+
+    def get_window(self, query):
+        """
+        Get the window size last used for a Datadog query.
+
+        :return: window size (seconds), or None
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM windows WHERE query = ?',
+                                     (query,)).fetchone()
+        return row[0] if row else None
+
+    def record_window(self, query, size):
+        """
+        Remember the window size chosen for a Datadog query.
+
+        :param query: the Datadog query
+        :param size: window size (seconds)
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO windows (query, size) '
+                               'VALUES (?, ?)', (query, int(size)))
+
+    def record_chunk(self, metric, query, start, end, points=0):
+        """
+        Record a completed backfill chunk.
+
+        :param metric: metric (measurement) name
+        :param query: the Datadog query
+        :param start: chunk start (epoch seconds)
+        :param end: chunk end (epoch seconds)
+        :param points: points written
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO backfill '
+                               '(metric, query, start, end, points) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (metric, query, int(start), int(end),
+                                int(points)))
+
+    def done_chunks(self, metric, query):
+        """
+        Get the completed backfill chunks of a metric/query pair.
+
+        :return: list of (start, end), in start order
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT start, end FROM backfill '
+                                      'WHERE metric = ? AND query = ? '
+                                      'ORDER BY start',
+                                      (metric, query)).fetchall()
+        return [(start, end) for start, end in rows]
@@ -1,19 +1,214 @@
 """
 reaper logger functions.
+
+Note(s):
+    1. Requires Python 3
+    2. Set from the environment: LOG_LEVEL, LOG_FORMAT ('text', the bare
+       message, or 'json', one JSON object per line), LOG_ASYNC,
+       LOG_RATE_LIMIT and LOG_SAMPLE.
+    3. With LOG_ASYNC (the default) a logging call only queues the record
+       and a background thread writes it to stdout, so a slow stdout
+       (the Cloud Foundry loggregator) does not hold the caller up.  When
+       the queue is full records are dropped rather than waited for, and
+       the number dropped is logged once the writer catches up.
+    4. Each call site (file and line) may log at most LOG_RATE_LIMIT
+       records a second (0: no limit), the next record it gets through
+       says how many were suppressed.  Hot loop messages, logged with
+       extra=HOT_LOOP, are also sampled: 1 in LOG_SAMPLE is kept.
+    5. The handler is installed once per logger, however often Logger is
+       constructed again.
+
 """
+import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 
 from commonpy.singleton import Singleton
 
 DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_FORMAT = 'text'
+DEFAULT_LOG_ASYNC = 'true'
+DEFAULT_LOG_RATE_LIMIT = 50                 # records per second per call site
+DEFAULT_LOG_SAMPLE = 1                      # keep 1 in N hot loop records
+DEFAULT_LOG_QUEUE_SIZE = 10000
+
+# extra= for the messages of hot loops (per series, per batch), sampled
+HOT_LOOP = {'hot_loop': True}
+
+_TRACEBACKS = logging.Formatter()
+
+
+def is_true(value):
+    """
+    Is an environment setting on ('1', 'true', 'yes', 'on')?
+    """
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as single line JSON objects.
+    """
+    def format(self, record):
+        entry = {'time': '{}.{:03d}Z'.format(
+                     time.strftime('%Y-%m-%dT%H:%M:%S',
+                                   time.gmtime(record.created)),
+                     int(record.msecs)),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage(),
+                }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per call site rate limit (token bucket) and hot loop sampling.
+    """
+    def __init__(self, rate=DEFAULT_LOG_RATE_LIMIT, sample=DEFAULT_LOG_SAMPLE):
+        """
+        :param rate: records per second per call site, 0 for no limit
+        :param sample: keep 1 in 'sample' hot loop records
+        """
+        super().__init__()
+        self.rate = float(rate)
+        self.sample = max(1, int(sample))
+        self._sites = {}    # (file, line): [tokens, last refill, suppressed, seen]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            state = self._sites.get(site)
+            if state is None:
+                state = self._sites[site] = [max(1.0, self.rate), now, 0, 0]
+            if getattr(record, 'hot_loop', False) and self.sample > 1:
+                state[3] += 1
+                if (state[3] - 1) % self.sample:
+                    return False
+            if self.rate > 0:
+                state[0] = min(max(1.0, self.rate),
+                               state[0] + (now - state[1]) * self.rate)
+                state[1] = now
+                if state[0] < 1:
+                    state[2] += 1
+                    return False
+                state[0] -= 1
+            suppressed, state[2] = state[2], 0
+        if suppressed:
+            record.msg = '{} ({} similar messages suppressed)'.format(
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Handler writing records from a background thread through another
+    handler.  emit() only queues the record, dropping it if the queue is
+    full.
+    """
+    def __init__(self, target, capacity=DEFAULT_LOG_QUEUE_SIZE):
+        """
+        :param target: handler doing the writing (and formatting)
+        :param capacity: most records queued
+        """
+        super().__init__()
+        self.target = target
+        self.capacity = max(1, int(capacity))
+        self.dropped = 0
+        self._reported = 0
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.capacity)
+        self._thread = threading.Thread(target=self._write, name='log-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # a forked process (backfill worker): the writer stayed behind
+            self._start()
+        # the record is formatted later, on the writer thread: freeze its
+        # arguments and traceback now
+        try:
+            record.msg = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                if self.dropped > self._reported:
+                    dropped, self._reported = (self.dropped - self._reported,
+                                               self.dropped)
+                    self.target.handle(logging.makeLogRecord(
+                        {'name': record.name, 'levelno': logging.WARNING,
+                         'levelname': 'WARNING',
+                         'msg': '{} log records dropped'.format(dropped)}))
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait for the queued records to be written.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+        self.target.flush()
+
+    def close(self):
+        """
+        Write the queued records and stop the writer.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.target.close()
+        super().close()
 
 
 class Logger(object, metaclass=Singleton):
-    def __init__(self, appname=None, level=None):
+    def __init__(self, appname=None, level=None, log_format=None,
+                 use_async=None):
         """
         Get a logger object for application-wide use.
+
+        :param appname: logger name (APPNAME)
+        :param level: log level name (LOG_LEVEL)
+        :param log_format: 'text' or 'json' (LOG_FORMAT)
+        :param use_async: write from a background thread (LOG_ASYNC)
         """
         avail_levels = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO,
                         'WARNING': logging.WARNING, 'ERROR': logging.ERROR,
@@ -21,9 +216,34 @@ class Logger(object, metaclass=Singleton):
 
         appname = appname or os.environ.get('APPNAME', __name__)
         level_str = str(level or os.environ.get('LOG_LEVEL', DEFAULT_LOG_LEVEL)).upper()
+        log_format = log_format or os.environ.get('LOG_FORMAT', DEFAULT_LOG_FORMAT)
+        if use_async is None:
+            use_async = is_true(os.environ.get('LOG_ASYNC', DEFAULT_LOG_ASYNC))
 
         self._logger = logging.getLogger(appname)
-        self._logger.addHandler(logging.StreamHandler(sys.stdout))
+        # a new Logger (singleton reset) replaces the handler and filter,
+        # rather than adding more
+        for handler in [handler for handler in self._logger.handlers
+                        if getattr(handler, 'commonpy', False)]:
+            self._logger.removeHandler(handler)
+            handler.close()
+        for old_filter in [old_filter for old_filter in self._logger.filters
+                           if isinstance(old_filter, RateLimitFilter)]:
+            self._logger.removeFilter(old_filter)
+
+        handler = logging.StreamHandler(sys.stdout)
+        if log_format == 'json':
+            handler.setFormatter(JsonFormatter())
+        elif log_format != 'text':
+            print("Can't set log format to {}".format(log_format))
+        if use_async:
+            handler = AsyncHandler(handler, os.environ.get(
+                'LOG_QUEUE_SIZE', DEFAULT_LOG_QUEUE_SIZE))
+        handler.commonpy = True
+        self._logger.addHandler(handler)
+        self._logger.addFilter(RateLimitFilter(
+            os.environ.get('LOG_RATE_LIMIT', DEFAULT_LOG_RATE_LIMIT),
+            os.environ.get('LOG_SAMPLE', DEFAULT_LOG_SAMPLE)))
         if level_str in avail_levels:
             self._logger.setLevel(avail_levels[level_str])
             self._loglevel_str = level_str
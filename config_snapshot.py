@@ -0,0 +1,110 @@
+"""
+Parsed configuration snapshot
+
+Note(s):
+    1. Requires Python 3
+    2. The foundations and queries files are parsed, and the foundry tag
+       sets compiled, on every run.  The result is pickled to the
+       config_snapshot file and reused by later runs for as long as both
+       source files keep their size and modification time.
+    3. A snapshot is validated before use: format version, source files
+       (path, size, mtime) and the shape of its contents must all match,
+       otherwise it is ignored and rebuilt.
+    4. Snapshots are written to a temporary file and renamed, so a crash
+       never leaves a partial one.  A snapshot is a pickle: keep it where
+       only the exporter writes.
+
+"""
+import os
+import pickle
+import tempfile
+
+from commonpy.logger import Logger
+
+SNAPSHOT_VERSION = 1
+
+
+def source_key(paths):
+    """
+    Identify the current contents of the source files.  Raises OSError if
+    a file cannot be read.
+
+    :param paths: source file names
+    :return: list of (absolute path, size, mtime (ns))
+    """
+    key = []
+    for path in paths:
+        stat = os.stat(path)
+        key.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return key
+
+
+class ConfigSnapshot(object):
+    """
+    Snapshot of the compiled foundation tag sets and the query list.
+    """
+    def __init__(self, path):
+        """
+        :param path: snapshot file name
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.path = path
+
+    def load(self, key):
+        """
+        Load the snapshot, if it was built from the sources as they are.
+
+        :param key: source_key() of the source files
+        :return: (tag sets, queries), or None if there is no valid snapshot
+        """
+        try:
+            with open(self.path, 'rb') as snap:
+                payload = pickle.load(snap)
+        except FileNotFoundError:
+            return None
+        except Exception as exn:
+            self.logger.warning("Config snapshot %s unreadable: %s",
+                                self.path, exn)
+            return None
+        if not self.valid(payload, key):
+            self.logger.debug("Config snapshot %s out of date", self.path)
+            return None
+        return payload['tag_sets'], payload['queries']
+
+    @staticmethod
+    def valid(payload, key):
+        """
+        Check a loaded snapshot against the source key.
+        """
+        return (isinstance(payload, dict)
+                and payload.get('version') == SNAPSHOT_VERSION
+                and payload.get('sources') == key
+                and isinstance(payload.get('tag_sets'), dict)
+                and all(isinstance(tags, dict)
+                        for tags in payload['tag_sets'].values())
+                and isinstance(payload.get('queries'), list))
+
+    def save(self, key, tag_sets, queries):
+        """
+        Write the snapshot.  Failures are logged, not raised: the snapshot
+        is only a shortcut.
+
+        :param key: source_key() of the sources, taken before they were read
+        :param tag_sets: FoundryIndex.tag_sets()
+        :param queries: the query list
+        """
+        payload = {'version': SNAPSHOT_VERSION, 'sources': key,
+                   'tag_sets': tag_sets, 'queries': queries}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = None
+        try:
+            handle, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as snap:
+                pickle.dump(payload, snap, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except Exception as exn:
+            self.logger.warning("Config snapshot %s not written: %s",
+                                self.path, exn)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
@@ -3,6 +3,10 @@ Shared constants.
 """
 
 DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_FORMAT = 'text'                 # or 'json'
+DEFAULT_LOG_ASYNC = 'true'                  # write logs from a thread
+DEFAULT_LOG_RATE_LIMIT = 50                 # records/s per call site (0: off)
+DEFAULT_LOG_SAMPLE = 1                      # keep 1 in N hot loop records
 
 REQUIRED_ENV = []
 
@@ -16,14 +20,98 @@ DEFAULT_INFLUX_DATABASE = 'cf-stats'
 DEFAULT_INFLUX_HOST = 'influxdb-poc01.unix.gsm1900.org'
 DEFAULT_INFLUX_PORT = 8086
 DEFAULT_INFLUX_TIMEOUT = 10
+DEFAULT_INFLUX_BATCH_SIZE = 5000            # initial, adapted within:
+DEFAULT_INFLUX_BATCH_MIN = 100
+DEFAULT_INFLUX_BATCH_MAX = 50000
+DEFAULT_INFLUX_WRITE_LATENCY = 1.0          # seconds per write to aim for
+DEFAULT_INFLUX_MAX_RETRIES = 5
+DEFAULT_INFLUX_BACKOFF = 0.5                # seconds, doubled per retry
+DEFAULT_INFLUX_PRECISION = 'ms'
 
 DEFAULT_DATADOG_TIME_RANGE = 75
+DEFAULT_CHECKPOINT_FILE = 'checkpoints.db'
+DEFAULT_CONFIG_SNAPSHOT = '.config_snapshot.pickle'     # '' for none
+
+# Influx write-ahead spool
+DEFAULT_SPOOL_DIR = 'spool'
+DEFAULT_SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SPOOL_DRAIN_INTERVAL = 5            # seconds
+
+# Foundries further behind a metric's newest watermark do not hold its
+# start back (0: no limit)
+DEFAULT_WATERMARK_MAX_LAG = 7 * 24          # hours
+
+DEFAULT_WINDOW_MODE = 'fixed'
+DEFAULT_WINDOW_MIN = 1                      # hours
+DEFAULT_WINDOW_MAX = 14 * 24                # hours
+DEFAULT_WINDOW_TARGET_POINTS = 300
+DEFAULT_WINDOW_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_WINDOW_MAX_LATENCY = 20             # seconds
 DEFAULT_START_TIMESTAMP = 1479945600 #11/23/2016 12:00 am
 
+# Datadog response cache (settled windows only)
+DEFAULT_DATADOG_CACHE_DIR = ''              # '' for no cache
+DEFAULT_DATADOG_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_DATADOG_CACHE_IMMUTABLE_AFTER = 24 * 60     # minutes
+
+# Datadog query rate limit (re-tuned from the response headers)
+DEFAULT_DATADOG_RATE_LIMIT = 1600           # requests per period
+DEFAULT_DATADOG_RATE_PERIOD = 3600          # seconds
+DEFAULT_DATADOG_RATE_BURST = 10
+DEFAULT_DATADOG_MAX_RETRIES = 5
+
+# Datadog responses: 'buffered' (whole window) or 'streaming' (per series)
+DEFAULT_DATADOG_RESPONSE_MODE = 'buffered'
+DEFAULT_DATADOG_TIMEOUT = 60                # seconds (streaming mode)
+
+# Daemon mode polling
+DEFAULT_POLL_INTERVAL = 300                 # seconds, per query
+DEFAULT_POLL_JITTER = 0.1                   # fraction of the interval
+DEFAULT_POLL_LOOKBACK = 600                 # seconds re-read for late points
+
+# Historical backfill
+DEFAULT_BACKFILL_WORKERS = 4                # processes
+DEFAULT_BACKFILL_CHUNK = 7 * 24             # hours
+
+# Prometheus metrics endpoint port (0: off)
+DEFAULT_METRICS_PORT = 0
+
+# Additional Influx sinks (JSON list or file, see sinks.py)
+DEFAULT_INFLUX_SINKS = ''
+DEFAULT_INFLUX_SINK_DEPTH = 256             # series queued per sink
+DEFAULT_INFLUX_SINK_OVERFLOW = 'spool'      # full queue: 'spool', 'block', 'drop'
+
+DEFAULT_QUERY_WORKERS = 4
+DEFAULT_QUERY_BATCH = 1                     # distinct queries per request
+DEFAULT_PIPELINE_WRITERS = 1
+DEFAULT_PIPELINE_DEPTH = 16
+
+DEFAULT_DATADOG_API_HOST = 'https://api.datadoghq.com'
+DEFAULT_ASYNC_CONCURRENCY = 32
+
+# Foundation info file keys written to Influx as tags (along with 'foundry')
+FOUNDATION_TAGS = ['environment', 'dc', 'region', 'context']
+
 OVERRIDABLE_ENV = {
         'LOG_LEVEL': DEFAULT_LOG_LEVEL,
+        'LOG_FORMAT': DEFAULT_LOG_FORMAT,
+        'LOG_ASYNC': DEFAULT_LOG_ASYNC,
+        'LOG_RATE_LIMIT': DEFAULT_LOG_RATE_LIMIT,
+        'LOG_SAMPLE': DEFAULT_LOG_SAMPLE,
         'DATADOG_TIME_RANGE': DEFAULT_DATADOG_TIME_RANGE,
         'START_TIMESTAMP': DEFAULT_START_TIMESTAMP,
+        'CHECKPOINT_FILE': DEFAULT_CHECKPOINT_FILE,
+        'CONFIG_SNAPSHOT': DEFAULT_CONFIG_SNAPSHOT,
+        'SPOOL_DIR': DEFAULT_SPOOL_DIR,
+        'SPOOL_SEGMENT_BYTES': DEFAULT_SPOOL_SEGMENT_BYTES,
+        'SPOOL_DRAIN_INTERVAL': DEFAULT_SPOOL_DRAIN_INTERVAL,
+        'WATERMARK_MAX_LAG': DEFAULT_WATERMARK_MAX_LAG,
+        'WINDOW_MODE': DEFAULT_WINDOW_MODE,
+        'WINDOW_MIN': DEFAULT_WINDOW_MIN,
+        'WINDOW_MAX': DEFAULT_WINDOW_MAX,
+        'WINDOW_TARGET_POINTS': DEFAULT_WINDOW_TARGET_POINTS,
+        'WINDOW_MAX_BYTES': DEFAULT_WINDOW_MAX_BYTES,
+        'WINDOW_MAX_LATENCY': DEFAULT_WINDOW_MAX_LATENCY,
         'QUERIES_FILE': DEFAULT_QUERIES_FILE,
         'INFLUX_DATABASE': DEFAULT_INFLUX_DATABASE,
         'INFLUX_HOST': DEFAULT_INFLUX_HOST,
@@ -31,6 +119,37 @@ OVERRIDABLE_ENV = {
         'INFLUX_USER': '',
         'INFLUX_PASSWORD': '',
         'INFLUX_TIMEOUT': DEFAULT_INFLUX_TIMEOUT,
+        'INFLUX_BATCH_SIZE': DEFAULT_INFLUX_BATCH_SIZE,
+        'INFLUX_BATCH_MIN': DEFAULT_INFLUX_BATCH_MIN,
+        'INFLUX_BATCH_MAX': DEFAULT_INFLUX_BATCH_MAX,
+        'INFLUX_WRITE_LATENCY': DEFAULT_INFLUX_WRITE_LATENCY,
+        'INFLUX_MAX_RETRIES': DEFAULT_INFLUX_MAX_RETRIES,
+        'INFLUX_BACKOFF': DEFAULT_INFLUX_BACKOFF,
+        'INFLUX_PRECISION': DEFAULT_INFLUX_PRECISION,
         'DATADOG_API_KEY': None,
         'DATADOG_APP_KEY': None,
+        'DATADOG_CACHE_DIR': DEFAULT_DATADOG_CACHE_DIR,
+        'DATADOG_CACHE_MAX_BYTES': DEFAULT_DATADOG_CACHE_MAX_BYTES,
+        'DATADOG_CACHE_IMMUTABLE_AFTER': DEFAULT_DATADOG_CACHE_IMMUTABLE_AFTER,
+        'DATADOG_RATE_LIMIT': DEFAULT_DATADOG_RATE_LIMIT,
+        'DATADOG_RATE_PERIOD': DEFAULT_DATADOG_RATE_PERIOD,
+        'DATADOG_RATE_BURST': DEFAULT_DATADOG_RATE_BURST,
+        'DATADOG_MAX_RETRIES': DEFAULT_DATADOG_MAX_RETRIES,
+        'DATADOG_RESPONSE_MODE': DEFAULT_DATADOG_RESPONSE_MODE,
+        'DATADOG_TIMEOUT': DEFAULT_DATADOG_TIMEOUT,
+        'POLL_INTERVAL': DEFAULT_POLL_INTERVAL,
+        'POLL_JITTER': DEFAULT_POLL_JITTER,
+        'POLL_LOOKBACK': DEFAULT_POLL_LOOKBACK,
+        'BACKFILL_WORKERS': DEFAULT_BACKFILL_WORKERS,
+        'BACKFILL_CHUNK': DEFAULT_BACKFILL_CHUNK,
+        'METRICS_PORT': DEFAULT_METRICS_PORT,
+        'INFLUX_SINKS': DEFAULT_INFLUX_SINKS,
+        'INFLUX_SINK_DEPTH': DEFAULT_INFLUX_SINK_DEPTH,
+        'INFLUX_SINK_OVERFLOW': DEFAULT_INFLUX_SINK_OVERFLOW,
+        'QUERY_WORKERS': DEFAULT_QUERY_WORKERS,
+        'QUERY_BATCH': DEFAULT_QUERY_BATCH,
+        'PIPELINE_WRITERS': DEFAULT_PIPELINE_WRITERS,
+        'PIPELINE_DEPTH': DEFAULT_PIPELINE_DEPTH,
+        'DATADOG_API_HOST': DEFAULT_DATADOG_API_HOST,
+        'ASYNC_CONCURRENCY': DEFAULT_ASYNC_CONCURRENCY,
 }
@@ -0,0 +1,179 @@
+"""
+Exporter daemon mode
+
+Note(s):
+    1. Requires Python 3
+    2. Runs the exporter as a long lived worker instead of a one shot
+       process per cycle.  The Datadog and Influx clients, the parsed
+       foundation and query files and the watermarks are set up once and
+       kept warm.
+    3. Every query is polled on its own interval ('interval' seconds in
+       its metricQueries.json entry, else poll_interval), with a random
+       jitter of up to poll_jitter of the interval so the queries do not
+       all hit Datadog at once.
+    4. The first pass of a query catches up from its watermark; after
+       that each pass only fetches from the end of the previous pass
+       (less poll_lookback seconds, for late arriving points).  Points
+       already written are dropped by the per series watermarks.
+    5. SIGTERM (what Cloud Foundry sends) and SIGINT stop the daemon:
+       running passes stop after their current window, the checkpoint
+       store is closed and the process exits 0.
+
+"""
+import heapq
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+import get_stats
+
+from commonpy.logger import Logger
+from commonpy.parameters import SysParams
+
+
+class Daemon(object):
+    """
+    Per query polling scheduler around an Exporter.
+    """
+    def __init__(self, exporter=None):
+        """
+        :param exporter: the get_stats.Exporter to drive (created if None)
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.params = SysParams().params
+        self.exporter = exporter if exporter is not None else get_stats.Exporter()
+        self.interval = float(self.params.get('poll_interval',
+                                              constants.DEFAULT_POLL_INTERVAL))
+        self.jitter = float(self.params.get('poll_jitter',
+                                            constants.DEFAULT_POLL_JITTER))
+        self.lookback = int(self.params.get('poll_lookback',
+                                            constants.DEFAULT_POLL_LOOKBACK))
+        self.ticks = 0
+        self._next_start = {}       # qnbr: start of the next pass
+        self._schedule = []         # heap of (due time, qnbr, query)
+        # reentrant: the signal handler may run while the main thread
+        # holds it
+        self._cond = threading.Condition(threading.RLock())
+
+    @property
+    def stopping(self):
+        return self.exporter.stopping
+
+    def stop(self, signum=None, frame=None):
+        """
+        Ask the daemon to stop (also the signal handler).
+        """
+        if signum is not None:
+            self.logger.info("Signal %d received, shutting down", signum)
+        self.stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def install_signal_handlers(self):
+        """
+        Stop on SIGTERM and SIGINT (main thread only).
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def query_interval(self, query):
+        """
+        Get a query's poll interval.
+
+        :param query: query dictionary
+        :return: interval (seconds)
+        """
+        try:
+            return float(query.get('interval', self.interval))
+        except (AttributeError, TypeError, ValueError):
+            return self.interval
+
+    def next_due(self, query, now):
+        """
+        Get the time a query is next due: one interval from now, plus
+        jitter.
+        """
+        interval = self.query_interval(query)
+        return now + interval + random.uniform(0, interval * self.jitter)
+
+    def schedule(self, due, qnbr, query):
+        with self._cond:
+            heapq.heappush(self._schedule, (due, qnbr, query))
+            self._cond.notify_all()
+
+    def _next_query(self):
+        """
+        Wait for the next query to be due.
+
+        :return: (qnbr, query), or None once stopping
+        """
+        with self._cond:
+            while not self.stopping.is_set():
+                now = time.time()
+                if self._schedule and self._schedule[0][0] <= now:
+                    _, qnbr, query = heapq.heappop(self._schedule)
+                    return qnbr, query
+                self._cond.wait(self._schedule[0][0] - now
+                                if self._schedule else None)
+        return None
+
+    def tick(self, qnbr, query, foundation_info):
+        """
+        Run one pass of a query and schedule the next one.
+
+        :return: get_stats.QueryResult
+        """
+        tick_end = int(time.time())
+        result = self.exporter._timed_query(qnbr, query, foundation_info,
+                                            self._next_start.get(qnbr))
+        with self._cond:
+            self.ticks += 1
+        if result.ok:
+            # a failed pass is retried from the same start next time
+            self._next_start[qnbr] = tick_end - self.lookback
+        self.logger.info("[%d] %s pass %s in %.1fs (%d series)", qnbr,
+                         result.metric, 'done' if result.ok else 'FAILED',
+                         result.elapsed, result.nseries)
+        if not self.stopping.is_set():
+            self.schedule(self.next_due(query, time.time()), qnbr, query)
+        return result
+
+    def serve(self):
+        """
+        Run until stopped.
+
+        :return: status code (1 fail, 0 success)
+        """
+        if threading.current_thread() is threading.main_thread():
+            self.install_signal_handlers()
+        prepared = self.exporter.prepare()
+        if prepared is None:
+            return 1
+        foundation_info, queries = prepared
+
+        try:
+            # start catching up right away, spread over the default jitter
+            now = time.time()
+            for qnbr, query in enumerate(queries, 1):
+                self.schedule(now + random.uniform(0, self.interval * self.jitter),
+                              qnbr, query)
+
+            workers = int(self.params.get('query_workers',
+                                          constants.DEFAULT_QUERY_WORKERS))
+            self.logger.info("Daemon polling %d queries", len(queries))
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                while True:
+                    due = self._next_query()
+                    if due is None:
+                        break
+                    pool.submit(self.tick, due[0], due[1], foundation_info)
+        finally:
+            # the checkpoints, spool and sinks are released however the
+            # loop ends
+            self.exporter.close()
+        self.logger.info("Daemon stopped after %d passes", self.ticks)
+        return 0
@@ -0,0 +1,108 @@
+"""
+Point deduplication
+
+Note(s):
+    1. Requires Python 3
+    2. Drops points Influx already has before they are encoded:
+       - points at or below the series' (metric, foundry) watermark,
+       - points repeated by adjacent Datadog windows: a window's bounds
+         are inclusive, so a point on the boundary (and rollup buckets
+         straddling it) come back in both windows.  The last timestamp
+         handed on per series is remembered and the next window is
+         trimmed to after it.
+    3. Datadog point lists are in time order, so the trimmed points are
+       always at the head of a series; only those are looked at (binary
+       searched for a pointlist.Series).
+    4. One Deduplicator is used per query run: its windows come in time
+       order (the asyncio engine fetches them concurrently but writes
+       them in order).  track_overlap False only trims against the
+       watermarks, for windows handed on in any order.
+    5. The trimmed points are counted so the saving can be checked.
+
+"""
+import threading
+
+import pointlist
+
+
+class DedupStats(object):
+    """
+    Point counts across Deduplicators.
+    """
+    def __init__(self):
+        super().__init__()
+        self.kept = 0
+        self.watermark = 0
+        self.overlap = 0
+        self._lock = threading.Lock()
+
+    def add(self, kept, watermark, overlap):
+        with self._lock:
+            self.kept += kept
+            self.watermark += watermark
+            self.overlap += overlap
+
+
+class Deduplicator(object):
+    """
+    Per query run point trimming.
+    """
+    def __init__(self, watermarks, stats=None, track_overlap=True):
+        """
+        :param watermarks: watermarks.Watermarks of the run
+        :param stats: DedupStats to count into (a new one if None)
+        :param track_overlap: trim points handed on by earlier windows
+        """
+        super().__init__()
+        self.watermarks = watermarks
+        self.stats = stats if stats is not None else DedupStats()
+        self.track_overlap = track_overlap
+        self._sent = {}     # (metric, foundry): last timestamp handed on (ms)
+
+    def trim(self, metric, foundry, points):
+        """
+        Drop the points of a series that were already exported.
+
+        :param metric: measurement name
+        :param foundry: foundry name
+        :param points: pointlist.Series or Datadog point list
+                       ([timestamp (ms), value], ...)
+        :return: the points to send (a tail of 'points')
+        """
+        mark = self.watermarks.get(metric, foundry)
+        sent = self._sent.get((metric, foundry))
+        cutoff = max(mark if mark is not None else float('-inf'),
+                     sent if sent is not None else float('-inf'))
+        try:
+            head = count_upto(points, cutoff)
+            last = points[-1][0] if len(points) else None
+        except (TypeError, IndexError):
+            # malformed points, left to pointlist to sort out
+            return points
+
+        # split what was trimmed between the two causes
+        below_mark = head
+        if sent is not None and (mark is None or sent > mark):
+            below_mark = 0
+            if mark is not None:
+                below_mark = count_upto(points[:head], mark)
+        self.stats.add(len(points) - head, below_mark, head - below_mark)
+
+        if self.track_overlap and last is not None and last > cutoff:
+            self._sent[(metric, foundry)] = last
+        return points[head:] if head else points
+
+
+def count_upto(points, timestamp):
+    """
+    Number of leading points at or before a timestamp.
+
+    :param points: pointlist.Series or Datadog point list
+    :param timestamp: timestamp (ms)
+    """
+    if isinstance(points, pointlist.Series):
+        return points.count_upto(timestamp)
+    head = 0
+    while head < len(points) and points[head][0] <= timestamp:
+        head += 1
+    return head
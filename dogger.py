@@ -29,12 +29,60 @@ Note(s):
      'query': 'system.cpu.idle{*}by{host}',
      'message': u''
     }
+  3. datadog_response_mode 'streaming' issues the query itself and parses
+     the body as it arrives (series_stream.py), handing each series on as
+     soon as it is complete: memory then scales with one series rather
+     than one window.  Settled windows still go through the (buffered)
+     response cache when it is on.
+  4. The requests package (and its dependencies) is imported when a
+     Dogger is first created rather than with this module, so runs that
+     never query Datadog do not pay for it.  The datadog package is not
+     used.
+  5. Buffered queries go through the same per thread requests session
+     as streamed ones rather than the datadog client, which hides the
+     status and headers of failed requests: every response's rate limit
+     headers reach the scheduler, a 429 is retried after its
+     Retry-After (or X-RateLimit-Reset) and connection errors and
+     timeouts are retried like 5xx responses.
 
 """
 
+import threading
+import time
+
 from commonpy.logger import Logger
 import commonpy.parameters
-import datadog
+import constants
+import ratelimit
+import response_cache
+import series_stream
+import telemetry
+
+# Approximate size of one [timestamp, value] point in a query response
+BYTES_PER_POINT = 32
+
+# Body read size for streamed query responses
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class DatadogQueryFailed(Exception):
+    """ Datadog answered the query with errors """
+
+
+class DatadogServerError(Exception):
+    """ Datadog answered with a server error (5xx) """
+
+
+def transient_errors():
+    """
+    Get the Datadog query errors worth retrying (timeouts, connection
+    errors, 5xx).
+
+    :return: tuple of exception classes
+    """
+    import requests
+    return (DatadogServerError, requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout)
 
 
 class Dogger(object):  # (datadog.api):
@@ -47,30 +95,212 @@ class Dogger(object):  # (datadog.api):
         self.params = commonpy.parameters.SysParams().params
         self.logger = Logger().logger
 
-        datadog_options = {'api_key': self.params['datadog_api_key'],
-                           'app_key': self.params['datadog_app_key'],
-                          }
+        # Shared by every thread using this object
+        self.scheduler = ratelimit.RequestScheduler(
+            self.params.get('datadog_rate_limit',
+                            constants.DEFAULT_DATADOG_RATE_LIMIT),
+            self.params.get('datadog_rate_period',
+                            constants.DEFAULT_DATADOG_RATE_PERIOD),
+            burst=self.params.get('datadog_rate_burst',
+                                  constants.DEFAULT_DATADOG_RATE_BURST),
+            max_retries=self.params.get('datadog_max_retries',
+                                        constants.DEFAULT_DATADOG_MAX_RETRIES),
+            retry_on=transient_errors(),
+            share=self.params.get('datadog_rate_share', 1.0))
+        # queries that failed (after retries)
+        self.errors = 0
+
+        # Optional cache of settled windows' responses
+        self.cache = None
+        if self.params.get('datadog_cache_dir'):
+            self.cache = response_cache.ResponseCache(
+                self.params['datadog_cache_dir'],
+                self.params.get('datadog_cache_max_bytes',
+                                constants.DEFAULT_DATADOG_CACHE_MAX_BYTES),
+                self.params.get('datadog_cache_immutable_after',
+                                constants.DEFAULT_DATADOG_CACHE_IMMUTABLE_AFTER)
+                * 60)
 
-        datadog.initialize(**datadog_options)
+        self.streaming = (self.params.get('datadog_response_mode',
+                                          constants.DEFAULT_DATADOG_RESPONSE_MODE)
+                          == 'streaming')
+        self.api_host = (self.params.get('datadog_api_host')
+                         or constants.DEFAULT_DATADOG_API_HOST).rstrip('/')
+        self.timeout = self.params.get('datadog_timeout',
+                                       constants.DEFAULT_DATADOG_TIMEOUT)
+        # one HTTP session (connection pool) per thread
+        self._local = threading.local()
 
-    def metrics(self, start, end, query):
+    def metrics(self, start, end, query, stats=None):
         """
         Generator function, returns entries in metrics.
 
         :param start:
         :param end:
         :param query:
+        :param stats: optional dictionary, filled in with the query's
+                      'latency' (seconds), 'series' and 'points' counts,
+                      'bytes' (response size) or 'error'
         """
+        # only settled windows are looked up in (and added to) the cache
+        cached = self.cache is not None and self.cache.cacheable(end)
+        if self.streaming and not cached:
+            yield from self.stream_metrics(start, end, query, stats)
+            return
+        started = time.time()
         try:
             self.logger.debug("Datadog query %d - %d: %s", start, end, query)
-            dd_metrics = datadog.api.Metric.query(start=start,
-                                                  end=end,
-                                                  query=query)
+            dd_metrics = self.cache.get(query, start, end) if cached else None
+            outcome = 'cache'
+            if dd_metrics is not None:
+                nbytes = None
+            else:
+                outcome = 'ok'
+                dd_metrics, nbytes = self.scheduler.call(query, self.query_once,
+                                                         start, end, query)
         except Exception as exn:
             self.logger.error("Datadog query failed: %s", exn)
+            self.errors += 1
+            telemetry.DATADOG_REQUESTS.inc(1, 'error')
+            if stats is not None:
+                stats.update(error=True, latency=time.time() - started)
         else:
+            if cached and outcome == 'ok':
+                # the window was fetched: a cache failure must not fail it
+                try:
+                    self.cache.put(query, start, end, dd_metrics)
+                except Exception as exn:
+                    self.logger.warning("Datadog cache write failed: %s", exn)
+            telemetry.DATADOG_REQUESTS.inc(1, outcome)
+            telemetry.DATADOG_FETCH_SECONDS.observe(time.time() - started)
+            if stats is not None:
+                self.query_stats(dd_metrics, time.time() - started, stats,
+                                 nbytes)
             try:
                 for series in dd_metrics['series']:
                     yield series
             except KeyError:
                 self.logger.info("Query result not a series: %s", query)
+
+    def query_once(self, start, end, query):
+        """
+        Run one Datadog query (no scheduling or retries).  Raises as
+        send_query(), and DatadogQueryFailed for errors in the response.
+
+        :return: (decoded response, response size in bytes)
+        """
+        response = self.send_query(start, end, query)
+        try:
+            result = response.json()
+        except ValueError as exn:
+            raise DatadogQueryFailed('Bad response: {}'.format(exn))
+        if isinstance(result, dict) and result.get('errors'):
+            errors = str(result['errors'])
+            if 'rate limit' in errors.lower():
+                raise ratelimit.RateLimited(
+                    errors, ratelimit.retry_after(response.headers))
+            raise DatadogQueryFailed(errors)
+        return result, len(response.content)
+
+    def stream_metrics(self, start, end, query, stats=None):
+        """
+        Generator function, returns entries in metrics as the response
+        body is parsed.  A failure part way through the body ends the
+        generator (after the series already returned) and is counted as
+        a failed query.
+
+        :param stats: as for metrics(); the latency leaves out the time
+                      spent by the caller between series
+        """
+        started = time.time()
+        paused = 0.0
+        response = None
+        try:
+            self.logger.debug("Datadog streamed query %d - %d: %s",
+                              start, end, query)
+            response = self.scheduler.call(query, self.send_query,
+                                           start, end, query, stream=True)
+            parser = series_stream.SeriesParser()
+            for chunk in response.iter_content(STREAM_CHUNK_BYTES):
+                for series in parser.feed(chunk):
+                    resumed = time.time()
+                    yield series
+                    paused += time.time() - resumed
+            for series in parser.flush():
+                resumed = time.time()
+                yield series
+                paused += time.time() - resumed
+            result = parser.close()
+            if isinstance(result, dict) and result.get('errors'):
+                raise DatadogQueryFailed(str(result['errors']))
+        except Exception as exn:
+            self.logger.error("Datadog query failed: %s", exn)
+            self.errors += 1
+            telemetry.DATADOG_REQUESTS.inc(1, 'error')
+            if stats is not None:
+                stats.update(error=True, latency=time.time() - started - paused)
+        else:
+            latency = time.time() - started - paused
+            telemetry.DATADOG_REQUESTS.inc(1, 'ok')
+            telemetry.DATADOG_FETCH_SECONDS.observe(latency)
+            if not isinstance(result, dict) or 'series' not in result:
+                self.logger.info("Query result not a series: %s", query)
+            if stats is not None:
+                stats.update(latency=latency, series=parser.nseries,
+                             points=parser.npoints, bytes=parser.nbytes)
+        finally:
+            if response is not None:
+                response.close()
+
+    def send_query(self, start, end, query, stream=False):
+        """
+        Send one Datadog query (no scheduling or retries).  Raises
+        ratelimit.RateLimited (with the server's retry delay) if the
+        request was rate limited, a transient_errors() error for
+        connection errors, timeouts and server errors and
+        DatadogQueryFailed for other errors.
+
+        :param stream: leave the body unread
+        :return: the requests response
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        response = session.get(
+            self.api_host + '/api/v1/query',
+            params={'from': int(start), 'to': int(end), 'query': query},
+            headers={'DD-API-KEY': self.params['datadog_api_key'],
+                     'DD-APPLICATION-KEY': self.params['datadog_app_key']},
+            timeout=self.timeout, stream=stream)
+        self.scheduler.update(response.headers)
+        if response.status_code < 400:
+            return response
+        try:
+            reason = response.text[:500]
+        finally:
+            response.close()
+        if response.status_code == 429 or 'rate limit' in reason.lower():
+            raise ratelimit.RateLimited(reason,
+                                        ratelimit.retry_after(response.headers))
+        if response.status_code >= 500:
+            raise DatadogServerError('{}: {}'.format(response.status_code,
+                                                     reason))
+        raise DatadogQueryFailed('{}: {}'.format(response.status_code, reason))
+
+    @staticmethod
+    def query_stats(dd_metrics, latency, stats, nbytes=None):
+        """
+        Fill in the statistics for a query response.
+
+        :param dd_metrics: the decoded query response
+        :param latency: query time (seconds)
+        :param stats: dictionary to fill in
+        :param nbytes: response size, estimated from the points if None
+        """
+        series = (dd_metrics.get('series') or []) if isinstance(dd_metrics, dict) else []
+        points = sum(len(entry.get('pointlist') or []) for entry in series)
+        if nbytes is None:
+            nbytes = points * BYTES_PER_POINT
+        stats.update(latency=latency, series=len(series), points=points,
+                     bytes=nbytes)
@@ -0,0 +1,108 @@
+"""
+Foundation info index
+
+Note(s):
+    1. Requires Python 3
+    2. The foundation info file is compiled once, at load, into a dict
+       keyed by foundry name.  Each entry is the (read only) tag set
+       written to Influx with the foundry's points, so looking up a
+       series' foundry is O(1) and nothing is rebuilt per point.
+    3. Foundries not in the file are remembered (negative cache) so they
+       are reported once per run rather than once per series.
+    4. tag_sets() and from_tag_sets() turn the compiled index into plain
+       dicts and back, for the configuration snapshot.
+
+"""
+import threading
+from types import MappingProxyType
+
+import constants
+from commonpy.logger import Logger
+
+
+def foundry_tags(foundry, info):
+    """
+    Build the Influx tag set for a foundry.
+
+    :param foundry: foundry name
+    :param info: the foundry's entry from the foundation info file
+    :return: read only mapping of tag name: value
+    """
+    tags = {key: info[key] for key in constants.FOUNDATION_TAGS}
+    tags['foundry'] = foundry
+    return MappingProxyType(tags)
+
+
+class FoundryIndex(object):
+    """
+    Foundry name to tag set index over the foundation info file.
+    """
+    def __init__(self, foundation_info):
+        """
+        Compile the index.  A missing 'foundations' list raises KeyError;
+        individual malformed entries are logged and left out.
+
+        :param foundation_info: loaded foundation info file
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self._tags = {}
+        self._missing = set()
+        self._lock = threading.Lock()
+        for entry in foundation_info['foundations']:
+            try:
+                foundry = entry['foundry']
+                self._tags[foundry] = foundry_tags(foundry, entry)
+            except KeyError as exn:
+                self.logger.error("Malformed foundation info %s (missing %s)",
+                                  entry, exn)
+
+    @classmethod
+    def from_tag_sets(cls, tag_sets):
+        """
+        Build an index from already compiled tag sets.
+
+        :param tag_sets: dictionary of foundry: tag dictionary, as
+                         returned by tag_sets()
+        """
+        index = cls({'foundations': []})
+        index._tags = {foundry: MappingProxyType(dict(tags))
+                       for foundry, tags in tag_sets.items()}
+        return index
+
+    def tag_sets(self):
+        """
+        Get the compiled tag sets as plain dictionaries.
+
+        :return: dictionary of foundry: tag dictionary
+        """
+        return {foundry: dict(tags) for foundry, tags in self._tags.items()}
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, foundry):
+        return foundry in self._tags
+
+    def lookup(self, foundry):
+        """
+        Get the tag set for a foundry.
+
+        :param foundry: foundry name
+        :return: tag mapping, or None if the foundry is unknown
+        """
+        tags = self._tags.get(foundry)
+        if tags is None and foundry not in self._missing:
+            with self._lock:
+                if foundry not in self._missing:
+                    self._missing.add(foundry)
+                    self.logger.error("Foundry %s not found in foundation info",
+                                      foundry)
+        return tags
+
+    @property
+    def missing(self):
+        """
+        Foundries looked up but not found so far.
+        """
+        return frozenset(self._missing)
@@ -3,19 +3,52 @@ Influx DB exporter
 
 Note(s):
     1. Requires Python 3
+    2. --profile-startup times the startup (module imports, parameters,
+       clients, configuration), prints the report and exits.
+    3. A run plans its queries (see planner.py): identical Datadog
+       queries are fetched once, and with query_batch above 1 distinct
+       ones in multi-query requests.  A query left on its own is run as
+       by the daemon, which runs its queries one by one.
 
 """
+import time
+# Start of the module imports, for --profile-startup
+IMPORTS_STARTED = time.perf_counter()
+
 import argparse
 import json
-import time
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+import checkpoint
+import config_snapshot
 import constants
+import dedup
 import dogger
+import foundry_index
 import influx_help
+import pipeline
+import planner
+import pointlist
+import rollup
+import sinks
+import spool
+import telemetry
+import watermarks
+import windowing
 
-from commonpy.logger import Logger
+from commonpy.logger import HOT_LOOP, Logger
 from commonpy.parameters import SysParams
 
+IMPORTS_DONE = time.perf_counter()
+
+# Per-query outcome, used for the end of run summary
+QueryResult = namedtuple('QueryResult',
+                         ['qnbr', 'metric', 'ok', 'elapsed', 'nseries', 'error'])
+
 
 class Exporter(object):
     """
@@ -26,18 +59,40 @@ class Exporter(object):
         super().__init__()
         self.logger = Logger().logger
         self.params = SysParams().params
-        self.datadog = dogger.Dogger()
-        self.helper = influx_help.InfluxHelper()
+        self.datadog, self.helper = self.make_clients()
+        self.watermarks = watermarks.Watermarks()
+        self.checkpoints = None
+        self.drainer = None
+        self.sinks = []
+        # metric: rollup.Rollup, for the queries with a rollup
+        self.rollups = {}
+        self.dedup_stats = dedup.DedupStats()
+        # where load_config() got the configuration: 'files' or 'snapshot'
+        self.config_source = None
+        # set to stop between windows (daemon shutdown)
+        self.stopping = threading.Event()
+
+    def make_clients(self):
+        """
+        Create the Datadog and Influx clients used by the exporter.
+
+        :return: (datadog client, influx helper)
+        """
+        return dogger.Dogger(), influx_help.InfluxHelper()
 
     def get_foundation_object(self, foundation, foundation_info):
         """
-        Get the list of foundation info from the info file, given
-        the foundation name.
+        Get the foundation info (Influx tags) given the foundation name.
 
         :param foundation: the foundation to find in the file info
-        :param foundation_info: loaded foundation info file
-        :return: foundation info corresponding to requested foundation
+        :param foundation_info: FoundryIndex, or the loaded foundation
+                                info file (linear search)
+        :return: (foundation, info) or (None, {}) if not found
         """
+        if isinstance(foundation_info, foundry_index.FoundryIndex):
+            tags = foundation_info.lookup(foundation)
+            return (foundation, tags) if tags is not None else (None, {})
+
         info = (None, {})
         try:
             info = (foundation,
@@ -50,6 +105,54 @@ class Exporter(object):
                               foundation)
         return info
 
+    def load_foundations(self, filename):
+        """
+        Load the foundation info file and compile it into a FoundryIndex.
+
+        :param filename: name of the foundation info file
+        :return: the FoundryIndex
+        """
+        return foundry_index.FoundryIndex(self.load_json_file(filename))
+
+    def load_config(self):
+        """
+        Load the foundation info and query files, or their snapshot when
+        config_snapshot is set and the files have not changed since it
+        was written.  An exception will be raised if a file load fails.
+
+        :return: (FoundryIndex, queries), or None if the queries file is
+                 malformed
+        """
+        files = (self.params['foundations_file'], self.params['queries_file'])
+        snapshot = None
+        if self.params.get('config_snapshot'):
+            try:
+                key = config_snapshot.source_key(files)
+            except OSError:
+                pass        # reported by the file loads below
+            else:
+                snapshot = config_snapshot.ConfigSnapshot(
+                    self.params['config_snapshot'])
+                loaded = snapshot.load(key)
+                if loaded is not None:
+                    self.logger.debug("Configuration from snapshot %s",
+                                      snapshot.path)
+                    self.config_source = 'snapshot'
+                    tag_sets, queries = loaded
+                    return foundry_index.FoundryIndex.from_tag_sets(tag_sets), queries
+
+        foundation_info = self.load_foundations(files[0])
+        query_dict = self.load_json_file(files[1])
+        try: # extract the query list from the dictionary
+            queries = query_dict['queries']
+        except KeyError as exn:
+            self.logger.error('Error loading queries file. Missing key: %s', exn)
+            return None
+        self.config_source = 'files'
+        if snapshot is not None:
+            snapshot.save(key, foundation_info.tag_sets(), queries)
+        return foundation_info, queries
+
     def load_json_file(self, filename):
         """
         Load the named json file.  If the file is not found and readable,
@@ -70,47 +173,572 @@ class Exporter(object):
         else:
             return payload
 
-    def send_results(self, start_time, metric, query, foundation_info):
+    def send_results(self, start_time, metric, query, foundation_info,
+                     query_rollup=None):
         """
-        Send the datadog metric results to Influx
+        Send the datadog metric results to Influx.  Unless the pipeline is
+        disabled (pipeline_writers of 0) the Influx writes are done by
+        writer threads so that fetching the next Datadog window overlaps
+        with writing the previous one.
 
         :param start_time: earliest results to send
         :param metric: the metric being selected
         :param query: the datadog query to use
         :param foundation_info: the foundation description
+        :param query_rollup: rollup.Rollup to write buckets with, or None
+        :return: number of series sent
         """
-        now = int(time.time())
-        time_range = self.params['datadog_time_range']
+        with self.open_writer(metric) as send:
+            return self.fetch_results(start_time, metric, query,
+                                      foundation_info, send,
+                                      query_rollup=query_rollup)
+
+    @contextmanager
+    def open_writer(self, name):
+        """
+        Context manager: the send function for a fetch, queueing on
+        writer threads unless the pipeline is disabled.
+
+        :param name: name of the writer threads
+        """
+        writers = int(self.params.get('pipeline_writers',
+                                      constants.DEFAULT_PIPELINE_WRITERS))
+        if writers < 1:
+            yield self.fan_out(self.helper.send_points)
+            return
+
+        depth = int(self.params.get('pipeline_depth',
+                                    constants.DEFAULT_PIPELINE_DEPTH))
+        with pipeline.WritePipeline(self.helper.send_points, depth, writers,
+                                    name='writer-{}'.format(name)) as stage:
+            yield self.fan_out(stage.put)
+        if stage.errors:
+            raise influx_help.InfluxWritesLost(
+                "{} series failed to write".format(stage.errors))
+
+    def fan_out(self, send):
+        """
+        Wrap the primary sink's send function so that every series is
+        also queued on the additional sinks.
+
+        :param send: send function (InfluxHelper.send_points arguments)
+        :return: send function
+        """
+        if not self.sinks:
+            return send
+
+        def send_all(*args):
+            for sink in self.sinks:
+                sink.put(*args)
+            return send(*args)
+        return send_all
+
+    def fetch_results(self, start_time, metric, query, foundation_info, send,
+                      end_time=None, query_rollup=None):
+        """
+        Fetch the datadog metric results and hand each series to 'send'.
+
+        :param start_time: earliest results to send
+        :param metric: the metric being selected
+        :param query: the datadog query to use
+        :param foundation_info: the foundation description
+        :param send: called as send(metric, foundation, points, after)
+                     per series
+        :param end_time: stop here rather than at the current time
+        :param query_rollup: rollup.Rollup to send buckets with, or None
+        :return: number of series sent
+        """
+        group = planner.QueryGroup()
+        group.add(query, planner.Target(0, metric, query_rollup))
+        return self.fetch_group(start_time, group, foundation_info, send,
+                                end_time)[0]
 
-        # Datadog returns 150 datapoints per call.  Set the end timeframe
-        # <time range> hours in the future or now, whichever is sooner
-        end = min(start_time + time_range, now)
+    def fetch_group(self, start_time, group, foundation_info, send,
+                    end_time=None):
+        """
+        Fetch the results of a planner.QueryGroup, one (multi-)query
+        Datadog request per window, and hand each series to 'send' for
+        every entry it is for.
+
+        :param start_time: earliest results to send
+        :param group: planner.QueryGroup
+        :param foundation_info: the foundation description
+        :param send: called as send(metric, foundation, points, after)
+                     per series
+        :param end_time: stop here rather than at the current time
+        :return: dictionary of entry number: number of series sent
+        :raises dogger.DatadogQueryFailed: a window failed (after its
+                retries): nothing is fetched past it, so no watermark or
+                checkpoint moves past the gap
+        """
+        now = int(time.time()) if end_time is None else int(end_time)
+        query = group.query
+        window = self.make_window(query)
+        deduper = dedup.Deduplicator(self.watermarks, self.dedup_stats)
+        sends = {}
+        stages = []
+        for target in group.all_targets():
+            sends[target.qnbr] = send
+            if target.rollup is not None:
+                # fetch whole buckets, send closed ones
+                start_time = min(start_time, target.rollup.align(start_time))
+                stages.append(target.rollup.stage(send))
+                sends[target.qnbr] = stages[-1].put
+        nseries = dict.fromkeys(sends, 0)
 
-        #Loop through datadog results until we reach current time
-        for start in range(start_time, now, time_range):
+        #Loop through datadog results until we reach current time, one
+        #window after the other
+        start = start_time
+        failed = None
+        while start < now and not self.stopping.is_set():
+            end = min(start + window.size, now)
             self.logger.info("Start %d : end %d (diff: %d)",
                              start, end, end-start_time)
+            stats = {}
             # Execute the datadog query, and for every item in the series,
             # for each point in the item, write the point to influx.
-            for series in self.datadog.metrics(start, end, query):
-                end = end + time_range
-                foundry = series['scope'].split(":")[1]
-                points = series['pointlist']
-                self.logger.debug('Process %d points for foundry %s',
-                                  len(points), foundry)
-                try:
-                    fnd_info = self.get_foundation_object(foundry, foundation_info)
-                except IndexError:
-                    self.logger.error("Error retrieving foundation " + \
-                                      "info %s.  Ignore results.",
-                                      foundry)
-                else:
-                    # send all points from the current series to influx
-                    self.helper.send_points(metric, fnd_info, points)
+            for series in self.query_window(start, end, query, stats):
+                targets = group.targets_of(series)
+                if not targets:
+                    self.logger.warning("Series %s matches no query, ignored",
+                                        series.get('expression'))
+                    continue
+                for qnbr in self.send_series(series, targets, sends,
+                                             foundation_info, deduper):
+                    nseries[qnbr] += 1
+            if window.adaptive:
+                window.observe(end - start, stats)
+                if stats.get('error') and window.size < end - start:
+                    # retry the failed window in smaller pieces
+                    continue
+            if stats.get('error'):
+                failed = (start, end)
+                break
+            start = end
+        for stage in stages:
+            stage.flush(start * 1000)
+        self.save_window(query, window)
+        if failed is not None:
+            raise dogger.DatadogQueryFailed(
+                "Window {} - {} failed".format(*failed))
+        return nseries
+
+    def send_series(self, series, targets, sends, foundation_info, deduper):
+        """
+        Hand a fetched series to the send function of each entry it is
+        for, past the entry's watermark (and past the previous window).
+
+        :param series: series from the Datadog response
+        :param targets: list of planner.Target
+        :param sends: dictionary of entry number: send function
+        :param foundation_info: the foundation description
+        :param deduper: dedup.Deduplicator of the fetch
+        :return: numbers of the entries the series was sent for
+        """
+        foundry = series['scope'].split(":")[1]
+        points = series['pointlist']
+        self.logger.debug('Process %d points for foundry %s',
+                          len(points), foundry, extra=HOT_LOOP)
+        for target in targets:
+            telemetry.POINTS_FETCHED.inc(len(points), target.metric)
+        try:
+            fnd_info = self.get_foundation_object(foundry, foundation_info)
+        except IndexError:
+            self.logger.error("Error retrieving foundation " + \
+                              "info %s.  Ignore results.",
+                              foundry)
+            return []
+        if fnd_info[0] is None:
+            for target in targets:
+                telemetry.POINTS_DROPPED.inc(len(points), target.metric,
+                                             'unknown_foundry')
+            return []
+        # keep the points compactly from here on
+        fetched = len(points)
+        points = pointlist.Series.from_points(points, fnd_info[1])
+        sent = []
+        for target in targets:
+            metric = target.metric
+            if len(points) < fetched:
+                telemetry.POINTS_DROPPED.inc(fetched - len(points), metric,
+                                             'filtered')
+            kept = deduper.trim(metric, fnd_info[0], points)
+            if len(kept) < len(points):
+                telemetry.POINTS_DROPPED.inc(len(points) - len(kept),
+                                             metric, 'duplicate')
+            if not kept:
+                continue
+            sends[target.qnbr](metric, fnd_info, kept,
+                               self.watermarks.get(metric, fnd_info[0]))
+            sent.append(target.qnbr)
+        return sent
+
+    def query_window(self, start, end, query, stats):
+        """
+        Run the Datadog query for one window.
+
+        :param stats: dictionary for the query statistics ('error' is set
+                      if the query failed)
+        :return: generator of series
+        """
+        return self.datadog.metrics(start, end, query, stats=stats)
+
+    def make_window(self, query):
+        """
+        Get the window sizer for a Datadog query: fixed at
+        datadog_time_range, or adaptive (window_mode 'adaptive') starting
+        from the size remembered for the query.
+
+        :param query: the Datadog query
+        :return: windowing.FixedWindow or windowing.AdaptiveWindow
+        """
+        time_range = self.params['datadog_time_range']
+        if self.params.get('window_mode', constants.DEFAULT_WINDOW_MODE) != 'adaptive':
+            return windowing.FixedWindow(time_range)
+        size = None
+        if self.checkpoints is not None:
+            size = self.checkpoints.get_window(query)
+        return windowing.AdaptiveWindow(
+            size or time_range,
+            self.params.get('window_min',
+                            constants.DEFAULT_WINDOW_MIN * constants.SEC_PER_HOUR),
+            self.params.get('window_max',
+                            constants.DEFAULT_WINDOW_MAX * constants.SEC_PER_HOUR),
+            self.params.get('window_target_points',
+                            constants.DEFAULT_WINDOW_TARGET_POINTS),
+            self.params.get('window_max_bytes',
+                            constants.DEFAULT_WINDOW_MAX_BYTES),
+            self.params.get('window_max_latency',
+                            constants.DEFAULT_WINDOW_MAX_LATENCY))
+
+    def save_window(self, query, window):
+        """
+        Remember an adaptive window's size for the next run.
+        """
+        if window.adaptive and self.checkpoints is not None:
+            self.checkpoints.record_window(query, window.size)
+
+    def open_checkpoints(self):
+        """
+        Open the checkpoint store, if one is configured.
+
+        :return: checkpoint.CheckpointStore or None
+        """
+        path = self.params.get('checkpoint_file')
+        if not path:
+            return None
+        self.logger.debug("Checkpoint store: %s", path)
+        return checkpoint.CheckpointStore(path)
+
+    def open_sinks(self):
+        """
+        Start the additional Influx sinks, if any are configured.
+
+        :return: list of sinks.Sink
+        """
+        return [sinks.Sink(target, self.params)
+                for target in self.params.get('influx_sinks') or []]
+
+    def open_spool(self):
+        """
+        Open the Influx write-ahead spool and start its drainer, if a spool
+        directory is configured.
+
+        :return: spool.Spool or None
+        """
+        path = self.params.get('spool_dir')
+        if not path:
+            return None
+        self.logger.debug("Spool directory: %s", path)
+        influx_spool = spool.Spool(path, self.params.get(
+            'spool_segment_bytes', constants.DEFAULT_SPOOL_SEGMENT_BYTES))
+        self.drainer = spool.SpoolDrainer(
+            influx_spool, self.helper.write_lines,
+            self.params.get('spool_drain_interval',
+                            constants.DEFAULT_SPOOL_DRAIN_INTERVAL))
+        return influx_spool
+
+    def load_watermarks(self, metrics):
+        """
+        Get the per (metric, foundry) watermarks for all metrics: from the
+        checkpoint store where it has them, otherwise with one grouped
+        Influx query.
+
+        :param metrics: list of metric (measurement) names
+        :return: Watermarks (not loaded, if the Influx query failed)
+        """
+        marks = {}
+        if self.checkpoints is not None:
+            marks = self.checkpoints.load(metrics)
+            stored = set(metric for metric, _ in marks)
+            metrics = [metric for metric in metrics if metric not in stored]
+            self.logger.debug("Checkpoints for %d metrics, %d to query",
+                              len(stored), len(metrics))
+        if not metrics:
+            return watermarks.Watermarks(marks, loaded=True)
+        queried = {}
+        try:
+            for field, measurements in rollup.watermark_measurements(
+                    metrics, self.rollups):
+                queried.update(self.helper.get_watermarks(
+                    measurements, field).as_dict())
+        except influx_help.InfluxStartQueryFailed:
+            self.logger.warning("Watermark query failed, falling back to "
+                                "per metric start time queries")
+            return watermarks.Watermarks(marks)
+        queried = rollup.watermark_marks(queried, self.rollups)
+        queried.update(marks)
+        return watermarks.Watermarks(queried, loaded=True)
+
+    def get_start_time(self, metric):
+        """
+        Get the time to start exporting a metric from.
+
+        :param metric: metric (measurement) name
+        :return: start time (epoch seconds)
+        """
+        series_start = self.watermarks.start_time(
+            metric, self.params.get('watermark_max_lag',
+                                    constants.DEFAULT_WATERMARK_MAX_LAG
+                                    * constants.SEC_PER_HOUR))
+        if series_start is not None:
+            return series_start
+        if self.watermarks.loaded:
+            # the watermark query worked: nothing exported for this metric yet
+            return self.params['START_TIMESTAMP']
+
+        # Get last datapoint from Influx and set to start time, otherwise start
+        # from (datadog) beginning
+        measurement, field = metric, None
+        if metric in self.rollups:
+            # the start of the last bucket, fetched again whole
+            measurement = self.rollups[metric].measurement
+            field = self.rollups[metric].aggregates[0]
+        try:
+            series_start = self.helper.get_metric_start_time(measurement,
+                                                             field)
+        except influx_help.InfluxStartQueryFailed:
+            series_start = self.params['START_TIMESTAMP']
+            self.logger.debug("Start time query failed, setting start time %d",
+                              series_start)
+        return series_start
+
+    def run_query(self, qnbr, query, foundation_info, start_time=None):
+        """
+        Export a single metric/query pair: find where the metric left off
+        in Influx and send everything Datadog has from there on.
+
+        :param qnbr: query number (1 based), for logging
+        :param query: query dictionary ('metric' and 'query' keys)
+        :param foundation_info: FoundryIndex of the foundation info file
+        :param start_time: start here rather than at the metric's watermark
+        :return: number of series sent
+        """
+        self.logger.info("[%d] Starting work on query pair %s", qnbr, query)
+        metric = query['metric']
+        dd_query = query['query']
+        query_rollup = rollup.Rollup.from_query(query)
+
+        series_start = (start_time if start_time is not None
+                        else self.get_start_time(metric))
+        return self.send_results(series_start, metric, dd_query, foundation_info,
+                                 query_rollup)
+
+    def _timed_query(self, qnbr, query, foundation_info, start_time=None):
+        """
+        Run one query and catch anything it raises so that a failing query
+        cannot take the others down with it.
+
+        :return: QueryResult summary for the query
+        """
+        metric = query.get('metric') if isinstance(query, dict) else None
+        started = time.time()
+        self.helper.reset_failed(metric)
+        try:
+            nseries = self.run_query(qnbr, query, foundation_info, start_time)
+        except KeyError as exn:
+            self.logger.error('Error: query %d missing required key: %s',
+                              qnbr, exn)
+            return QueryResult(qnbr, metric, False, time.time() - started,
+                               0, 'missing key {}'.format(exn))
+        except Exception as exn:
+            self.logger.error('Error: query %d (%s) failed: %s',
+                              qnbr, metric, exn)
+            return QueryResult(qnbr, metric, False, time.time() - started,
+                               0, str(exn))
+        return self.query_result(qnbr, metric, time.time() - started, nseries)
+
+    def query_result(self, qnbr, metric, elapsed, nseries):
+        """
+        Summarize a query that ran through: it still failed if any of
+        its points were lost (neither written nor spooled), so that its
+        next pass fetches them again.
+
+        :return: QueryResult
+        """
+        lost = self.helper.lost(metric)
+        if lost:
+            self.logger.error('Error: query %d (%s) lost points for %s',
+                              qnbr, metric, ', '.join(lost))
+            return QueryResult(qnbr, metric, False, elapsed, nseries or 0,
+                               'lost points for {}'.format(', '.join(lost)))
+        return QueryResult(qnbr, metric, True, elapsed, nseries or 0, None)
+
+    def plan_queries(self, queries):
+        """
+        Group the queries for run_groups() (see planner.py).  Entries
+        that cannot be planned (bad keys or rollup) fail right away.
+
+        :param queries: query dictionaries
+        :return: (list of planner.QueryGroup, list of QueryResult)
+        """
+        entries = []
+        failed = []
+        for qnbr, query in enumerate(queries, 1):
+            metric = query.get('metric') if isinstance(query, dict) else None
+            try:
+                target = planner.Target(qnbr, query['metric'],
+                                        rollup.Rollup.from_query(query))
+                start = self.get_start_time(target.metric)
+                if target.rollup is not None:
+                    start = target.rollup.align(start)
+                entries.append((query['query'], target, start))
+            except (KeyError, TypeError, ValueError) as exn:
+                self.logger.error('Error: query %d (%s) cannot be run: %s',
+                                  qnbr, metric, exn)
+                failed.append(QueryResult(qnbr, metric, False, 0.0, 0,
+                                          str(exn)))
+        groups = planner.plan(
+            entries,
+            int(self.params.get('query_batch', constants.DEFAULT_QUERY_BATCH)),
+            self.params['datadog_time_range'])
+        self.logger.info("Planned %d queries as %d Datadog fetches",
+                         len(entries), len(groups))
+        return groups, failed
+
+    def _timed_group(self, group, foundation_info):
+        """
+        Run one planned group, catching anything it raises.
+
+        :return: QueryResult per entry of the group
+        """
+        targets = group.all_targets()
+        self.logger.info("Starting work on queries %s: %s",
+                         ', '.join(str(target.qnbr) for target in targets),
+                         group.query)
+        started = time.time()
+        for target in targets:
+            self.helper.reset_failed(target.metric)
+        try:
+            with self.open_writer(targets[0].metric) as send:
+                nseries = self.fetch_group(group.start, group,
+                                           foundation_info, send)
+        except Exception as exn:
+            self.logger.error('Error: queries %s failed: %s',
+                              ', '.join(str(target.qnbr) for target in targets),
+                              exn)
+            return [QueryResult(target.qnbr, target.metric, False,
+                                time.time() - started, 0, str(exn))
+                    for target in targets]
+        return [self.query_result(target.qnbr, target.metric,
+                                  time.time() - started, nseries[target.qnbr])
+                for target in targets]
+
+    def run_groups(self, queries, foundation_info, workers):
+        """
+        Run the queries as planned groups.
+
+        :return: list of QueryResult
+        """
+        groups, results = self.plan_queries(queries)
+
+        def run_group(group):
+            targets = group.all_targets()
+            if len(targets) > 1:
+                return self._timed_group(group, foundation_info)
+            # a group of one: run as a plain query
+            return [self._timed_query(targets[0].qnbr,
+                                      queries[targets[0].qnbr - 1],
+                                      foundation_info, group.start)]
+
+        if workers > 1 and len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_group, group) for group in groups]
+                for future in futures:
+                    results.extend(future.result())
+        else:
+            for group in groups:
+                results.extend(run_group(group))
+        return results
+
+    def log_summary(self, results):
+        """
+        Log a one line summary per query, followed by the totals.
+
+        :param results: list of QueryResult
+        """
+        for result in sorted(results, key=lambda res: res.qnbr):
+            self.logger.info("[%d] %s: %s in %.1fs (%d series)%s",
+                             result.qnbr, result.metric,
+                             'ok' if result.ok else 'FAILED',
+                             result.elapsed, result.nseries,
+                             ': ' + result.error if result.error else '')
+        failed = len([res for res in results if not res.ok])
+        self.logger.info("Completed %d queries, %d failed",
+                         len(results), failed)
+        stats = self.dedup_stats
+        self.logger.info("Dedup: %d points kept, %d trimmed at or below "
+                         "watermarks, %d trimmed as window overlap",
+                         stats.kept, stats.watermark, stats.overlap)
+        cache = getattr(self.datadog, 'cache', None)
+        if cache is not None:
+            self.logger.info("Datadog cache: %s hits, %s misses, %s evictions",
+                             cache.hits, cache.misses, cache.evictions)
+
+    def prepare(self):
+        """
+        Load the foundation and query files, open the checkpoint store and
+        discover the watermarks.  An exception will be raised if a file
+        load fails.
+
+        :return: (foundation_info, queries), or None if the queries file
+                 is malformed
+        """
+        config = self.load_config()
+        if config is None:
+            return None
+        foundation_info, queries = config
+
+        self.checkpoints = self.open_checkpoints()
+        self.helper.checkpoints = self.checkpoints
+        self.helper.spool = self.open_spool()
+        self.sinks = self.open_sinks()
+        self.rollups = rollup.parse_rollups(queries)
+        self.watermarks = self.load_watermarks(
+            [query['metric'] for query in queries
+             if isinstance(query, dict) and 'metric' in query])
+        # written points move the watermarks forward for later passes
+        self.helper.watermarks = self.watermarks
+        return foundation_info, queries
+
+    def close(self):
+        """
+        Release what prepare() opened.
+        """
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+        if self.drainer is not None:
+            self.drainer.close()
+            self.helper.spool.close()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
 
     def run(self):
         """
-        Exporter main run loop.
+        Exporter main run loop.  Queries are independent of each other so
+        they are run on a pool of worker threads (the work is bound by
+        Datadog and Influx latency, not CPU).
 
         :return: status code (1 fail, 0 success)
         """
@@ -118,43 +746,52 @@ class Exporter(object):
         # Load info about foundations and metric queries from files
         # An exception will be raised if the load fails.  Not caught here,
         # it will raise to the caller.
-        foundation_info = self.load_json_file(self.params['foundations_file'])
-        query_dict = self.load_json_file(self.params['queries_file'])
-
-        try: # extract the query list from the dictionary
-            queries = query_dict['queries']
-        except KeyError as exn:
-            self.logger.error('Error loading queries file. Missing key: %s', exn)
+        prepared = self.prepare()
+        if prepared is None:
             return 1
+        foundation_info, queries = prepared
 
-        #Loop through metric/query pairs
-        for qnbr, query in enumerate(queries, 1):
-            self.logger.info("[%d] Starting work on query pair %s", qnbr, query)
-            try:
-                metric = query['metric']
-                query = query['query']
-            except KeyError as exn:
-                self.logger.error('Error: query %d missing required key: %s',
-                                  qnbr, exn)
-                return 1
-
-            # Get last datapoint from Influx and set to start time, otherwise start
-            # from (datadog) beginning
-            try:
-                series_start = self.helper.get_metric_start_time(metric)
-            except influx_help.InfluxStartQueryFailed:
-                series_start = self.params['START_TIMESTAMP']
-                self.logger.debug("Start time query failed, setting start time %d",
-                                  series_start)
+        workers = int(self.params.get('query_workers',
+                                      constants.DEFAULT_QUERY_WORKERS))
+        results = self.run_groups(queries, foundation_info, workers)
+
+        self.log_summary(results)
+        self.close()
+        return 0 if all(res.ok for res in results) else 1
+
+
+def profile_startup(phases):
+    """
+    Time the rest of the startup (clients, configuration) and print the
+    --profile-startup report.
+
+    :param phases: list of (phase, seconds) timed so far
+    :return: status code
+    """
+    modules = len(sys.modules)
+    started = time.perf_counter()
+    exporter = Exporter()
+    phases.append(('clients (requests, influxdb imports)',
+                   time.perf_counter() - started))
+    started = time.perf_counter()
+    config = exporter.load_config()
+    phases.append(('configuration ({})'.format(exporter.config_source),
+                   time.perf_counter() - started))
 
-            self.send_results(series_start, metric, query, foundation_info)
-            return 0
+    total = sum(seconds for _, seconds in phases)
+    print("Startup profile ({} modules loaded, {} by the clients):".format(
+        len(sys.modules), len(sys.modules) - modules))
+    for phase, seconds in phases:
+        print("  {:<40} {:8.1f} ms".format(phase, seconds * 1000))
+    print("  {:<40} {:8.1f} ms".format('total', total * 1000))
+    return 0 if config is not None else 1
 
 
 if __name__ == "__main__":
     """
     Parse command line arguments and then start the main
     """
+    params_started = time.perf_counter()
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--foundations-file",
                         help="The JSON foundations file")
@@ -164,6 +801,14 @@ if __name__ == "__main__":
                         help="Influx DB request timeout")
     parser.add_argument("-p", "--influx-port",
                         help="Influx DB port number")
+    parser.add_argument("-b", "--influx-batch-size", type=int,
+                        help="Points per Influx write (initial)")
+    parser.add_argument("--influx-sinks",
+                        help="Additional Influx targets (JSON list or file)")
+    parser.add_argument("--influx-batch-max", type=int,
+                        help="Largest adaptive Influx write (points)")
+    parser.add_argument("--influx-precision", choices=['n', 'u', 'ms', 's'],
+                        help="Influx write timestamp precision")
     parser.add_argument("-q", "--queries-file",
                         help="name of the queries file")
     parser.add_argument("-t", "--time-range",
@@ -176,6 +821,61 @@ if __name__ == "__main__":
                         help="Influx DB host name")
     parser.add_argument("-a", "--datadog-api-key")
     parser.add_argument("-k", "--datadog-app-key")
+    parser.add_argument("--datadog-cache-dir",
+                        help="Datadog response cache directory ('' for none)")
+    parser.add_argument("--datadog-response-mode",
+                        choices=['buffered', 'streaming'],
+                        help="Read Datadog responses whole or series by series")
+    parser.add_argument("--datadog-rate-limit", type=int,
+                        help="Datadog requests allowed per rate period")
+    parser.add_argument("-n", "--query-workers", type=int,
+                        help="Number of queries to run concurrently")
+    parser.add_argument("--query-batch", type=int,
+                        help="Distinct Datadog queries per multi-query "
+                             "request (1: identical queries only share "
+                             "their fetch)")
+    parser.add_argument("--pipeline-writers", type=int,
+                        help="Influx writer threads per query (0: no pipeline)")
+    parser.add_argument("--pipeline-depth", type=int,
+                        help="Maximum series queued between fetch and write")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Use the asyncio export engine")
+    parser.add_argument("--async-concurrency", type=int,
+                        help="Maximum concurrent requests (asyncio engine)")
+    parser.add_argument("--datadog-api-host",
+                        help="Datadog API URL")
+    parser.add_argument("-c", "--checkpoint-file",
+                        help="Checkpoint database ('' to disable)")
+    parser.add_argument("--config-snapshot",
+                        help="Parsed configuration snapshot ('' to disable)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report the startup time and exit")
+    parser.add_argument("--watermark-max-lag", type=float,
+                        help="Foundries further behind a metric's newest "
+                             "watermark do not hold its start back "
+                             "(hours, 0: no limit)")
+    parser.add_argument("--window-mode", choices=['fixed', 'adaptive'],
+                        help="Datadog window sizing")
+    parser.add_argument("--window-min", type=float,
+                        help="Smallest adaptive window (hours)")
+    parser.add_argument("--window-max", type=float,
+                        help="Largest adaptive window (hours)")
+    parser.add_argument("-s", "--spool-dir",
+                        help="Influx write-ahead spool directory "
+                             "('' to disable)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port (0: off)")
+    parser.add_argument("-d", "--daemon", action="store_true",
+                        help="Keep running, polling each query on an interval")
+    parser.add_argument("--poll-interval", type=float,
+                        help="Daemon poll interval (seconds)")
+    parser.add_argument("--backfill", nargs=2, metavar=('FROM', 'TO'),
+                        help="Backfill a time range (epoch seconds or "
+                             "YYYY-MM-DD[THH:MM[:SS]] UTC) and exit")
+    parser.add_argument("--backfill-workers", type=int,
+                        help="Backfill worker processes")
+    parser.add_argument("--backfill-chunk", type=float,
+                        help="Backfill chunk length (hours)")
     args = parser.parse_args()
 
     # set parameters from command line or environment
@@ -192,8 +892,78 @@ if __name__ == "__main__":
     params['influx_user'] = args.influx_user or params.pop('INFLUX_USER')
     params['influx_password'] = args.influx_password or params.pop('INFLUX_PASSWORD')
     params['influx_timeout'] = args.influx_timeout or params.pop('INFLUX_TIMEOUT')
+    params['influx_batch_size'] = int(args.influx_batch_size
+                                      or params.pop('INFLUX_BATCH_SIZE'))
+    params['influx_batch_min'] = int(params.pop('INFLUX_BATCH_MIN'))
+    params['influx_batch_max'] = int(args.influx_batch_max
+                                     or params.pop('INFLUX_BATCH_MAX'))
+    params['influx_write_latency'] = float(params.pop('INFLUX_WRITE_LATENCY'))
+    params['influx_max_retries'] = int(params.pop('INFLUX_MAX_RETRIES'))
+    params['influx_backoff'] = float(params.pop('INFLUX_BACKOFF'))
+    params['influx_sinks'] = sinks.parse_sinks(
+        args.influx_sinks if args.influx_sinks is not None
+        else params.pop('INFLUX_SINKS'))
+    params['influx_sink_depth'] = int(params.pop('INFLUX_SINK_DEPTH'))
+    params['influx_sink_overflow'] = params.pop('INFLUX_SINK_OVERFLOW')
+    params['influx_precision'] = args.influx_precision or params.pop('INFLUX_PRECISION')
     params['datadog_api_key'] = args.datadog_api_key or params.pop('DATADOG_API_KEY')
     params['datadog_app_key'] = args.datadog_app_key or params.pop('DATADOG_APP_KEY')
+    params['datadog_cache_dir'] = (args.datadog_cache_dir
+                                   if args.datadog_cache_dir is not None
+                                   else params.pop('DATADOG_CACHE_DIR'))
+    params['datadog_cache_max_bytes'] = int(params.pop('DATADOG_CACHE_MAX_BYTES'))
+    params['datadog_cache_immutable_after'] = float(
+        params.pop('DATADOG_CACHE_IMMUTABLE_AFTER'))
+    params['datadog_rate_limit'] = int(args.datadog_rate_limit
+                                       or params.pop('DATADOG_RATE_LIMIT'))
+    params['datadog_rate_period'] = float(params.pop('DATADOG_RATE_PERIOD'))
+    params['datadog_rate_burst'] = int(params.pop('DATADOG_RATE_BURST'))
+    params['datadog_max_retries'] = int(params.pop('DATADOG_MAX_RETRIES'))
+    params['datadog_response_mode'] = (args.datadog_response_mode
+                                       or params.pop('DATADOG_RESPONSE_MODE'))
+    params['datadog_timeout'] = float(params.pop('DATADOG_TIMEOUT'))
+    params['query_workers'] = int(args.query_workers or params.pop('QUERY_WORKERS'))
+    params['query_batch'] = int(args.query_batch or params.pop('QUERY_BATCH'))
+    params['pipeline_writers'] = int(args.pipeline_writers
+                                     if args.pipeline_writers is not None
+                                     else params.pop('PIPELINE_WRITERS'))
+    params['pipeline_depth'] = int(args.pipeline_depth or params.pop('PIPELINE_DEPTH'))
+    params['async_concurrency'] = int(args.async_concurrency
+                                      or params.pop('ASYNC_CONCURRENCY'))
+    params['datadog_api_host'] = args.datadog_api_host or params.pop('DATADOG_API_HOST')
+    params['checkpoint_file'] = (args.checkpoint_file
+                                 if args.checkpoint_file is not None
+                                 else params.pop('CHECKPOINT_FILE'))
+    params['config_snapshot'] = (args.config_snapshot
+                                 if args.config_snapshot is not None
+                                 else params.pop('CONFIG_SNAPSHOT'))
+    params['watermark_max_lag'] = int(float(args.watermark_max_lag
+                                            if args.watermark_max_lag is not None
+                                            else params.pop('WATERMARK_MAX_LAG'))
+                                      * constants.SEC_PER_HOUR)
+    params['window_mode'] = args.window_mode or params.pop('WINDOW_MODE')
+    params['window_min'] = int(float(args.window_min or params.pop('WINDOW_MIN'))
+                               * constants.SEC_PER_HOUR)
+    params['window_max'] = int(float(args.window_max or params.pop('WINDOW_MAX'))
+                               * constants.SEC_PER_HOUR)
+    params['window_target_points'] = int(params.pop('WINDOW_TARGET_POINTS'))
+    params['window_max_bytes'] = int(params.pop('WINDOW_MAX_BYTES'))
+    params['window_max_latency'] = float(params.pop('WINDOW_MAX_LATENCY'))
+    params['spool_dir'] = (args.spool_dir if args.spool_dir is not None
+                           else params.pop('SPOOL_DIR'))
+    params['spool_segment_bytes'] = int(params.pop('SPOOL_SEGMENT_BYTES'))
+    params['spool_drain_interval'] = float(params.pop('SPOOL_DRAIN_INTERVAL'))
+    params['metrics_port'] = int(args.metrics_port
+                                 if args.metrics_port is not None
+                                 else params.pop('METRICS_PORT'))
+    params['poll_interval'] = float(args.poll_interval or params.pop('POLL_INTERVAL'))
+    params['poll_jitter'] = float(params.pop('POLL_JITTER'))
+    params['poll_lookback'] = int(params.pop('POLL_LOOKBACK'))
+    params['backfill_workers'] = int(args.backfill_workers
+                                     or params.pop('BACKFILL_WORKERS'))
+    params['backfill_chunk'] = int(float(args.backfill_chunk
+                                         or params.pop('BACKFILL_CHUNK'))
+                                   * constants.SEC_PER_HOUR)
 
     required_env = set(['foundations_file', 'datadog_time_range', 'queries_file',
                         'influx_database', 'influx_host', 'influx_port',
@@ -205,4 +975,20 @@ if __name__ == "__main__":
         Logger().logger.error(message)
         raise Exception(message)
 
-    Exporter().run()
+    if args.profile_startup:
+        exit(profile_startup([('module imports', IMPORTS_DONE - IMPORTS_STARTED),
+                              ('parameters',
+                               time.perf_counter() - params_started)]))
+    if params['metrics_port']:
+        telemetry.serve(params['metrics_port'])
+    if args.backfill:
+        import backfill
+        exit(backfill.Backfill(*[backfill.parse_time(arg)
+                                 for arg in args.backfill]).run())
+    if args.daemon:
+        import daemon
+        exit(daemon.Daemon().serve())
+    if args.use_async:
+        import async_engine
+        exit(async_engine.AsyncExporter().run())
+    exit(Exporter().run())
@@ -3,32 +3,143 @@ Influx DB helper class
 
 Note(s):
     1. Requires Python 3
-    2. The SeriesHelper is an influxdb.SeriesHelper with Meta subclass
+    2. Points are converted to columns (see pointlist.py, vectorized when
+       NumPy is installed), encoded straight to line protocol (see
+       line_protocol.py) and written with
+       InfluxDBClient.write_points(protocol='line').
        Refer to Influx DB documentation
          See http://influxdb-python.readthedocs.io/en/latest/api-documentation.html
-         Meta class stores time series helper configuration.
+    3. Writes are retried with exponential backoff on timeouts, connection
+       errors, 5xx and 429 responses.  A batch rejected for its content
+       (400, 413) is split in halves until the bad points are isolated
+       and dropped.
+    4. The batch size adapts (AdaptiveBatchSize) to aim at
+       influx_write_latency seconds per write, shrinking on errors,
+       within [influx_batch_min, influx_batch_max].
+    5. One InfluxHelper per Influx sink (see sinks.py).  The primary
+       sink's helper (no name) counts into the global points metrics and
+       the per metric lag, every helper into the per sink ones.
+    6. The influxdb and requests packages are imported when an
+       InfluxHelper is first created (or a write error is classified)
+       rather than with this module.
+    7. send_points() also takes rollup.Buckets (see rollup.py), written
+       as one multi-field line per bucket to the rollup's measurement
+       and retention policy, committed up to the end of the bucket.
+    8. spool_points() encodes a series straight into the spool, for a
+       sink too far behind to queue it (see sinks.py).
+    9. Once a batch of a (metric, foundry) series fails to write (and is
+       not spooled) the series is not committed again for the rest of
+       the pass over its metric, so no later window (or out of order
+       pipeline write) moves its checkpoint or watermark past the lost
+       points: the next pass (or run) fetches them again.  Each pass
+       starts with reset_failed(), and fails if lost() has any foundry
+       of its metric at the end.
 
 """
-import influxdb
+import random
+import threading
+import time
 
-from commonpy.logger import Logger
+import constants
+import foundry_index
+import line_protocol
+import pointlist
+import rollup
+import telemetry
+import watermarks
+from commonpy.logger import HOT_LOOP, Logger
 from commonpy.parameters import SysParams
 
 
+# Sink name of the primary (unnamed) helper, in the per sink metrics
+PRIMARY_SINK = 'primary'
+
+
 class InfluxStartQueryFailed(Exception):
     """ The start-time query failed """
 
 
+class InfluxWritesLost(Exception):
+    """ Points were neither written nor spooled """
+
+
+def is_transient(exn):
+    """
+    Is a write error worth retrying (timeout, connection, 5xx, 429)?
+    """
+    from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+    import requests
+    if isinstance(exn, (InfluxDBServerError, requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout)):
+        return True
+    return isinstance(exn, InfluxDBClientError) and exn.code == 429
+
+
+def is_rejected(exn):
+    """
+    Was a write rejected for its content (bad points, too large)?
+    """
+    from influxdb.exceptions import InfluxDBClientError
+    return isinstance(exn, InfluxDBClientError) and exn.code in (400, 413)
+
+
+class AdaptiveBatchSize(object):
+    """
+    Write batch size adapted to the observed write latency and errors.
+    """
+    def __init__(self, size, minimum, maximum, target_latency):
+        """
+        :param size: initial batch size (lines)
+        :param minimum: smallest batch (lines)
+        :param maximum: largest batch (lines)
+        :param target_latency: write time to aim for (seconds)
+        """
+        super().__init__()
+        size = max(1, int(size))
+        self.minimum = max(1, min(int(minimum), size))
+        self.maximum = max(int(maximum), size)
+        self.target_latency = float(target_latency)
+        self.size = size
+        self._lock = threading.Lock()
+
+    def _clamp(self, size):
+        return int(min(max(size, self.minimum), self.maximum))
+
+    def observe(self, lines, latency=None, error=False):
+        """
+        Adjust the batch size after a write.
+
+        :param lines: lines in the write
+        :param latency: write time (seconds), for a successful write
+        :param error: the write failed (transient error)
+        """
+        with self._lock:
+            if error:
+                self.size = self._clamp(self.size / 2)
+            elif lines * 2 >= self.size:
+                # a short (end of series) batch says little about the limit
+                wanted = (lines * self.target_latency / latency
+                          if latency and latency > 0 else self.size * 2)
+                wanted = min(max(wanted, self.size / 2), self.size * 2)
+                self.size = self._clamp(wanted)
+
+
 class InfluxHelper(object):
     """
     Influxdb helper class
     """
-    def __init__(self):
+    def __init__(self, params=None, name=None):
         """
         Influxdb helper class initializer
+
+        :param params: influx_* parameters (SysParams if None)
+        :param name: sink name, None for the primary sink
         """
         super().__init__()
-        self.params = SysParams().params
+        import influxdb
+        self.params = params if params is not None else SysParams().params
+        self.primary = name is None
+        self.name = name or PRIMARY_SINK
         self.database = self.params['influx_database']
         self.logger = Logger().logger
 
@@ -39,6 +150,38 @@ class InfluxHelper(object):
                                                 password=self.params['influx_password'],
                                                 timeout=self.params['influx_timeout'],
                                                 database=self.database)
+        self.precision = self.params.get('influx_precision',
+                                         constants.DEFAULT_INFLUX_PRECISION)
+        self.sizer = AdaptiveBatchSize(
+            self.params.get('influx_batch_size',
+                            constants.DEFAULT_INFLUX_BATCH_SIZE),
+            self.params.get('influx_batch_min',
+                            constants.DEFAULT_INFLUX_BATCH_MIN),
+            self.params.get('influx_batch_max',
+                            constants.DEFAULT_INFLUX_BATCH_MAX),
+            self.params.get('influx_write_latency',
+                            constants.DEFAULT_INFLUX_WRITE_LATENCY))
+        self.encoder = line_protocol.LineEncoder(self.sizer.size)
+        self.max_retries = int(self.params.get('influx_max_retries',
+                                               constants.DEFAULT_INFLUX_MAX_RETRIES))
+        self.backoff = float(self.params.get('influx_backoff',
+                                             constants.DEFAULT_INFLUX_BACKOFF))
+        # Optional checkpoint.CheckpointStore, committed timestamps are
+        # recorded there after each write
+        self.checkpoints = None
+        # Optional watermarks.Watermarks, advanced the same way
+        self.watermarks = None
+        # batches that failed to write, write retries, points rejected
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        # Optional spool.Spool, batches go there when Influx fails
+        self.spool = None
+        # per thread: spool_points() in progress
+        self._local = threading.local()
+        # (metric, foundry) series with a lost batch: no more commits
+        self.failed = set()
+        self._failed_lock = threading.Lock()
 
     @staticmethod
     def is_number(nbr):
@@ -56,16 +199,19 @@ class InfluxHelper(object):
         else:
             return True
 
-    def get_metric_start_time(self, metric):
+    def get_metric_start_time(self, metric, field=None):
         """
         Get the start time for the given influxdb metric.
 
         :param metric:
+        :param field: field to take the last point of (see
+                      watermarks.last_selector())
         :return: start time
         """
         start = self.params['START_TIMESTAMP']
         try:
-            influx_query = "SELECT LAST(*) FROM \"{}\"".format(metric)
+            influx_query = "SELECT {} FROM \"{}\"".format(
+                watermarks.last_selector(field), metric)
             self.logger.debug("Influx query: %s", influx_query)
             influx_result = self.dbclient.query(influx_query,
                                                 database=self.database,
@@ -83,62 +229,308 @@ class InfluxHelper(object):
         # Any exception: raise 'failed'
         raise InfluxStartQueryFailed
 
-    def send_points(self, metric, foundation_info, points):
+    def get_watermarks(self, metrics, field=None):
         """
-        Send the point series to influx
+        Get the last timestamp per (metric, foundry) for all the given
+        metrics with a single grouped query.
 
-        :param foundry:
-        :param points: list of points (as [time, value])
-        :return:
+        :param metrics: list of metric (measurement) names
+        :param field: field to take the last point of (see
+                      watermarks.last_selector())
+        :return: watermarks.Watermarks
+        """
+        influx_query = watermarks.last_query(metrics, field)
+        try:
+            self.logger.debug("Influx query: %s", influx_query)
+            influx_result = self.dbclient.query(influx_query,
+                                                database=self.database,
+                                                epoch="ms")
+            return watermarks.Watermarks.from_result(influx_result.raw)
+        except Exception as exn:
+            self.logger.warning("Watermark query failed: %s", exn)
+        raise InfluxStartQueryFailed
+
+    def send_points(self, metric, foundation_info, points, after=None,
+                    commit=True):
+        """
+        Send the point series to influx, encoded as line protocol in
+        batches of (adaptive) batch size points.
+
+        :param metric: measurement name
+        :param foundation_info: (foundry, tags) from the foundry index
+        :param points: pointlist.Series, list of points (as [time, value])
+                       or rollup.Buckets
+        :param after: only send points after this timestamp (ms)
+        :param commit: move the checkpoints and watermarks forward
+        :return: number of points written
 
         Note(s):
           1. points are returned from Datadog query
              https://docs.datadoghq.com/api/?lang=python#query-time-series-points
         """
-        class SeriesHelper(influxdb.SeriesHelper):
-            class Meta:
-                # The client should be an instance of InfluxDBClient.
-                client = self.dbclient
-                # Defines all the fields in this time series.
-                fields = ['value', 'time']
-                # Defines all the tags for the series.
-                tags = ['foundry', 'environment', 'dc', 'region', 'context']
-                # Defines the number of data points to store prior to writing
-                # on the wire.
-                bulk_size = 150
-                # autocommit must be set to True when using bulk_size
-                autocommit = True
-
-        SeriesHelper.Meta.series_name = metric
+        if isinstance(points, rollup.Buckets):
+            return self.send_buckets(metric, foundation_info, points)
+        prefix = self.series_prefix(metric, foundation_info)
+        if prefix is None:
+            return 0
+
+        if isinstance(points, pointlist.Series):
+            times, values = points.columns(self.precision, after)
+        else:
+            times, values = pointlist.to_columns(points, self.precision, after)
+        if len(times) < len(points):
+            self.dropped(len(points) - len(times), metric, 'filtered')
+        written = self.write_series(
+            metric, foundation_info[0],
+            self.encoder.column_batches(prefix, times, values),
+            (lambda sent: pointlist.to_ms(times[sent - 1], self.precision))
+            if commit else None)
+        self.logger.debug("Influx %s: wrote %d of %d points for %s %s",
+                          self.name, written, len(points), metric,
+                          foundation_info[0], extra=HOT_LOOP)
+        return written
+
+    def spool_points(self, metric, foundation_info, points, after=None,
+                     commit=True):
+        """
+        Encode a series as send_points() does, but append its batches to
+        the spool (which must be set) without trying Influx.  Batches for
+        a retention policy, never spooled, are written.
+
+        :return: number of points spooled (or written)
+        """
+        self._local.spooling = True
+        try:
+            return self.send_points(metric, foundation_info, points, after,
+                                    commit)
+        finally:
+            self._local.spooling = False
+
+    def send_buckets(self, metric, foundation_info, buckets):
+        """
+        Send a series' rollup buckets to influx.
+
+        :param metric: the metric the buckets roll up
+        :param foundation_info: (foundry, tags) from the foundry index
+        :param buckets: rollup.Buckets
+        :return: number of buckets written
+        """
+        prefix = self.series_prefix(buckets.measurement, foundation_info)
+        if prefix is None:
+            return 0
+        multiplier, divisor = pointlist.PRECISION_SCALE[self.precision]
+        times = [int(bucket) * multiplier // divisor for bucket in buckets.times]
+        written = self.write_series(
+            metric, foundation_info[0],
+            self.encoder.field_batches(prefix, times, buckets.fields),
+            lambda sent: int(buckets.times[sent - 1]) + buckets.span - 1,
+            buckets.retention_policy)
+        self.logger.debug("Influx %s: wrote %d of %d buckets for %s %s",
+                          self.name, written, len(buckets),
+                          buckets.measurement, foundation_info[0],
+                          extra=HOT_LOOP)
+        return written
+
+    def series_prefix(self, measurement, foundation_info):
+        """
+        Get the line prefix of a foundry's series.
+
+        :param measurement: measurement name
+        :param foundation_info: (foundry, tags) from the foundry index
+        :return: the prefix, or None if the foundry misses a tag
+        """
         (foundry, info) = foundation_info
-        for pnbr, point in enumerate(points, 1):
+        try:
+            if 'foundry' not in info:
+                # raw foundation info entry rather than an index tag set
+                info = foundry_index.foundry_tags(foundry, info)
+            return self.encoder.prefix(measurement, foundry, info)
+        except KeyError as exn:
+            self.logger.warning("Influx: foundry %s missing tag %s", foundry, exn)
+            return None
+
+    def write_series(self, metric, foundry, batches, committed=None,
+                     retention_policy=None):
+        """
+        Write a series' batches, committing after each written batch.
+
+        :param metric: measurement name (of the raw points)
+        :param foundry: foundry name
+        :param batches: iterable of line protocol batches
+        :param committed: called with the number of lines sent so far,
+                          returns the timestamp (ms) they cover; None to
+                          not commit
+        :param retention_policy: retention policy to write to, or None
+        :return: number of lines written
+        """
+        written = 0
+        sent = 0
+        for batch in batches:
+            sent += len(batch)
             try:
-                point_time, point_value = point[0:2]
-            except:
-                self.logger.warning("Unable to determine time/value on metrics: %s",
-                                    point)
-                return
-            # SeriesHelper(....)
-            if self.is_number(point_value):
-                self.logger.debug("Influx: [%d] send point [%d : %d]",
-                                  pnbr, point_time, point_value)
-                try:
-                    SeriesHelper(foundry=foundry,
-                                 environment=info['environment'],
-                                 dc=info['dc'],
-                                 region=info['region'],
-                                 context=info['context'],
-                                 time=int(point_time) * 1000000,
-                                 value=point_value)
-                except Exception as exn:
-                    self.logger.warning("Influx: error sending point %d %s: %s",
-                                        pnbr, str(point), type(exn))
-                    self.logger.debug("Influx error sending point %d: %s",
-                                      pnbr, exn)
-                    return
+                count = self.write_batch(batch, retention_policy)
+            except Exception as exn:
+                self.logger.warn("InfluxDB commit failed: %s", exn)
+                self.errors += 1
+                self.dropped(len(batch), metric, 'write_failed')
+                # no later batch (of this or any later window) may
+                # checkpoint past the failed one
+                committed = None
+                with self._failed_lock:
+                    if (metric, foundry) not in self.failed:
+                        self.failed.add((metric, foundry))
+                        self.logger.warning("Influx %s: %s %s lost points, its "
+                                            "checkpoint stays put for this run",
+                                            self.name, metric, foundry)
+            else:
+                written += count
+                if count < len(batch):
+                    self.dropped(len(batch) - count, metric, 'rejected')
+                if committed is not None and (metric, foundry) not in self.failed:
+                    self.commit(metric, foundry, committed(sent))
+        if self.primary:
+            telemetry.POINTS_WRITTEN.inc(written, metric)
+        telemetry.SINK_POINTS.inc(written, self.name, 'written')
+        return written
+
+    def reset_failed(self, metric):
+        """
+        Forget a metric's lost batches, at the start of a pass over it:
+        the pass fetches from before the lost points again.
+
+        :param metric: measurement name (of the raw points)
+        """
+        with self._failed_lock:
+            self.failed.difference_update(
+                [key for key in self.failed if key[0] == metric])
+
+    def lost(self, metric):
+        """
+        Get the foundries of a metric with a lost batch in this pass.
+
+        :param metric: measurement name (of the raw points)
+        :return: sorted list of foundry names
+        """
+        with self._failed_lock:
+            return sorted(foundry for name, foundry in self.failed
+                          if name == metric)
+
+    def dropped(self, amount, metric, reason):
+        """
+        Count points not written.
+
+        :param reason: why ('filtered', 'write_failed', 'rejected')
+        """
+        if self.primary:
+            telemetry.POINTS_DROPPED.inc(amount, metric, reason)
+        telemetry.SINK_POINTS.inc(amount, self.name, 'dropped')
+
+    def commit(self, metric, foundry, timestamp):
+        """
+        Record a committed timestamp in the checkpoint store and the
+        watermarks (when set).
+
+        :param timestamp: last committed timestamp (ms)
+        """
+        if self.checkpoints is not None:
+            self.checkpoints.record(metric, foundry, timestamp)
+        if self.watermarks is not None:
+            self.watermarks.advance(metric, foundry, timestamp)
+        if self.primary:
+            telemetry.METRIC_LAG.mark(metric, foundry, timestamp)
+        telemetry.SINK_LAG.mark(metric, foundry, timestamp, self.name)
+
+    def write_batch(self, lines, retention_policy=None):
+        """
+        Write one batch to Influx or, when there is a spool, to the spool
+        if Influx fails or the spool already has a backlog.  Batches for a
+        retention policy are not spooled.
+
+        :param lines: list of line protocol strings
+        :param retention_policy: retention policy to write to, or None
+        :return: number of lines written (or spooled)
+        """
+        if retention_policy is not None:
+            return self.write_lines(lines, retention_policy)
+        if self.spool is not None and (self.spool.pending or
+                                       getattr(self._local, 'spooling', False)):
+            self.spool.append(lines)
+            return len(lines)
         try:
-            self.logger.debug("Influx: commit")
-            SeriesHelper.commit()
-            self.logger.debug("Influx JSON: %s", SeriesHelper._json_body_())
+            return self.write_lines(lines)
         except Exception as exn:
-            self.logger.warn("InfluxDB commit failed: %s", exn)
+            if self.spool is None:
+                raise
+            self.logger.warn("InfluxDB commit failed, spooling: %s", exn)
+            self.spool.append(lines)
+            return len(lines)
+
+    def write_lines(self, lines, retention_policy=None):
+        """
+        Write one batch of line protocol lines, retrying transient errors
+        and splitting batches rejected for their content.  Raises the
+        last error when the retries run out.
+
+        :param lines: list of line protocol strings
+        :param retention_policy: retention policy to write to, or None
+        :return: number of lines written (rejected points are dropped)
+        """
+        options = {}
+        if retention_policy is not None:
+            options['retention_policy'] = retention_policy
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                self.dbclient.write_points(lines, time_precision=self.precision,
+                                           protocol='line', **options)
+            except Exception as exn:
+                telemetry.INFLUX_COMMIT_SECONDS.observe(time.time() - started)
+                if is_rejected(exn):
+                    telemetry.INFLUX_WRITES.inc(1, 'rejected')
+                    return self.write_rejected(lines, exn, retention_policy)
+                if not is_transient(exn) or attempt >= self.max_retries:
+                    telemetry.INFLUX_WRITES.inc(1, 'error')
+                else:
+                    telemetry.INFLUX_WRITES.inc(1, 'retry')
+                if not is_transient(exn):
+                    raise
+                self.sizer.observe(len(lines), error=True)
+                self.encoder.batch_size = self.sizer.size
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+                attempt += 1
+                self.retries += 1
+                self.logger.warning("Influx write failed (%s), retry %d in "
+                                    "%.1fs", exn, attempt, delay)
+                time.sleep(delay)
+            else:
+                latency = time.time() - started
+                telemetry.INFLUX_COMMIT_SECONDS.observe(latency)
+                telemetry.INFLUX_BATCH_POINTS.observe(len(lines))
+                telemetry.INFLUX_WRITES.inc(1, 'ok')
+                self.sizer.observe(len(lines), latency)
+                self.encoder.batch_size = self.sizer.size
+                return len(lines)
+
+    def write_rejected(self, lines, exn, retention_policy=None):
+        """
+        Isolate the bad points of a rejected batch: write each half on
+        its own, down to single (dropped) points.
+
+        :param lines: the rejected batch
+        :param exn: the rejection
+        :param retention_policy: retention policy to write to, or None
+        :return: number of lines written
+        """
+        if len(lines) == 1:
+            self.rejected += 1
+            self.logger.warning("Influx rejected point %s: %s", lines[0], exn)
+            return 0
+        if exn.code == 413:
+            self.sizer.observe(len(lines), error=True)
+            self.encoder.batch_size = self.sizer.size
+        half = len(lines) // 2
+        return (self.write_lines(lines[:half], retention_policy)
+                + self.write_lines(lines[half:], retention_policy))
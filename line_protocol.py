@@ -0,0 +1,191 @@
+"""
+Influx line protocol encoding
+
+Note(s):
+    1. Requires Python 3
+    2. Line protocol reference:
+         https://docs.influxdata.com/influxdb/v1.7/write_protocols/line_protocol_reference/
+       <measurement>[,<tag>=<value>...] <field>=<value>[,...] [timestamp]
+    3. Lines are built from a str.format() template per series, with the
+       braces of the prefix and field names doubled (see literal()).
+
+"""
+import math
+
+
+def escape_measurement(name):
+    """
+    Escape a measurement name (commas and spaces).
+    """
+    return str(name).replace(',', r'\,').replace(' ', r'\ ')
+
+
+def escape_tag(value):
+    """
+    Escape a tag key or tag value (commas, equal signs and spaces).
+    """
+    return str(value).replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def literal(text):
+    """
+    Escape text for a str.format() template (braces), so that tag values
+    and names holding '{' or '}' come out as they are.
+    """
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def series_prefix(measurement, tags):
+    """
+    Build the '<measurement>,<tags>' part of a line, which is the same for
+    every point of a series.  Tags are sorted by key (as recommended by
+    Influx) and empty tags are left out (line protocol cannot carry them).
+
+    :param measurement: measurement name
+    :param tags: dictionary of tag key: value
+    :return: escaped line prefix
+    """
+    parts = [escape_measurement(measurement)]
+    parts.extend('{}={}'.format(escape_tag(key), escape_tag(value))
+                 for key, value in sorted(tags.items())
+                 if value is not None and value != '')
+    return ','.join(parts)
+
+
+def format_value(value):
+    """
+    Format a point value as a line protocol float field value.
+
+    :param value: the value (number or numeric string)
+    :return: the formatted value, or None if it is not a finite number
+    """
+    try:
+        value = float(value)
+    except (ValueError, TypeError):
+        return None
+    if not math.isfinite(value):
+        return None
+    return repr(value)
+
+
+def encode_points(prefix, points, field='value'):
+    """
+    Generator: encode Datadog [timestamp, value] points as lines.  Points
+    without a usable value are skipped.
+
+    :param prefix: series prefix from series_prefix()
+    :param points: iterable of [timestamp, value] pairs
+    :param field: field name to store the value under
+    :return: line protocol strings (no trailing newline)
+    """
+    template = literal(prefix + ' ' + field) + '={} {}'
+    for point in points:
+        try:
+            point_time, point_value = point[0:2]
+        except (TypeError, ValueError):
+            continue
+        value = format_value(point_value)
+        if value is not None:
+            yield template.format(value, int(point_time))
+
+
+class LineEncoder(object):
+    """
+    Batch encoder from Datadog point lists to line protocol.  The escaped
+    '<measurement>,<tags>' prefix is built once per (measurement, foundry)
+    and reused for every later series of that foundry.
+    """
+    def __init__(self, batch_size):
+        """
+        :param batch_size: maximum number of lines per batch
+        """
+        super().__init__()
+        self.batch_size = max(1, int(batch_size))
+        self._prefixes = {}
+
+    def prefix(self, measurement, foundry, tags):
+        """
+        Get the (cached) line prefix for a foundry's series.
+
+        :param measurement: measurement name
+        :param foundry: foundry name
+        :param tags: the foundry's tag set
+        :return: escaped line prefix
+        """
+        key = (measurement, foundry)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = self._prefixes[key] = series_prefix(measurement, tags)
+        return prefix
+
+    def batches(self, prefix, points, field='value'):
+        """
+        Generator: encode points into lists of at most batch_size lines.
+
+        :param prefix: line prefix from prefix()
+        :param points: iterable of [timestamp, value] pairs
+        :param field: field name to store the value under
+        :return: lists of line protocol strings
+        """
+        batch = []
+        for line in encode_points(prefix, points, field):
+            batch.append(line)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def column_batches(self, prefix, times, values, field='value'):
+        """
+        Generator: encode already validated (times, values) columns, as
+        returned by pointlist.to_columns(), into lists of at most
+        batch_size lines.
+
+        :param prefix: line prefix from prefix()
+        :param times: integer timestamps (list or NumPy array)
+        :param values: float values (list or NumPy array)
+        :param field: field name to store the value under
+        :return: lists of line protocol strings
+        """
+        if hasattr(times, 'tolist'):
+            # one bulk conversion to Python ints/floats
+            times = times.tolist()
+            values = values.tolist()
+        template = literal(prefix + ' ' + field) + '={!r} {}'
+        offset = 0
+        while offset < len(times):
+            # batch_size is read per batch, it may be adapted in between
+            end = offset + self.batch_size
+            yield [template.format(value, point_time)
+                   for point_time, value in zip(times[offset:end],
+                                                values[offset:end])]
+            offset = end
+
+    def field_batches(self, prefix, times, fields):
+        """
+        Generator: encode points with several fields (rollup buckets)
+        into lists of at most batch_size lines.  Integer columns are
+        written as integer fields, the others as floats.
+
+        :param prefix: line prefix from prefix()
+        :param times: integer timestamps (list or NumPy array)
+        :param fields: [(field name, column), ...], columns as for
+                       column_batches()
+        :return: lists of line protocol strings
+        """
+        columns = [column.tolist() if hasattr(column, 'tolist') else column
+                   for _, column in fields]
+        if hasattr(times, 'tolist'):
+            times = times.tolist()
+        template = literal(prefix) + ' ' + ','.join(
+            literal(escape_tag(name)) + ('={}i' if column and
+                                         isinstance(column[0], int)
+                                         else '={!r}')
+            for (name, _), column in zip(fields, columns)) + ' {}'
+        rows = list(zip(*(columns + [times])))
+        offset = 0
+        while offset < len(rows):
+            end = offset + self.batch_size
+            yield [template.format(*row) for row in rows[offset:end]]
+            offset = end
@@ -0,0 +1,103 @@
+"""
+Fetch/write pipeline
+
+Note(s):
+    1. Requires Python 3
+    2. The Datadog fetch side (producer) puts work items on a bounded
+       queue, one or more writer threads drain the queue into Influx.
+       When the writers fall behind the queue fills up and put() blocks,
+       which throttles the producer (backpressure) and caps the number
+       of series held in memory at 'depth'.  put(block=False) raises
+       queue.Full instead, for producers that must not wait.
+
+"""
+import queue
+import threading
+
+from commonpy.logger import Logger
+
+# Queue sentinel telling a writer thread to exit
+_STOP = object()
+
+
+class WritePipeline(object):
+    """
+    Bounded producer/consumer stage.  Each item put on the pipeline is
+    handed to the writer function by one of the writer threads.
+    """
+    def __init__(self, writer, depth, writers=1, name='writer'):
+        """
+        Start the writer threads.
+
+        :param writer: function called with each item's arguments
+        :param depth: maximum number of items queued (>= 1)
+        :param writers: number of writer threads (>= 1)
+        :param name: thread name prefix
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max(1, int(depth)))
+        self.written = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._drain,
+                                          name='{}-{}'.format(name, nbr),
+                                          daemon=True)
+                         for nbr in range(max(1, int(writers)))]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, *args, block=True):
+        """
+        Queue an item for the writers, blocking while the queue is full
+        (or raising queue.Full if not 'block').
+
+        :param args: arguments for the writer function
+        """
+        if self._closed:
+            raise RuntimeError("put() on a closed pipeline")
+        self.queue.put(args, block)
+
+    def close(self):
+        """
+        Wait for everything queued to be written, then stop the writers.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self.logger.debug("Pipeline closed: %d written, %d errors",
+                          self.written, self.errors)
+
+    def _drain(self):
+        """
+        Writer thread body: write items until told to stop.  A failed
+        write is logged and counted, it does not stop the thread.
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                try:
+                    self.writer(*item)
+                except Exception as exn:
+                    self.logger.error("Pipeline write failed: %s", exn)
+                    with self._lock:
+                        self.errors += 1
+                else:
+                    with self._lock:
+                        self.written += 1
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,126 @@
+"""
+Datadog query planner
+
+Note(s):
+    1. Requires Python 3
+    2. Exporter.run() fetches the queries file entries in groups rather
+       than one by one.  Entries with the same Datadog query share one
+       fetch (its series go to every one of their metrics), and with
+       query_batch above 1 up to query_batch distinct queries are sent
+       as one comma separated multi-query request per window.
+    3. Datadog tags each returned series with the position of its query
+       in the request (query_index), falling back to its expression.
+    4. A group fetches from the earliest start time of its entries, the
+       watermarks trim what the others already have.  So entries, even
+       with identical queries, are only grouped when their start times
+       are within 'spread' seconds (a window) of each other: a metric
+       that is up to date is not fetched again from a lagging one's
+       start.
+    5. A group's combined query is at most MAX_QUERY_CHARS characters
+       (it goes in the request URL).
+
+"""
+from collections import namedtuple
+
+MAX_QUERY_CHARS = 4000
+
+# A queries file entry fetched by a group: its number (1 based), metric
+# and rollup.Rollup (or None)
+Target = namedtuple('Target', ['qnbr', 'metric', 'rollup'])
+
+
+class QueryGroup(object):
+    """
+    Datadog queries fetched together, with the entries each one is for.
+    """
+    def __init__(self):
+        super().__init__()
+        self.queries = []       # distinct Datadog queries, in request order
+        self.targets = []       # per query: list of Target
+        self.start = None       # earliest start time (epoch seconds)
+
+    @property
+    def query(self):
+        """
+        The (multi-)query sent to Datadog.
+        """
+        return ','.join(self.queries)
+
+    def all_targets(self):
+        """
+        Every entry of the group.
+
+        :return: list of Target
+        """
+        return [target for targets in self.targets for target in targets]
+
+    def fits(self, query, start, batch, spread):
+        """
+        Can a distinct query be added to the group?
+
+        :param query: Datadog query
+        :param start: its start time (epoch seconds)
+        :param batch: most distinct queries per group
+        :param spread: most seconds between start times
+        """
+        return (len(self.queries) < batch
+                and abs(start - self.start) <= spread
+                and len(self.query) + 1 + len(query) <= MAX_QUERY_CHARS)
+
+    def add(self, query, target, start=None):
+        """
+        Add an entry.
+
+        :param query: its Datadog query
+        :param target: Target
+        :param start: its start time (epoch seconds)
+        """
+        if query in self.queries:
+            self.targets[self.queries.index(query)].append(target)
+        else:
+            self.queries.append(query)
+            self.targets.append([target])
+        if start is not None and (self.start is None or start < self.start):
+            self.start = start
+
+    def targets_of(self, series):
+        """
+        Get the entries a returned series is for.
+
+        :param series: series from the Datadog response
+        :return: list of Target, empty if the series matches no query
+        """
+        if len(self.queries) == 1:
+            return self.targets[0]
+        index = series.get('query_index')
+        if isinstance(index, int) and 0 <= index < len(self.queries):
+            return self.targets[index]
+        try:
+            return self.targets[self.queries.index(series.get('expression'))]
+        except ValueError:
+            return []
+
+
+def plan(entries, batch, spread):
+    """
+    Group queries file entries into fetches.
+
+    :param entries: list of (Datadog query, Target, start time)
+    :param batch: most distinct Datadog queries per group
+    :param spread: most seconds between the start times of a group's
+                   entries
+    :return: list of QueryGroup
+    """
+    groups = []
+    by_query = {}           # query: its latest group
+    for query, target, start in sorted(entries, key=lambda entry: entry[2]):
+        group = by_query.get(query)
+        if group is None or start - group.start > spread:
+            if groups and groups[-1].fits(query, start, batch, spread):
+                group = groups[-1]
+            else:
+                group = QueryGroup()
+                groups.append(group)
+            by_query[query] = group
+        group.add(query, target, start)
+    return groups
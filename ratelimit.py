@@ -0,0 +1,258 @@
+"""
+Datadog request scheduler
+
+Note(s):
+    1. Requires Python 3
+    2. Every Datadog call goes through one shared RequestScheduler:
+       - a token bucket holds the request rate at the org's allowance
+         (limit requests per period, with a small burst),
+       - waiting callers are served round robin by key (the Datadog
+         query), so one query with many windows cannot starve the rest,
+       - the rate limit response headers re-tune the bucket:
+           X-RateLimit-Limit, X-RateLimit-Period,
+           X-RateLimit-Remaining, X-RateLimit-Reset
+       - rate limited (429) and transient failures are retried with
+         exponential backoff instead of the window being dropped, a 429
+         no sooner than its Retry-After (or X-RateLimit-Reset).
+    3. asyncio callers (async_engine.py) use acquire_async() and
+       call_async(), which wait on the event loop instead of blocking
+       it.  They take tokens from the same bucket, but ahead of any
+       threads waiting in acquire() (one engine is used per run).
+
+"""
+from collections import deque
+import random
+import threading
+import time
+
+from commonpy.logger import Logger
+
+
+class RateLimited(Exception):
+    """ The request was rejected by the rate limiter (HTTP 429) """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after(headers):
+    """
+    Get how long a rate limited response asks to wait.
+
+    :param headers: response headers (case insensitive mapping)
+    :return: seconds, None if the response does not say
+    """
+    for name in ('Retry-After', 'X-RateLimit-Reset'):
+        try:
+            seconds = float(headers.get(name))
+        except (TypeError, ValueError):
+            continue
+        if seconds >= 0:
+            return seconds
+    return None
+
+
+class RequestScheduler(object):
+    """
+    Fair, rate limited, retrying request scheduler.
+    """
+    def __init__(self, limit, period, burst=1, max_retries=5,
+                 backoff=1.0, max_backoff=60.0, retry_on=(), share=1.0):
+        """
+        :param limit: requests allowed per period
+        :param period: rate limit period (seconds)
+        :param burst: bucket size (requests allowed back to back)
+        :param max_retries: retries per request before giving up
+        :param backoff: first retry delay (seconds), doubled per retry
+        :param max_backoff: longest retry delay (seconds)
+        :param retry_on: exception types worth retrying (besides
+                         RateLimited)
+        :param share: part of the org's allowance (the rate limit headers)
+                      this scheduler may use, when several processes
+                      share it
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.rate = float(limit) / float(period)
+        self.burst = max(1.0, float(burst))
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.retry_on = (RateLimited,) + tuple(retry_on)
+        self.share = float(share)
+        self.requests = 0
+        self.retries = 0
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = {}          # key: deque of tickets
+        self._order = deque()       # keys with waiters, round robin order
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _delay(self, now):
+        """
+        Time until a token could be available.
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        return max(0.0, (1.0 - self._tokens) / self.rate)
+
+    def acquire(self, key):
+        """
+        Wait for this key's turn and a request token.
+
+        :param key: fairness key (the Datadog query)
+        """
+        ticket = object()
+        with self._cond:
+            if key not in self._waiting:
+                self._waiting[key] = deque()
+                self._order.append(key)
+            self._waiting[key].append(ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                head = self._order[0]
+                if (self._waiting[head][0] is ticket and
+                        now >= self._paused_until and self._tokens >= 1.0):
+                    self._tokens -= 1.0
+                    self.requests += 1
+                    self._waiting[head].popleft()
+                    self._order.popleft()
+                    if self._waiting[head]:
+                        self._order.append(head)
+                    else:
+                        del self._waiting[head]
+                    self._cond.notify_all()
+                    return
+                self._cond.wait(self._delay(now) if self._waiting[head][0] is ticket
+                                else None)
+
+    def try_acquire(self):
+        """
+        Take a request token if one is available now, without waiting.
+
+        :return: 0 if a token was taken, else the seconds until one
+                 could be
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self.requests += 1
+                return 0
+            return max(0.01, self._delay(now))
+
+    async def acquire_async(self):
+        """
+        Wait (on the event loop) for a request token.
+        """
+        import asyncio
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def update(self, headers):
+        """
+        Re-tune the bucket from a response's rate limit headers.
+
+        :param headers: response headers (case insensitive mapping)
+        """
+        try:
+            limit = headers.get('X-RateLimit-Limit')
+            period = headers.get('X-RateLimit-Period')
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset = headers.get('X-RateLimit-Reset')
+            with self._cond:
+                if limit and period and float(period) > 0:
+                    self.rate = float(limit) / float(period) * self.share
+                if remaining is not None:
+                    # never believe we have more than the server says
+                    self._refill(time.monotonic())
+                    self._tokens = min(self._tokens, float(remaining))
+                    if float(remaining) < 1 and reset is not None:
+                        self._pause(float(reset))
+                self._cond.notify_all()
+        except (TypeError, ValueError) as exn:
+            self.logger.debug("Bad rate limit headers %s: %s", headers, exn)
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until,
+                                 time.monotonic() + seconds)
+
+    def pause(self, seconds):
+        """
+        Hold all requests for a while (after a 429).
+
+        :param seconds: how long to hold
+        """
+        with self._cond:
+            self._pause(seconds)
+            self._cond.notify_all()
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) as a scheduled request, retrying rate
+        limited and transient failures.
+
+        :param key: fairness key (the Datadog query)
+        :return: whatever func returns
+        """
+        attempt = 0
+        while True:
+            self.acquire(key)
+            try:
+                return func(*args, **kwargs)
+            except self.retry_on as exn:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                time.sleep(self._retry_delay(exn, attempt))
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        As call(), for a coroutine function: await func(*args, **kwargs)
+        as a scheduled request, retrying rate limited and transient
+        failures.
+
+        :return: whatever func's coroutine returns
+        """
+        import asyncio
+        attempt = 0
+        while True:
+            await self.acquire_async()
+            try:
+                return await func(*args, **kwargs)
+            except self.retry_on as exn:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                await asyncio.sleep(self._retry_delay(exn, attempt))
+
+    def _retry_delay(self, exn, attempt):
+        """
+        Get the backoff before a retry, holding all requests as long
+        after a 429.
+
+        :param exn: the failure
+        :param attempt: retry number (from 1)
+        :return: seconds to wait
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.0)
+        if isinstance(exn, RateLimited):
+            if exn.retry_after:
+                delay = max(delay, float(exn.retry_after))
+            self.pause(delay)
+        self.retries += 1
+        self.logger.warning("Datadog request failed (%s), retry %d "
+                            "in %.1fs", exn, attempt, delay)
+        return delay
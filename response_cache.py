@@ -0,0 +1,165 @@
+"""
+Datadog response cache
+
+Note(s):
+    1. Requires Python 3
+    2. Optional on-disk cache of Datadog query responses, keyed by
+       (query, start, end): one gzip'd JSON file per window, named by the
+       SHA-256 of the key.
+    3. Only settled windows are cached: a window whose end is at least
+       'immutable_after' seconds in the past.  Datadog may still fill in
+       late points for anything newer.
+    4. The cache is kept under 'max_bytes' by evicting the least recently
+       used files (file mtime, refreshed on every hit).
+    5. Files are written to a temporary name and renamed, so a crash
+       never leaves a partial entry; entries that fail to load are
+       treated as misses and removed.
+
+"""
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from commonpy.logger import Logger
+
+_SUFFIX = '.json.gz'
+
+
+def cache_key(query, start, end):
+    """
+    Get the file name for a window.
+
+    :return: hex SHA-256 of the (query, start, end) key
+    """
+    key = json.dumps([query, int(start), int(end)])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Size bounded, LRU evicted Datadog response cache.
+    """
+    def __init__(self, directory, max_bytes, immutable_after):
+        """
+        Open (creating if needed) the cache directory.
+
+        :param directory: cache directory
+        :param max_bytes: largest total size of the cache files
+        :param immutable_after: age (seconds) of a window's end after
+                                which its response is cached
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.immutable_after = int(immutable_after)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # name: size, least recently used first
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(_SUFFIX):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        self._entries = OrderedDict((name, size)
+                                    for _, name, size in sorted(entries))
+        self._bytes = sum(self._entries.values())
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def cacheable(self, end, now=None):
+        """
+        Is a window ending at 'end' settled enough to cache?
+
+        :param end: window end (epoch seconds)
+        """
+        return end <= (now if now is not None else time.time()) - self.immutable_after
+
+    def get(self, query, start, end):
+        """
+        Look a window's response up.
+
+        :return: the decoded response, or None on a miss
+        """
+        name = cache_key(query, start, end) + _SUFFIX
+        with self._lock:
+            known = name in self._entries
+            if known:
+                self._entries.move_to_end(name)
+        if known:
+            try:
+                with gzip.open(self._path(name), 'rt', encoding='utf-8') as entry:
+                    response = json.load(entry)
+                os.utime(self._path(name))
+            except (OSError, ValueError, EOFError) as exn:
+                self.logger.warning("Datadog cache: dropping %s: %s", name, exn)
+                self._remove(name)
+            else:
+                with self._lock:
+                    self.hits += 1
+                return response
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query, start, end, response):
+        """
+        Cache a window's response, if the window is settled.
+
+        :param response: the decoded response
+        :return: True if cached
+        """
+        if not self.cacheable(end):
+            return False
+        name = cache_key(query, start, end) + _SUFFIX
+        handle, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as raw, \
+                 gzip.GzipFile(fileobj=raw, mode='wb') as entry:
+                entry.write(json.dumps(response).encode('utf-8'))
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self._path(name))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self._lock:
+            self._bytes += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            evict = []
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old, old_size = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+        return True
+
+    def _remove(self, name):
+        with self._lock:
+            self._bytes -= self._entries.pop(name, 0)
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    @property
+    def size(self):
+        """
+        Total size of the cache files (bytes).
+        """
+        return self._bytes
@@ -0,0 +1,345 @@
+"""
+Time bucket rollups
+
+Note(s):
+    1. Requires Python 3.  NumPy is optional.
+    2. A query with a 'rollup' key is written as fixed time bucket
+       aggregates instead of raw points:
+         {"metric": "cpu", "query": "...",
+          "rollup": {"interval": 300, "aggregates": ["avg", "max"],
+                     "measurement": "cpu_5m", "retention_policy": "weeks",
+                     "keep_raw": false}}
+       interval is the bucket size (seconds), buckets are aligned on
+       multiples of it (epoch time).  aggregates are taken from
+       AGGREGATES (default avg) and written as one field each (count as
+       an integer field), to 'measurement' (default the metric's) in
+       'retention_policy' (default the database's).  keep_raw also
+       writes the raw points to the metric's measurement, so the rollup
+       must then go to a measurement of its own.
+    3. A bucket is written once it is closed: when a later point arrives
+       or the export gets past its end.  The points of the still open
+       bucket of a series are held over to the next window, and the
+       checkpoints and watermarks only move to the end of the last
+       written bucket, so the next run fetches the open bucket again
+       from its start (fetches start on a bucket boundary).
+    4. The watermark found in Influx for a rollup is the start of its
+       last bucket: watermarks are looked up in the rollup measurement,
+       with LAST of its first aggregate field (LAST(*) of several fields
+       has no single time), and moved to the end of that bucket (see
+       watermark_marks()).
+    5. Rollup batches have no spool fallback when they go to a retention
+       policy (a spool segment does not record one).
+
+"""
+from array import array
+from itertools import groupby
+
+import pointlist
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGGREGATES = ('avg', 'min', 'max', 'sum', 'count')
+DEFAULT_AGGREGATES = ('avg',)
+ROLLUP_KEYS = ('interval', 'aggregates', 'measurement', 'retention_policy',
+               'keep_raw')
+
+
+def aggregate(times, values, interval, aggregates=DEFAULT_AGGREGATES):
+    """
+    Aggregate time ordered points into buckets.
+
+    :param times: timestamps (ms), NumPy array or sequence of ints
+    :param values: float values, same length
+    :param interval: bucket size (ms)
+    :param aggregates: names from AGGREGATES
+    :return: (bucket start times (ms), [(aggregate, column), ...])
+    """
+    if numpy is not None and isinstance(times, numpy.ndarray):
+        return numpy_aggregate(times, values, interval, aggregates)
+    return python_aggregate(times, values, interval, aggregates)
+
+
+def numpy_aggregate(times, values, interval, aggregates):
+    """
+    Vectorized aggregation (NumPy required): every bucket is a run of
+    consecutive points, reduced in one pass per aggregate.
+    """
+    buckets = times - times % interval
+    if not len(buckets):
+        return buckets, [(name, numpy.empty(0)) for name in aggregates]
+    starts = numpy.flatnonzero(numpy.concatenate(
+        ([True], buckets[1:] != buckets[:-1])))
+    counts = numpy.diff(numpy.append(starts, len(buckets)))
+    columns = []
+    for name in aggregates:
+        if name == 'count':
+            column = counts
+        elif name == 'min':
+            column = numpy.minimum.reduceat(values, starts)
+        elif name == 'max':
+            column = numpy.maximum.reduceat(values, starts)
+        else:
+            column = numpy.add.reduceat(values, starts)
+            if name == 'avg':
+                column = column / counts
+        columns.append((name, column))
+    return buckets[starts], columns
+
+
+def python_aggregate(times, values, interval, aggregates):
+    """
+    Pure Python aggregation, bucket by bucket.
+    """
+    functions = {'avg': lambda group: sum(group) / len(group),
+                 'min': min,
+                 'max': max,
+                 'sum': sum,
+                 'count': len,
+                }
+    starts = []
+    columns = [(name, []) for name in aggregates]
+    for bucket, points in groupby(zip(times, values),
+                                  key=lambda point: point[0] - point[0] % interval):
+        group = [value for _, value in points]
+        starts.append(bucket)
+        for name, column in columns:
+            column.append(functions[name](group))
+    return starts, columns
+
+
+def join(first, second):
+    """
+    Concatenate two pointlist.Series (the second one later in time).
+    """
+    if numpy is not None and isinstance(first.times, numpy.ndarray):
+        return pointlist.Series(numpy.concatenate((first.times, second.times)),
+                                numpy.concatenate((first.values, second.values)),
+                                first.tags)
+    return pointlist.Series(array('q', first.times) + array('q', second.times),
+                            array('d', first.values) + array('d', second.values),
+                            first.tags)
+
+
+def parse_rollups(queries):
+    """
+    Get the rollups of a queries list.  Queries with a malformed rollup
+    are left out (they fail when they are run).
+
+    :param queries: query dictionaries
+    :return: dictionary of metric: Rollup
+    """
+    rollups = {}
+    for query in queries:
+        try:
+            rollup = Rollup.from_query(query)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+        if rollup is not None:
+            rollups[query['metric']] = rollup
+    return rollups
+
+
+def watermark_measurements(metrics, rollups):
+    """
+    Measurements to look the watermarks of metrics up in, grouped by the
+    field to take the last point of.
+
+    :param metrics: metric names
+    :param rollups: dictionary of metric: Rollup
+    :return: list of (field, measurement names), the field None (any)
+             for the raw measurements
+    """
+    groups = {}
+    for metric in metrics:
+        if metric in rollups:
+            groups.setdefault(rollups[metric].aggregates[0], []).append(
+                rollups[metric].measurement)
+        else:
+            groups.setdefault(None, []).append(metric)
+    return sorted(groups.items(), key=lambda group: group[0] or '')
+
+
+def watermark_marks(marks, rollups):
+    """
+    Map the watermarks found in rollup measurements back to their
+    metrics, moved from the start to the end of the last bucket.
+
+    :param marks: dictionary of (measurement, foundry): timestamp (ms)
+    :param rollups: dictionary of metric: Rollup
+    :return: dictionary of (metric, foundry): timestamp (ms)
+    """
+    metrics = dict((rollup.measurement, metric)
+                   for metric, rollup in rollups.items())
+    mapped = {}
+    for (measurement, foundry), timestamp in marks.items():
+        metric = metrics.get(measurement)
+        if metric is None:
+            mapped[(measurement, foundry)] = timestamp
+        else:
+            mapped[(metric, foundry)] = (timestamp
+                                         + rollups[metric].interval_ms - 1)
+    return mapped
+
+
+class Buckets(object):
+    """
+    Aggregated buckets of a series, as handed to InfluxHelper.send_points()
+    in place of the points.
+    """
+    __slots__ = ('times', 'fields', 'measurement', 'retention_policy', 'span')
+
+    def __init__(self, times, fields, measurement, retention_policy=None,
+                 span=1):
+        """
+        :param times: bucket start times (ms)
+        :param fields: [(field name, column), ...]
+        :param measurement: measurement to write to
+        :param retention_policy: retention policy to write to, or None
+        :param span: bucket size (ms)
+        """
+        self.times = times
+        self.fields = fields
+        self.measurement = measurement
+        self.retention_policy = retention_policy
+        self.span = span
+
+    def __len__(self):
+        return len(self.times)
+
+
+class Rollup(object):
+    """
+    A query's rollup settings.
+    """
+    def __init__(self, interval, measurement, aggregates=DEFAULT_AGGREGATES,
+                 retention_policy=None, keep_raw=False):
+        """
+        :param interval: bucket size (seconds)
+        :param measurement: measurement to write the buckets to
+        :param aggregates: names from AGGREGATES
+        :param retention_policy: retention policy to write to, or None
+        :param keep_raw: also write the raw points
+        """
+        super().__init__()
+        self.interval = int(interval)
+        self.measurement = measurement
+        self.aggregates = tuple(aggregates)
+        self.retention_policy = retention_policy or None
+        self.keep_raw = bool(keep_raw)
+
+    @classmethod
+    def from_query(cls, query):
+        """
+        Get a query's rollup.  Raises ValueError if it is malformed.
+
+        :param query: query dictionary
+        :return: Rollup, or None if the query has none
+        """
+        spec = query.get('rollup')
+        if not spec:
+            return None
+        if not isinstance(spec, dict):
+            raise ValueError("rollup must be an object")
+        unknown = set(spec) - set(ROLLUP_KEYS)
+        if unknown:
+            raise ValueError("rollup: unknown keys {}".format(
+                ', '.join(sorted(unknown))))
+        try:
+            interval = int(spec['interval'])
+        except (KeyError, ValueError, TypeError):
+            raise ValueError("rollup needs an interval (seconds)")
+        if interval < 1:
+            raise ValueError("rollup interval must be positive")
+        aggregates = spec.get('aggregates') or DEFAULT_AGGREGATES
+        if isinstance(aggregates, str) or not set(aggregates) <= set(AGGREGATES):
+            raise ValueError("rollup aggregates must be a list from {}".format(
+                ', '.join(AGGREGATES)))
+        measurement = spec.get('measurement') or query['metric']
+        if spec.get('keep_raw') and measurement == query['metric']:
+            raise ValueError("rollup with keep_raw needs a measurement "
+                             "of its own")
+        return cls(interval, measurement, aggregates,
+                   spec.get('retention_policy'), spec.get('keep_raw'))
+
+    @property
+    def interval_ms(self):
+        return self.interval * 1000
+
+    def align(self, start):
+        """
+        Move a start time (epoch seconds) back to its bucket's start.
+        """
+        return start - start % self.interval
+
+    def buckets(self, points):
+        """
+        Aggregate a series.
+
+        :param points: pointlist.Series
+        :return: Buckets
+        """
+        times, fields = aggregate(points.times, points.values,
+                                  self.interval_ms, self.aggregates)
+        return Buckets(times, fields, self.measurement, self.retention_policy,
+                       self.interval_ms)
+
+    def stage(self, send):
+        """
+        Get a RollupStage sending to 'send'.
+        """
+        return RollupStage(self, send)
+
+
+class RollupStage(object):
+    """
+    Stand in for a send function (InfluxHelper.send_points arguments)
+    that sends closed buckets rather than points, holding each series'
+    open bucket over to its next window.
+    """
+    def __init__(self, rollup, send):
+        """
+        :param rollup: Rollup
+        :param send: send function the buckets (and raw points) go to
+        """
+        super().__init__()
+        self.rollup = rollup
+        self.send = send
+        self._open = {}     # foundry: (metric, foundation_info, points)
+
+    def put(self, metric, foundation_info, points, after=None):
+        """
+        Send the buckets a series closes.  Arguments as for
+        InfluxHelper.send_points().
+        """
+        if self.rollup.keep_raw:
+            # the rollup commits, the raw points must not get ahead of it
+            self.send(metric, foundation_info, points, after, False)
+        held = self._open.pop(foundation_info[0], None)
+        if held is not None:
+            points = join(held[2], points)
+        if not len(points):
+            return
+        last = int(points.times[-1])
+        closed = points.count_upto(last - last % self.rollup.interval_ms - 1)
+        self._open[foundation_info[0]] = (metric, foundation_info,
+                                          points[closed:])
+        if closed:
+            self.send(metric, foundation_info,
+                      self.rollup.buckets(points[:closed]))
+
+    def flush(self, upto):
+        """
+        Send the open buckets that end by a time, and forget the others
+        (they are fetched again next run).
+
+        :param upto: time the series were fetched up to (ms)
+        """
+        interval = self.rollup.interval_ms
+        for metric, foundation_info, points in self._open.values():
+            start = int(points.times[0])
+            if start - start % interval + interval <= upto:
+                self.send(metric, foundation_info, self.rollup.buckets(points))
+        self._open.clear()
@@ -0,0 +1,126 @@
+"""
+Streaming Datadog query response parser
+
+Note(s):
+    1. Requires Python 3
+    2. Parses a query response body as it arrives and hands back each
+       entry of its 'series' list as soon as the entry is complete, so
+       only one series (not the whole window) is held in memory:
+         parser = SeriesParser()
+         for chunk in body:
+             for series in parser.feed(chunk):
+                 ...
+         for series in parser.flush():
+             ...
+         response = parser.close()     # everything but the series
+    3. The series entries are decoded by json's C raw_decode.  An entry
+       spanning several chunks is only re-tried once the buffer has
+       doubled, which keeps large entries linear.
+    4. The text before the series list is small (status, query, dates,
+       group_by); the series list itself is located with a pattern that
+       cannot match inside a JSON string (a quote in a string is always
+       escaped).
+
+"""
+import codecs
+import json
+import re
+
+_SERIES_START = re.compile(r'(?<!\\)"series"\s*:\s*\[')
+_SKIP = re.compile(r'[\s,]*')
+
+
+class SeriesParser(object):
+    """
+    Incremental parser of one query response.
+    """
+    def __init__(self):
+        super().__init__()
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._head = None           # text up to the series list
+        self._tail = None           # text after it
+        self._retry_at = 0          # buffer size worth another decode try
+        self.nbytes = 0
+        self.nseries = 0
+        self.npoints = 0
+
+    def feed(self, chunk):
+        """
+        Add part of the body.
+
+        :param chunk: bytes (or str)
+        :return: list of the series completed by this chunk
+        """
+        if isinstance(chunk, bytes):
+            self.nbytes += len(chunk)
+            chunk = self._text.decode(chunk)
+        else:
+            self.nbytes += len(chunk)
+        if self._tail is not None:
+            self._tail += chunk
+            return []
+        self._buffer += chunk
+        if self._head is None:
+            match = _SERIES_START.search(self._buffer)
+            if match is None:
+                return []
+            self._head = self._buffer[:match.end()]
+            self._buffer = self._buffer[match.end():]
+        return self._entries()
+
+    def _entries(self, final=False):
+        found = []
+        while self._tail is None:
+            pos = _SKIP.match(self._buffer).end()
+            if pos >= len(self._buffer):
+                self._buffer = ''
+                break
+            if self._buffer[pos] == ']':
+                self._tail = self._buffer[pos:]
+                self._buffer = ''
+                break
+            if not final and len(self._buffer) < self._retry_at:
+                break
+            try:
+                series, end = self._decoder.raw_decode(self._buffer, pos)
+            except ValueError:
+                if final:
+                    break
+                # incomplete entry, wait for the buffer to double
+                self._retry_at = 2 * len(self._buffer)
+                break
+            self._retry_at = 0
+            self._buffer = self._buffer[end:]
+            self.nseries += 1
+            try:
+                self.npoints += len(series.get('pointlist') or [])
+            except AttributeError:
+                pass
+            found.append(series)
+        return found
+
+    def flush(self):
+        """
+        End of the body: decode what is left of the series list.
+
+        :return: list of the remaining complete series
+        """
+        self._buffer += self._text.decode(b'', final=True)
+        if self._head is None:
+            return []
+        return self._entries(final=True)
+
+    def close(self):
+        """
+        Decode the rest of the response (after flush()).  Raises
+        ValueError if the body is not a complete response.
+
+        :return: the response without its series
+        """
+        if self._head is None:
+            return json.loads(self._buffer)
+        if self._tail is None:
+            raise ValueError("Truncated query response")
+        return json.loads(self._head + self._tail)
@@ -0,0 +1,175 @@
+"""
+Additional Influx sinks
+
+Note(s):
+    1. Requires Python 3
+    2. influx_sinks lists the Influx targets written to besides the
+       primary one (the influx_* parameters), as JSON or the name of a
+       JSON file:
+         [{"name": "dr", "host": "influx-dr", "database": "metrics"}, ...]
+       Keys left out are taken from the primary's influx_* parameters
+       (see SINK_KEYS); 'depth' and 'writers' size the sink's queue and
+       'overflow' (influx_sink_overflow) says what happens when it is
+       full.
+    3. Each series is fetched from Datadog once and handed to every sink.
+       A sink has its own InfluxHelper (batching, adaptive batch size,
+       retries) and its own writer threads behind a bounded queue.
+    4. A sink also has its own write-ahead spool, <spool_dir>/sink-<name>
+       (see spool.py), with its own drainer: batches the sink's Influx
+       fails are spooled and replayed as for the primary.
+    5. Series are queued on a sink without waiting.  While a sink is
+       'depth' series behind, further series ('overflow'):
+         spool: go to the sink's spool, replayed once it catches up, so
+                a slow sink lags rather than loses points (the default;
+                'block' when there is no spool_dir)
+         block: wait for the queue, stalling the export
+         drop:  are dropped for that sink
+                (exporter_sink_points_total{outcome="backlog"}); opt-in,
+                lossy: the sink keeps no checkpoint to catch up from
+    6. Only the primary sink moves the checkpoints and watermarks (where
+       the next run resumes from); lag is tracked per sink
+       (exporter_sink_lag_seconds).
+
+"""
+import json
+import os
+import queue
+
+import constants
+import influx_help
+import pipeline
+import spool
+import telemetry
+from commonpy.logger import Logger
+
+# Sink keys overriding the primary's influx_<key> parameters
+SINK_KEYS = ('host', 'port', 'database', 'user', 'password', 'timeout',
+             'precision', 'batch_size', 'batch_min', 'batch_max',
+             'write_latency', 'max_retries', 'backoff')
+QUEUE_KEYS = ('depth', 'writers', 'overflow')
+OVERFLOW_MODES = ('spool', 'block', 'drop')
+
+
+def parse_sinks(value):
+    """
+    Parse and check the influx_sinks setting.  Raises ValueError if it is
+    malformed.
+
+    :param value: JSON list of targets, name of a JSON file holding one,
+                  an already parsed list, or '' for none
+    :return: list of target dictionaries
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        text = value.strip()
+        if not text.startswith(('[', '{')):
+            with open(text, 'r') as source:
+                text = source.read()
+        value = json.loads(text)
+    if not isinstance(value, list):
+        raise ValueError("influx_sinks must be a list of Influx targets")
+    names = set([influx_help.PRIMARY_SINK])
+    for target in value:
+        if not isinstance(target, dict) or not target.get('name'):
+            raise ValueError("Influx sink without a name: {}".format(target))
+        unknown = set(target) - set(SINK_KEYS + QUEUE_KEYS + ('name',))
+        if unknown:
+            raise ValueError("Influx sink {}: unknown keys {}".format(
+                target['name'], ', '.join(sorted(unknown))))
+        if target.get('overflow', OVERFLOW_MODES[0]) not in OVERFLOW_MODES:
+            raise ValueError("Influx sink {}: overflow must be one of {}".format(
+                target['name'], ', '.join(OVERFLOW_MODES)))
+        if target['name'] in names:
+            raise ValueError("Duplicate Influx sink name: {}".format(
+                target['name']))
+        names.add(target['name'])
+    return value
+
+
+class Sink(object):
+    """
+    An additional Influx target with its own writers.
+    """
+    def __init__(self, target, params):
+        """
+        Create the sink's Influx helper and spool and start its writers.
+
+        :param target: target dictionary from parse_sinks()
+        :param params: the primary's parameters
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.name = target['name']
+        sink_params = dict(params)
+        sink_params.update(('influx_' + key, target[key])
+                           for key in SINK_KEYS if key in target)
+        self.helper = influx_help.InfluxHelper(sink_params, self.name)
+        self.drainer = None
+        if params.get('spool_dir'):
+            self.helper.spool = spool.Spool(
+                os.path.join(params['spool_dir'], 'sink-{}'.format(self.name)),
+                params.get('spool_segment_bytes',
+                           constants.DEFAULT_SPOOL_SEGMENT_BYTES))
+            self.drainer = spool.SpoolDrainer(
+                self.helper.spool, self.helper.write_lines,
+                params.get('spool_drain_interval',
+                           constants.DEFAULT_SPOOL_DRAIN_INTERVAL))
+        self.overflow = target.get('overflow', params.get(
+            'influx_sink_overflow', constants.DEFAULT_INFLUX_SINK_OVERFLOW))
+        if self.overflow not in OVERFLOW_MODES:
+            raise ValueError("Influx sink {}: overflow must be one of {}".format(
+                self.name, ', '.join(OVERFLOW_MODES)))
+        if self.overflow == 'spool' and self.drainer is None:
+            self.overflow = 'block'
+        self.backlog = 0
+        self.spooled = 0
+        self._behind = False
+        self.pipeline = pipeline.WritePipeline(
+            self.helper.send_points,
+            target.get('depth', params.get('influx_sink_depth',
+                                           constants.DEFAULT_INFLUX_SINK_DEPTH)),
+            target.get('writers', params.get('pipeline_writers',
+                                             constants.DEFAULT_PIPELINE_WRITERS)),
+            name='sink-{}'.format(self.name))
+
+    def put(self, metric, foundation_info, points, *args):
+        """
+        Queue a series for the sink; if the sink is too far behind spool
+        it, wait or drop it (as set by 'overflow').  Arguments as for
+        InfluxHelper.send_points().
+        """
+        try:
+            self.pipeline.put(metric, foundation_info, points, *args,
+                              block=self.overflow == 'block')
+        except queue.Full:
+            if not self._behind:
+                self._behind = True
+                self.logger.warning("Influx sink %s is behind, %s series "
+                                    "until it catches up", self.name,
+                                    'spooling' if self.overflow == 'spool'
+                                    else 'dropping')
+            if self.overflow == 'spool':
+                self.spooled += len(points)
+                self.helper.spool_points(metric, foundation_info, points, *args)
+            else:
+                self.backlog += len(points)
+                telemetry.SINK_POINTS.inc(len(points), self.name, 'backlog')
+        else:
+            if self._behind:
+                self._behind = False
+                self.logger.info("Influx sink %s caught up", self.name)
+
+    def close(self):
+        """
+        Wait for the queued series to be written, stop the writers and
+        make a last attempt at emptying the spool.
+        """
+        self.pipeline.close()
+        if self.drainer is not None:
+            self.drainer.close()
+            self.helper.spool.close()
+        self.logger.info("Influx sink %s: %d write errors, %d retries, "
+                         "%d points spooled and %d dropped as backlog",
+                         self.name, self.helper.errors, self.helper.retries,
+                         self.spooled, self.backlog)
@@ -0,0 +1,244 @@
+"""
+Influx write-ahead spool
+
+Note(s):
+    1. Requires Python 3
+    2. Encoded (line protocol) batches that cannot be written to Influx
+       go to an append-only spool on disk instead of being dropped.  The
+       spool is a directory of numbered segment files; a segment is
+       closed once it reaches segment_bytes and a new one is started.
+       Each record is a batch:
+         payload length (4 bytes), payload CRC32 (4 bytes), payload
+       where the payload is the batch's lines, newline separated, UTF-8.
+       Every append is fsync'd, so a spooled batch counts as committed
+       (checkpoints move past it).
+    3. While the spool holds anything, new batches are appended behind
+       it rather than tried against Influx: the Datadog fetch side keeps
+       going at full speed and Influx is not hit with a timeout per
+       batch.
+    4. A SpoolDrainer thread replays the segments, oldest first (read
+       through mmap where possible), and deletes each one once it is
+       fully written.  On a failure it backs off and retries later.  A
+       segment interrupted by a restart is replayed from its start; the
+       repeated points overwrite themselves in Influx.
+    5. A torn record at the end of a segment (crash during an append)
+       is detected by its length/CRC and dropped.
+
+"""
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from commonpy.logger import Logger
+
+# Record header: payload length, payload CRC32
+_HEADER = struct.Struct('>II')
+
+_SEGMENT = re.compile(r'^spool-(\d+)\.seg$')
+
+
+class Spool(object):
+    """
+    Append-only, segment rotated batch spool.
+    """
+    def __init__(self, directory, segment_bytes):
+        """
+        Open (creating if needed) the spool directory.  Segments left by
+        an earlier run are picked up for replay.
+
+        :param directory: spool directory
+        :param segment_bytes: segment size to rotate at
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.directory = directory
+        self.segment_bytes = int(segment_bytes)
+        self.appended = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted(int(match.group(1))
+                         for match in (_SEGMENT.match(name)
+                                       for name in os.listdir(directory))
+                         if match)
+        self._segments = [self._path(nbr) for nbr in numbers]
+        self._next = numbers[-1] + 1 if numbers else 0
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+        if self._segments:
+            self.logger.warning("Spool: %d segments to replay in %s",
+                                len(self._segments), directory)
+
+    def _path(self, number):
+        return os.path.join(self.directory, 'spool-{:012d}.seg'.format(number))
+
+    @property
+    def pending(self):
+        """
+        True while the spool holds batches not yet replayed.
+        """
+        with self._lock:
+            return bool(self._segments) or self._active is not None
+
+    def append(self, lines):
+        """
+        Append a batch, durably.
+
+        :param lines: list of line protocol strings
+        """
+        payload = '\n'.join(lines).encode('utf-8')
+        record = _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        with self._lock:
+            if self._active is None:
+                self._active_path = self._path(self._next)
+                self._next += 1
+                self._active = open(self._active_path, 'ab')
+                self._active_size = 0
+            self._active.write(record + payload)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self._active_size += len(record) + len(payload)
+            self.appended += 1
+            if self._active_size >= self.segment_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        if self._active is not None:
+            self._active.close()
+            self._segments.append(self._active_path)
+            self._active = None
+            self._active_path = None
+
+    def next_segment(self):
+        """
+        Get the oldest segment to replay, closing the active segment if
+        it is the only one left.
+
+        :return: segment path, or None if the spool is empty
+        """
+        with self._lock:
+            if not self._segments:
+                self._rotate()
+            return self._segments[0] if self._segments else None
+
+    def records(self, path):
+        """
+        Generator of the batches in a segment.
+
+        :param path: segment path
+        :return: generator of lists of line protocol strings
+        """
+        with open(path, 'rb') as segment:
+            try:
+                data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # empty file, or no mmap here
+                data = segment.read()
+            try:
+                offset = 0
+                while offset + _HEADER.size <= len(data):
+                    length, crc = _HEADER.unpack_from(data, offset)
+                    start = offset + _HEADER.size
+                    payload = data[start:start + length]
+                    if (len(payload) < length or
+                            zlib.crc32(payload) & 0xffffffff != crc):
+                        break
+                    yield payload.decode('utf-8').split('\n')
+                    offset = start + length
+                if offset < len(data):
+                    self.logger.warning("Spool: dropping torn record at %d "
+                                        "in %s", offset, path)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    def remove(self, path):
+        """
+        Delete a fully replayed segment.
+
+        :param path: segment path
+        """
+        with self._lock:
+            self._segments.remove(path)
+            os.remove(path)
+
+    def close(self):
+        """
+        Close the active segment (what is spooled stays on disk).
+        """
+        with self._lock:
+            self._rotate()
+
+
+class SpoolDrainer(object):
+    """
+    Background thread replaying the spool into Influx.
+    """
+    def __init__(self, spool, writer, interval, max_interval=60.0):
+        """
+        Start the drainer thread.
+
+        :param spool: the Spool
+        :param writer: function writing one batch (list of lines)
+        :param interval: seconds between checks of the spool
+        :param max_interval: longest back off after failures (seconds)
+        """
+        super().__init__()
+        self.logger = Logger().logger
+        self.spool = spool
+        self.writer = writer
+        self.interval = float(interval)
+        self.max_interval = max(float(max_interval), self.interval)
+        self.replayed = 0
+        self._progress = (None, 0)      # (segment, batches already written)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='spool-drainer',
+                                        daemon=True)
+        self._thread.start()
+
+    def drain(self):
+        """
+        Replay everything spooled, oldest first.
+
+        :return: True if the spool was emptied, False after a failure
+        """
+        while True:
+            path = self.spool.next_segment()
+            if path is None:
+                return True
+            records = self.spool.records(path)
+            try:
+                for nbr, lines in enumerate(records):
+                    if path == self._progress[0] and nbr < self._progress[1]:
+                        continue
+                    self.writer(lines)
+                    self.replayed += 1
+                    self._progress = (path, nbr + 1)
+            except Exception as exn:
+                self.logger.warning("Spool replay failed: %s", exn)
+                return False
+            finally:
+                records.close()
+            self.spool.remove(path)
+            self.logger.info("Spool: replayed %s", path)
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.wait(delay):
+            if self.spool.pending:
+                delay = (self.interval if self.drain()
+                         else min(delay * 2, self.max_interval))
+
+    def close(self, drain=True):
+        """
+        Stop the drainer thread.
+
+        :param drain: make a last attempt at emptying the spool
+        """
+        self._stop.set()
+        self._thread.join()
+        if drain and self.spool.pending:
+            self.drain()
@@ -0,0 +1,283 @@
+"""
+Exporter runtime metrics
+
+Note(s):
+    1. Requires Python 3
+    2. Counters, gauges and histograms for the hot path (Datadog fetches,
+       Influx writes, points in/out/dropped, per metric lag), exposed in
+       the Prometheus text format on http://<host>:<metrics_port>/metrics
+       when metrics_port is set (see serve()).
+    3. No client library: an update is a dictionary lookup and an add
+       under a lock, cheap enough to leave on under full load.
+    4. Metrics are per process: backfill worker processes are not
+       included.
+    5. The HTTP server modules are only imported by serve().
+
+"""
+from bisect import bisect_left
+import threading
+import time
+
+from commonpy.logger import Logger
+
+# Latency buckets (seconds) and batch size buckets (points)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+SIZE_BUCKETS = (1, 10, 100, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class _Metric(object):
+    """
+    Metric base: name, help, label names, per label values state.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__()
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        :return: list of exposition lines
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append('{}{} {!r}'.format(self.name,
+                                            _labels(self.labels, key),
+                                            float(value)))
+        return lines
+
+    def value(self, *labels):
+        """
+        Current value (for tests and reports).
+        """
+        return self._values.get(labels, 0)
+
+
+class Counter(_Metric):
+    """
+    Monotonic counter.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        """
+        :param amount: amount to add
+        :param labels: label values, in label name order
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    Cumulative bucket histogram.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets, labels=()):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """
+        :param value: observed value
+        :param labels: label values, in label name order
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per bucket counts (the last one +Inf), sum
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def value(self, *labels):
+        """
+        :return: (count, sum)
+        """
+        state = self._values.get(labels)
+        return (sum(state[0]), state[1]) if state else (0, 0.0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1]))
+                            for key, state in self._values.items())
+        names = self.labels + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(names, key + (bound,)), cumulative))
+            lines.append('{}_sum{} {!r}'.format(self.name,
+                                                _labels(self.labels, key),
+                                                total))
+            lines.append('{}_count{} {}'.format(self.name,
+                                                _labels(self.labels, key),
+                                                cumulative))
+        return lines
+
+
+class Lag(_Metric):
+    """
+    Per metric export lag: seconds between now and the oldest of the
+    metric's per foundry last written timestamps.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=()):
+        """
+        :param labels: label names before 'metric'
+        """
+        super().__init__(name, doc, tuple(labels) + ('metric',))
+        self._marks = {}        # labels + (metric,): {foundry: timestamp (ms)}
+
+    def mark(self, metric, foundry, timestamp, *labels):
+        """
+        :param timestamp: last written timestamp (ms)
+        :param labels: values of the labels before 'metric'
+        """
+        key = labels + (metric,)
+        with self._lock:
+            marks = self._marks.setdefault(key, {})
+            if timestamp > marks.get(foundry, timestamp - 1):
+                marks[foundry] = timestamp
+                self._values[key] = min(marks.values())
+
+    def render(self):
+        now = time.time()
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} gauge'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, oldest in values:
+            lines.append('{}{} {!r}'.format(self.name, _labels(self.labels, key),
+                                            max(0.0, now - oldest / 1000.0)))
+        return lines
+
+
+class Registry(object):
+    """
+    The set of exposed metrics.
+    """
+    def __init__(self):
+        super().__init__()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: the Prometheus text exposition of every metric
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+POINTS_FETCHED = REGISTRY.add(Counter(
+    'exporter_points_fetched_total', 'Points fetched from Datadog',
+    ('metric',)))
+POINTS_WRITTEN = REGISTRY.add(Counter(
+    'exporter_points_written_total', 'Points written (or spooled) to Influx',
+    ('metric',)))
+POINTS_DROPPED = REGISTRY.add(Counter(
+    'exporter_points_dropped_total', 'Points not written, by reason',
+    ('metric', 'reason')))
+DATADOG_REQUESTS = REGISTRY.add(Counter(
+    'exporter_datadog_requests_total', 'Datadog window fetches, by outcome',
+    ('outcome',)))
+DATADOG_FETCH_SECONDS = REGISTRY.add(Histogram(
+    'exporter_datadog_fetch_seconds', 'Datadog window fetch time',
+    LATENCY_BUCKETS))
+INFLUX_COMMIT_SECONDS = REGISTRY.add(Histogram(
+    'exporter_influx_commit_seconds', 'Influx write request time',
+    LATENCY_BUCKETS))
+INFLUX_BATCH_POINTS = REGISTRY.add(Histogram(
+    'exporter_influx_batch_points', 'Points per Influx write', SIZE_BUCKETS))
+INFLUX_WRITES = REGISTRY.add(Counter(
+    'exporter_influx_writes_total', 'Influx write requests, by outcome',
+    ('outcome',)))
+METRIC_LAG = REGISTRY.add(Lag(
+    'exporter_metric_lag_seconds',
+    'Age of the oldest per foundry last written point, per metric'))
+SINK_POINTS = REGISTRY.add(Counter(
+    'exporter_sink_points_total',
+    'Points per Influx sink, by outcome (written, dropped, backlog)',
+    ('sink', 'outcome')))
+SINK_LAG = REGISTRY.add(Lag(
+    'exporter_sink_lag_seconds',
+    'Age of the oldest per foundry last written point, per sink and metric',
+    ('sink',)))
+
+
+def serve(port, host='0.0.0.0', registry=REGISTRY):
+    """
+    Serve the metrics on a background thread.
+
+    :param port: port to listen on (0 for any free port)
+    :param host: address to listen on
+    :return: the HTTP server (server.server_address has the port)
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = Server((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    Logger().logger.info("Serving metrics on port %d", server.server_address[1])
+    return server
@@ -0,0 +1,248 @@
+"""
+Unit tests for the datadog-exporter asyncio engine, run against local
+stand-in Datadog and Influx HTTP servers.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from mock import patch, PropertyMock
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import async_engine
+import checkpoint
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """
+    Stand-in for both the Datadog query API and the Influx HTTP API.
+    """
+    foundries = ['px-prd01', 'px-prd02']
+    requests = []
+    writes = []
+    fail_from = None
+    npoints = 1
+    fail_writes = False
+    flaky = {}          # window start: statuses to reply before success
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = {key: val[0] for key, val in parse_qs(url.query).items()}
+        with self.lock:
+            self.requests.append((url.path, args, dict(self.headers)))
+        if url.path == '/api/v1/query':
+            start = int(args['from'])
+            if start == self.fail_from:
+                self._reply(400, {'errors': ['bad window']})
+                return
+            with self.lock:
+                status = (self.flaky.get(start) or [None]).pop(0)
+            if status is not None:
+                self.send_response(status)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            series = [{'scope': 'foundry:{}'.format(foundry),
+                       'pointlist': [[start * 1000.0 + nbr, 1.5]
+                                     for nbr in range(self.npoints)] +
+                                    [[start * 1000.0 + self.npoints, None]]}
+                      for foundry in self.foundries]
+            self._reply(200, {'status': 'ok', 'series': series})
+        elif url.path == '/query':
+            self._reply(200, {'results': [{'statement_id': 0}]})
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.fail_writes:
+            self._reply(500, {'error': 'down'})
+            return
+        with self.lock:
+            self.writes.append((parse_qs(url.query), body.decode()))
+        self._reply(204)
+
+
+class TestAsyncExporter(unittest.TestCase):
+    """
+    End to end run of the async engine against the stand-ins.
+    """
+    foundations = {'foundations': [{'foundry': 'px-prd01',
+                                    'environment': 'production',
+                                    'region': 'px 01',
+                                    'dc': 'Polaris',
+                                    'context': 'EIT'}]}
+
+    def setUp(self):
+        """
+        Start the stand-in server, patch out logging and parameters.
+        """
+        _StandIn.requests = []
+        _StandIn.writes = []
+        _StandIn.fail_from = None
+        _StandIn.npoints = 1
+        _StandIn.fail_writes = False
+        _StandIn.flaky = {}
+        self.server = _Server(('127.0.0.1', 0), _StandIn)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address
+        self.env_dict = {'foundations_file': 'found_file',
+                         'queries_file': 'query_file',
+                         'datadog_time_range': 100,
+                         'START_TIMESTAMP': 1000,
+                         'datadog_api_host': 'http://{}:{}'.format(host, port),
+                         'datadog_api_key': 'api',
+                         'datadog_app_key': 'app',
+                         'influx_host': host,
+                         'influx_port': port,
+                         'influx_database': 'db',
+                         'async_concurrency': 2,
+                        }
+        patch('commonpy.logger.Logger.logger').start()
+        patch('commonpy.parameters.SysParams.params',
+              new_callable=PropertyMock,
+              return_value=self.env_dict).start()
+        patch('time.time', return_value=1300).start()
+
+    def tearDown(self):
+        """
+        Stop the stand-in server and clean up patches.
+        """
+        patch.stopall()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _run(self, queries):
+        with patch('get_stats.Exporter.load_json_file',
+                   side_effect=[self.foundations, {'queries': queries}]):
+            return async_engine.AsyncExporter().run()
+
+    def testRunSuccess(self):
+        """
+        Every window is fetched and the known foundry's points written
+        """
+        res = self._run([{'metric': 'my metric', 'query': 'avg:x{*} by {foundry}'}])
+        self.assertEqual(res, 0)
+
+        dd_queries = sorted((args['from'], args['to'])
+                            for path, args, _ in _StandIn.requests
+                            if path == '/api/v1/query')
+        self.assertEqual(dd_queries, [('1000', '1100'), ('1100', '1200'),
+                                      ('1200', '1300')])
+        headers = [hdrs for path, _, hdrs in _StandIn.requests
+                   if path == '/api/v1/query'][0]
+        self.assertEqual(headers['DD-API-KEY'], 'api')
+
+        lines = sorted(body for _, body in _StandIn.writes)
+        self.assertEqual(lines[0],
+                         'my\\ metric,context=EIT,dc=Polaris,'
+                         'environment=production,foundry=px-prd01,'
+                         'region=px\\ 01 value=1.5 1000000')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(_StandIn.writes[0][0]['precision'], ['ms'])
+
+    def testRunBatches(self):
+        """
+        A window's lines are written in batches of the Influx batch size
+        """
+        _StandIn.npoints = 5
+        self.env_dict.update(influx_batch_size=2, influx_batch_min=2,
+                             influx_batch_max=2, datadog_time_range=300)
+        res = self._run([{'metric': 'm1', 'query': 'q1'}])
+        self.assertEqual(res, 0)
+        self.assertEqual([body.count('\n') + 1 for _, body in _StandIn.writes],
+                         [2, 2, 1])
+
+    def testRunCheckpointSpool(self):
+        """
+        Written windows are checkpointed, failed writes spooled and
+        replayed by the next run
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.env_dict.update(checkpoint_file=os.path.join(tmpdir, 'cp.db'),
+                             spool_dir=os.path.join(tmpdir, 'spool'))
+        _StandIn.fail_writes = True
+        self.assertEqual(self._run([{'metric': 'm1', 'query': 'q1'}]), 0)
+        self.assertEqual(_StandIn.writes, [])
+        with checkpoint.CheckpointStore(self.env_dict['checkpoint_file']) as store:
+            self.assertEqual(store.get('m1', 'px-prd01'), 1200000)
+
+        _StandIn.fail_writes = False
+        self.assertEqual(self._run([{'metric': 'm1', 'query': 'q1'}]), 0)
+        # the three spooled windows, then the three of this run
+        self.assertEqual(len(_StandIn.writes), 6)
+        self.assertEqual([body for _, body in _StandIn.writes[:3]],
+                         [body for _, body in _StandIn.writes[3:]])
+
+    def testRunSinksRejected(self):
+        """
+        The async engine does not run with additional sinks
+        """
+        self.env_dict['influx_sinks'] = [{'name': 'dr'}]
+        self.assertEqual(self._run([{'metric': 'm1', 'query': 'q1'}]), 1)
+        self.assertEqual(_StandIn.requests, [])
+
+    def testRunQueryFailure(self):
+        """
+        A query missing keys fails without stopping the others
+        """
+        res = self._run([{'metric': 'm1', 'query': 'q1'}, {'metric': 'm2'}])
+        self.assertEqual(res, 1)
+        self.assertEqual(len(_StandIn.writes), 3)
+
+    def testRunWindowFailure(self):
+        """
+        Windows are written in order, none after a failed window
+        """
+        _StandIn.fail_from = 1100
+        res = self._run([{'metric': 'm1', 'query': 'q1'}])
+        self.assertEqual(res, 1)
+        self.assertEqual(len(_StandIn.writes), 1)
+        self.assertTrue(_StandIn.writes[0][1].endswith(' 1000000'))
+
+    def testRunDatadogRetry(self):
+        """
+        Rate limited and failed Datadog queries are retried
+        """
+        _StandIn.flaky = {1000: [429], 1200: [503]}
+        res = self._run([{'metric': 'm1', 'query': 'q1'}])
+        self.assertEqual(res, 0)
+        dd_queries = [args['from'] for path, args, _ in _StandIn.requests
+                      if path == '/api/v1/query']
+        self.assertEqual(sorted(dd_queries),
+                         ['1000', '1000', '1100', '1200', '1200'])
+        self.assertEqual(len(_StandIn.writes), 3)
+
+    def testRunDatadogFailure(self):
+        """
+        Datadog errors fail the query
+        """
+        self.env_dict['datadog_api_host'] += '/nowhere'
+        res = self._run([{'metric': 'm1', 'query': 'q1'}])
+        self.assertEqual(res, 1)
+        self.assertEqual(_StandIn.writes, [])
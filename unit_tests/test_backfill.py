@@ -0,0 +1,154 @@
+"""
+Unit tests for the datadog-exporter backfill module
+"""
+from concurrent.futures import ThreadPoolExecutor
+from mock import patch, ANY, PropertyMock
+import os
+import shutil
+import tempfile
+import unittest
+
+import backfill
+import checkpoint
+
+
+class TestBackfill(unittest.TestCase):
+    """
+    Test the process pool backfill.
+    """
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.tmpdir = tempfile.mkdtemp()
+        self._env_dict = {'queries_file': 'queries',
+                          'foundations_file': 'foundations',
+                          'backfill_workers': 2,
+                          'backfill_chunk': 100,
+                         }
+        patch('commonpy.parameters.SysParams.params',
+              new_callable=PropertyMock,
+              return_value=self._env_dict).start()
+        self.queries = [{'metric': 'm1', 'query': 'q1'},
+                        {'metric': 'm2', 'query': 'q2'}]
+        self.mock_exporter = patch('get_stats.Exporter').start()
+        self.mock_exporter.return_value.load_json_file.return_value = \
+            {'queries': self.queries}
+        self.path = os.path.join(self.tmpdir, 'checkpoints.db')
+        self.mock_exporter.return_value.open_checkpoints.side_effect = \
+            lambda: checkpoint.CheckpointStore(self.path)
+        # threads stand in for processes (the mocks do not cross processes)
+        patch('backfill.ProcessPoolExecutor', ThreadPoolExecutor).start()
+        backfill._WORKER.clear()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+        shutil.rmtree(self.tmpdir)
+        backfill._WORKER.clear()
+
+    def testParseTime(self):
+        """
+        Backfill times are epoch seconds or UTC dates
+        """
+        self.assertEqual(backfill.parse_time('1479945600'), 1479945600)
+        self.assertEqual(backfill.parse_time('2016-11-24'), 1479945600)
+        self.assertEqual(backfill.parse_time('2016-11-24T01:00'), 1479949200)
+        with self.assertRaises(ValueError):
+            backfill.parse_time('yesterday')
+
+    def testSplitRange(self):
+        """
+        The range is split into chunks, the last one cut at the end
+        """
+        self.assertEqual(backfill.split_range(0, 250, 100),
+                         [(0, 100), (100, 200), (200, 250)])
+        self.assertEqual(backfill.split_range(10, 10, 100), [])
+
+    def testChunksResume(self):
+        """
+        Completed chunks are not done again
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            store.record_chunk('m1', 'q1', 0, 100)
+            store.record_chunk('m2', 'q2', 0, 300)
+            todo = backfill.Backfill(0, 300).chunks(
+                self.queries + [{'metric': 'bad'}], store)
+        self.assertEqual(todo, [('m1', 'q1', 100, 200), ('m1', 'q1', 200, 300)])
+
+    def testRun(self):
+        """
+        Every chunk is run and recorded; a second run has nothing to do
+        """
+        failed = []
+        def run_chunk(params, metric, query, start, end, query_rollup=None):
+            # m2's second chunk fails the first time
+            ok = failed or start != 100 or metric != 'm2'
+            if not ok:
+                failed.append(start)
+            return backfill.ChunkResult(metric, query, start, end, bool(ok),
+                                        10, 0.1, None)
+        with patch('backfill.run_chunk', side_effect=run_chunk) as mock_run:
+            self.assertEqual(backfill.Backfill(0, 200).run(), 1)
+            self.assertEqual(mock_run.call_count, 4)
+            mock_run.reset_mock()
+            self.assertEqual(backfill.Backfill(0, 200).run(), 0)
+            mock_run.assert_called_once_with(ANY, 'm2', 'q2',
+                                             100, 200, query_rollup=None)
+
+    def testWorkerParams(self):
+        """
+        The workers share the Datadog rate limit and burst
+        """
+        self._env_dict.update(datadog_rate_limit=1600, datadog_rate_burst=10)
+        bfill = backfill.Backfill(0, 200)
+        with patch('backfill.run_chunk',
+                   return_value=backfill.ChunkResult('m1', 'q1', 0, 100, True,
+                                                     0, 0.1, None)) as mock_run:
+            bfill.run()
+        params = mock_run.call_args[0][0]
+        self.assertEqual((params['datadog_rate_limit'],
+                          params['datadog_rate_burst'],
+                          params['datadog_rate_share']), (800, 5, 0.5))
+        self.assertEqual(self._env_dict['datadog_rate_limit'], 1600)
+        self._env_dict['backfill_workers'] = 20
+        self.assertEqual(backfill.Backfill(0, 200).worker_params()
+                         ['datadog_rate_burst'], 1)
+
+    def testRunBadQueries(self):
+        """
+        A queries file without queries fails the run
+        """
+        self.mock_exporter.return_value.load_json_file.return_value = {}
+        self.assertEqual(backfill.Backfill(0, 200).run(), 1)
+
+    def testRunChunk(self):
+        """
+        run_chunk() fetches its range once per chunk, reusing the worker's
+        exporter, and counts the points written
+        """
+        exporter = self.mock_exporter.return_value
+        exporter.datadog.errors = 0
+        exporter.helper.errors = 0
+        exporter.helper.send_points.return_value = 3
+        def fetch(start, metric, query, foundation_info, send, end_time=None,
+                  query_rollup=None):
+            send(metric, ('f1', {}), [[1, 1]], None)
+            send(metric, ('f2', {}), [[1, 1]], None)
+        exporter.fetch_results.side_effect = fetch
+
+        res = backfill.run_chunk(self._env_dict, 'm1', 'q1', 0, 100)
+        self.assertEqual(res[:6], ('m1', 'q1', 0, 100, True, 6))
+        exporter.fetch_results.assert_called_once_with(
+            0, 'm1', 'q1', exporter.load_foundations.return_value,
+            ANY, end_time=100, query_rollup=None)
+
+        def failing_fetch(*args, **kwargs):
+            exporter.helper.errors += 1
+        exporter.fetch_results.side_effect = failing_fetch
+        res = backfill.run_chunk(self._env_dict, 'm1', 'q1', 100, 200)
+        self.assertFalse(res.ok)
+        self.mock_exporter.assert_called_once_with()
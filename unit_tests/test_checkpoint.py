@@ -0,0 +1,87 @@
+"""
+Unit tests for the datadog-exporter checkpoint module
+"""
+from mock import patch
+import os
+import shutil
+import tempfile
+import unittest
+
+import checkpoint
+
+
+class TestCheckpointStore(unittest.TestCase):
+    """
+    Test the SQLite checkpoint store.
+    """
+    def setUp(self):
+        """
+        Test setups: temporary database, patch out logging.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'checkpoints.db')
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up patches and the database.
+        """
+        patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def testRecordAndGet(self):
+        """
+        A recorded checkpoint can be read back
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            self.assertIsNone(store.get('m', 'f'))
+            store.record('m', 'f', 1000)
+            self.assertEqual(store.get('m', 'f'), 1000)
+
+    def testForwardOnly(self):
+        """
+        Checkpoints never move back
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            store.record('m', 'f', 1000)
+            store.record('m', 'f', 500)
+            self.assertEqual(store.get('m', 'f'), 1000)
+            store.record('m', 'f', 2000)
+            self.assertEqual(store.get('m', 'f'), 2000)
+
+    def testDurable(self):
+        """
+        Checkpoints survive closing and reopening the store
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            store.record('m1', 'f1', 1000)
+            store.record('m1', 'f2', 2000)
+            store.record('m2', 'f1', 3000)
+        with checkpoint.CheckpointStore(self.path) as store:
+            self.assertEqual(store.load(['m1', 'm3']),
+                             {('m1', 'f1'): 1000, ('m1', 'f2'): 2000})
+            self.assertEqual(store.load([]), {})
+
+    def testWindows(self):
+        """
+        Window sizes are remembered per query
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            self.assertIsNone(store.get_window('q1'))
+            store.record_window('q1', 3600)
+            store.record_window('q1', 7200)
+        with checkpoint.CheckpointStore(self.path) as store:
+            self.assertEqual(store.get_window('q1'), 7200)
+
+    def testBackfillChunks(self):
+        """
+        Completed backfill chunks are kept per metric/query pair
+        """
+        with checkpoint.CheckpointStore(self.path) as store:
+            store.record_chunk('m', 'q', 200, 300, 5)
+            store.record_chunk('m', 'q', 100, 200, 5)
+            store.record_chunk('m', 'other', 0, 100)
+        with checkpoint.CheckpointStore(self.path) as store:
+            self.assertEqual(store.done_chunks('m', 'q'),
+                             [(100, 200), (200, 300)])
+            self.assertEqual(store.done_chunks('x', 'q'), [])
@@ -0,0 +1,83 @@
+"""
+Unit tests for the datadog-exporter config_snapshot module
+"""
+from mock import patch
+import os
+import shutil
+import tempfile
+import unittest
+
+import config_snapshot
+
+
+class TestConfigSnapshot(unittest.TestCase):
+    """
+    Test saving, loading and invalidating snapshots.
+    """
+    tag_sets = {'f1': {'foundry': 'f1', 'dc': 'd'}}
+    queries = [{'metric': 'm', 'query': 'q'}]
+
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        self.mock_logger = patch('commonpy.logger.Logger.logger').start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source.json')
+        with open(self.source, 'w') as out:
+            out.write('{}')
+        self.snapshot = config_snapshot.ConfigSnapshot(
+            os.path.join(self.tmpdir, 'snap'))
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def testRoundTrip(self):
+        """
+        A saved snapshot loads back while the sources are unchanged
+        """
+        key = config_snapshot.source_key([self.source])
+        self.assertIsNone(self.snapshot.load(key))
+        self.snapshot.save(key, self.tag_sets, self.queries)
+        self.assertEqual(self.snapshot.load(key),
+                         (self.tag_sets, self.queries))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['snap', 'source.json'])
+
+    def testSourceChanged(self):
+        """
+        A snapshot of other source contents is not used
+        """
+        key = config_snapshot.source_key([self.source])
+        self.snapshot.save(key, self.tag_sets, self.queries)
+        with open(self.source, 'w') as out:
+            out.write('{"queries": []}')
+        self.assertIsNone(self.snapshot.load(
+            config_snapshot.source_key([self.source])))
+
+    def testInvalid(self):
+        """
+        Corrupt snapshots and snapshots of the wrong shape are ignored
+        """
+        key = config_snapshot.source_key([self.source])
+        with open(self.snapshot.path, 'wb') as out:
+            out.write(b'not a pickle')
+        self.assertIsNone(self.snapshot.load(key))
+        self.mock_logger.warning.assert_called_once()
+        self.snapshot.save(key, self.tag_sets, 'not a list')
+        self.assertIsNone(self.snapshot.load(key))
+        with patch('config_snapshot.SNAPSHOT_VERSION', 2):
+            self.snapshot.save(key, self.tag_sets, self.queries)
+        self.assertIsNone(self.snapshot.load(key))
+
+    def testSaveFailure(self):
+        """
+        A snapshot that cannot be written is logged, not raised
+        """
+        snapshot = config_snapshot.ConfigSnapshot(
+            os.path.join(self.tmpdir, 'missing', 'snap'))
+        snapshot.save([], self.tag_sets, self.queries)
+        self.mock_logger.warning.assert_called_once()
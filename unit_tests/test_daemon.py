@@ -0,0 +1,115 @@
+"""
+Unit tests for the datadog-exporter daemon module
+"""
+from mock import patch, MagicMock, PropertyMock
+import threading
+import time
+import unittest
+
+import daemon
+import get_stats
+
+
+class TestDaemon(unittest.TestCase):
+    """
+    Test the per query polling scheduler.
+    """
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self._env_dict = {'poll_interval': 0.05,
+                          'poll_jitter': 0.2,
+                          'poll_lookback': 60,
+                          'query_workers': 2,
+                         }
+        patch('commonpy.parameters.SysParams.params',
+              new_callable=PropertyMock,
+              return_value=self._env_dict).start()
+        self.exporter = MagicMock()
+        self.exporter.stopping = threading.Event()
+        self.queries = [{'metric': 'm1', 'query': 'q1'},
+                        {'metric': 'm2', 'query': 'q2', 'interval': 3600}]
+        self.exporter.prepare.return_value = ('fnd', self.queries)
+        def timed_query(qnbr, query, foundation_info, start_time=None):
+            return get_stats.QueryResult(qnbr, query['metric'], True,
+                                         0.0, 1, None)
+        self.exporter._timed_query.side_effect = timed_query
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def serve_for(self, dmn, seconds):
+        thread = threading.Thread(target=dmn.serve)
+        thread.start()
+        time.sleep(seconds)
+        dmn.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def testPollsOnInterval(self):
+        """
+        Each query is polled on its own interval, the exporter is only
+        prepared once and is closed on stop
+        """
+        dmn = daemon.Daemon(self.exporter)
+        self.serve_for(dmn, 0.4)
+        qnbrs = [args[0][0] for args in self.exporter._timed_query.call_args_list]
+        self.assertGreater(qnbrs.count(1), 2)
+        self.assertEqual(qnbrs.count(2), 1)
+        self.exporter.prepare.assert_called_once_with()
+        self.exporter.close.assert_called_once_with()
+
+    def testIncrementalStart(self):
+        """
+        The first pass starts at the watermark, later passes at the end of
+        the previous pass less the lookback
+        """
+        dmn = daemon.Daemon(self.exporter)
+        with patch('daemon.time.time', return_value=10000):
+            dmn.tick(1, self.queries[0], 'fnd')
+            dmn.tick(1, self.queries[0], 'fnd')
+        starts = [args[0][3] for args in self.exporter._timed_query.call_args_list]
+        self.assertEqual(starts, [None, 10000 - 60])
+
+    def testFailedPassRetried(self):
+        """
+        A failed pass does not move the next start
+        """
+        self.exporter._timed_query.side_effect = None
+        self.exporter._timed_query.return_value = get_stats.QueryResult(
+            1, 'm1', False, 0.0, 0, 'boom')
+        dmn = daemon.Daemon(self.exporter)
+        dmn.tick(1, self.queries[0], 'fnd')
+        dmn.tick(1, self.queries[0], 'fnd')
+        starts = [args[0][3] for args in self.exporter._timed_query.call_args_list]
+        self.assertEqual(starts, [None, None])
+
+    def testBadQueriesFile(self):
+        """
+        serve() fails if the queries cannot be loaded
+        """
+        self.exporter.prepare.return_value = None
+        self.assertEqual(daemon.Daemon(self.exporter).serve(), 1)
+
+    def testClosedOnError(self):
+        """
+        The exporter is closed when the polling loop fails
+        """
+        dmn = daemon.Daemon(self.exporter)
+        with patch.object(dmn, '_next_query', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                dmn.serve()
+        self.exporter.close.assert_called_once()
+
+    def testSignalStops(self):
+        """
+        The signal handler stops the daemon
+        """
+        dmn = daemon.Daemon(self.exporter)
+        dmn.stop(15, None)
+        self.assertTrue(self.exporter.stopping.is_set())
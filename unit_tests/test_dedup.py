@@ -0,0 +1,74 @@
+"""
+Unit tests for the datadog-exporter dedup module
+"""
+import unittest
+
+import dedup
+import pointlist
+import watermarks
+
+
+class TestDeduplicator(unittest.TestCase):
+    """
+    Test the watermark and window overlap trimming.
+    """
+    def testWatermark(self):
+        """
+        Points at or below the series watermark are dropped and counted
+        """
+        marks = watermarks.Watermarks({('m', 'f1'): 2000})
+        deduper = dedup.Deduplicator(marks)
+        points = [[1000.0, 1], [2000.0, 2], [3000.0, 3]]
+        self.assertEqual(deduper.trim('m', 'f1', points), [[3000.0, 3]])
+        self.assertIs(deduper.trim('m', 'f2', points), points)
+        stats = deduper.stats
+        self.assertEqual((stats.kept, stats.watermark, stats.overlap),
+                         (4, 2, 0))
+
+    def testOverlap(self):
+        """
+        Points already handed on by the previous window are dropped
+        """
+        marks = watermarks.Watermarks({('m', 'f1'): 1000})
+        stats = dedup.DedupStats()
+        deduper = dedup.Deduplicator(marks, stats)
+        deduper.trim('m', 'f1', [[1000.0, 1], [2000.0, 2], [3000.0, 3]])
+        self.assertEqual(deduper.trim('m', 'f1', [[1000.0, 1], [3000.0, 3],
+                                                  [4000.0, 4]]),
+                         [[4000.0, 4]])
+        self.assertEqual(deduper.trim('m', 'f1', []), [])
+        self.assertEqual((stats.kept, stats.watermark, stats.overlap),
+                         (3, 2, 1))
+
+    def testNoOverlapTracking(self):
+        """
+        Without overlap tracking only the watermarks trim
+        """
+        deduper = dedup.Deduplicator(watermarks.Watermarks(),
+                                     track_overlap=False)
+        points = [[1000.0, 1]]
+        deduper.trim('m', 'f1', points)
+        self.assertEqual(deduper.trim('m', 'f1', points), points)
+
+    def testMalformed(self):
+        """
+        Malformed points are passed on untouched
+        """
+        deduper = dedup.Deduplicator(watermarks.Watermarks({('m', 'f'): 7}))
+        self.assertEqual(deduper.trim('m', 'f', ['123']), ['123'])
+
+    def testSeries(self):
+        """
+        A pointlist.Series is trimmed like a point list
+        """
+        marks = watermarks.Watermarks({('m', 'f1'): 1000})
+        deduper = dedup.Deduplicator(marks)
+        deduper.trim('m', 'f1', pointlist.Series.from_points(
+            [[1000.0, 1], [2000.0, 2]]))
+        trimmed = deduper.trim('m', 'f1', pointlist.Series.from_points(
+            [[1000.0, 1], [2000.0, 2], [3000.0, 3]]))
+        self.assertIsInstance(trimmed, pointlist.Series)
+        self.assertEqual(trimmed, [[3000, 3.0]])
+        stats = deduper.stats
+        self.assertEqual((stats.kept, stats.watermark, stats.overlap),
+                         (2, 2, 1))
@@ -1,8 +1,12 @@
 """
 Unit tests for the datadog-exporter dogger module
 """
+import json
 from mock import patch, MagicMock, PropertyMock
 import pytest
+import shutil
+import tempfile
+import time
 import unittest
 
 import dogger
@@ -23,7 +27,6 @@ class TestObject(unittest.TestCase):
         patch('commonpy.parameters.SysParams.params',
               new_callable=PropertyMock,
               return_value=self._env_dict).start()
-        self.mock_dog = patch('datadog.initialize').start()
 
     def tearDown(self):
         """
@@ -31,16 +34,24 @@ class TestObject(unittest.TestCase):
         """
         patch.stopall()
 
+    def query_response(self, result, status=200, headers=None):
+        body = json.dumps(result).encode()
+        return MagicMock(status_code=status, headers=headers or {},
+                         content=body, text=body.decode(),
+                         json=MagicMock(return_value=result))
+
+    def patch_get(self, *results, **kwargs):
+        return patch('requests.Session.get',
+                     side_effect=[self.query_response(result, **kwargs)
+                                  for result in results])
+
     def testInit(self):
         """
         Test the initializer.
         """
-        init_opts = {'api_key': self._env_dict['datadog_api_key'],
-                     'app_key': self._env_dict['datadog_app_key'],
-                    }
-
-        dogger.Dogger()
-        self.mock_dog.assert_called_once_with(**init_opts)
+        dogobj = dogger.Dogger()
+        self.assertEqual(dogobj.api_host, 'https://api.datadoghq.com')
+        self.assertFalse(dogobj.streaming)
 
     def testMetricsSuccess(self):
         """
@@ -48,42 +59,220 @@ class TestObject(unittest.TestCase):
         """
         data = [1, 2, 3, 4]
         metrics = {'series': data}
-        with patch('datadog.initialize') as mock_dog, \
-             patch('datadog.api.metrics.Metric.query',
-                   return_value=metrics) as mock_query, \
-             patch('commonpy.parameters.SysParams.params',
-                   new_callable=PropertyMock,
-                   return_value=self._env_dict):
+        with self.patch_get(metrics) as mock_get:
             dogobj = dogger.Dogger()
-            res = [x for x in dogobj.metrics('start', 'end', 'query')]
-        mock_query.assert_called_once_with(start='start',
-                                           end='end',
-                                           query='query')
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        self.assertEqual(mock_get.call_args[1]['params'],
+                         {'from': 10, 'to': 20, 'query': 'query'})
+        self.assertEqual(mock_get.call_args[1]['headers'],
+                         {'DD-API-KEY': 'datadog api key',
+                          'DD-APPLICATION-KEY': 'datadog app key'})
+        self.assertFalse(mock_get.call_args[1]['stream'])
         self.assertEqual(data, res)
 
     def testMetricsQueryExcept(self):
         """
         Test the metrics function with datadog query exception
         """
-        with patch('datadog.api.Metric.query',
-                   side_effect=Exception) as mock_query:
+        with patch('requests.Session.get',
+                   side_effect=Exception) as mock_get:
             dogobj = dogger.Dogger()
-            res = [x for x in dogobj.metrics('start', 'end', 'query')]
-        mock_query.assert_called_once_with(start='start',
-                                           end='end',
-                                           query='query')
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        mock_get.assert_called_once()
         self.assertEqual([], res)
 
     def testMetricsNoSeries(self):
         """
         Test the metrics function with datadog query returning not a series
         """
-        with patch('datadog.api.Metric.query',
-                   side_effect=[{'a': 1},]) as mock_query:
+        with self.patch_get({'a': 1}) as mock_get:
             dogobj = dogger.Dogger()
-            res = [x for x in dogobj.metrics('start', 'end', 'query')]
-
-        mock_query.assert_called_once_with(start='start',
-                                           end='end',
-                                           query='query')
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        mock_get.assert_called_once()
         self.assertEqual([], res)
+
+    def testMetricsStats(self):
+        """
+        Test the metrics function filling in query statistics
+        """
+        metrics = {'series': [{'pointlist': [[1, 2], [3, 4]]},
+                              {'pointlist': [[1, 2]]}]}
+        stats = {}
+        with self.patch_get(metrics):
+            dogobj = dogger.Dogger()
+            res = [x for x in dogobj.metrics(10, 20, 'query', stats)]
+        self.assertEqual(len(res), 2)
+        self.assertEqual(stats['series'], 2)
+        self.assertEqual(stats['points'], 3)
+        self.assertEqual(stats['bytes'], len(json.dumps(metrics)))
+        self.assertNotIn('error', stats)
+
+    def testMetricsStatsError(self):
+        """
+        Test the metrics function statistics on a failed query
+        """
+        stats = {}
+        with patch('requests.Session.get', side_effect=Exception):
+            dogobj = dogger.Dogger()
+            res = [x for x in dogobj.metrics(10, 20, 'query', stats)]
+        self.assertEqual(res, [])
+        self.assertTrue(stats['error'])
+
+    def testMetricsHeaders(self):
+        """
+        Test the metrics function passing the rate limit headers to the
+        scheduler
+        """
+        metrics = {'series': [{'pointlist': [[1, 2]]}]}
+        headers = {'X-RateLimit-Remaining': '5'}
+        with self.patch_get(metrics, headers=headers):
+            dogobj = dogger.Dogger()
+            dogobj.scheduler.update = MagicMock()
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        self.assertEqual(res, metrics['series'])
+        dogobj.scheduler.update.assert_called_once_with(headers)
+
+    def testMetricsRateLimitRetry(self):
+        """
+        Test the metrics function retrying a rate limited query after the
+        delay the server asks for
+        """
+        limited = self.query_response(
+            {'errors': ['Rate limit of 300 requests in 3600 seconds reached']},
+            429, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '42'})
+        with patch('requests.Session.get',
+                   side_effect=[limited,
+                                self.query_response({'series': [1]})]) as mock_get, \
+             patch('ratelimit.time.sleep') as mock_sleep:
+            dogobj = dogger.Dogger()
+            dogobj.scheduler.pause = MagicMock()
+            dogobj.scheduler.update = MagicMock()
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        self.assertEqual(mock_get.call_count, 2)
+        mock_sleep.assert_called_once()
+        self.assertGreaterEqual(dogobj.scheduler.pause.call_args[0][0], 42)
+        dogobj.scheduler.update.assert_any_call(limited.headers)
+        self.assertEqual(res, [1])
+
+    def testMetricsTransientRetry(self):
+        """
+        Test the metrics function retrying connection errors, timeouts and
+        server errors
+        """
+        import requests
+        with patch('requests.Session.get',
+                   side_effect=[requests.exceptions.ConnectionError('reset'),
+                                requests.exceptions.Timeout('slow'),
+                                self.query_response({}, 503),
+                                self.query_response({'series': [1]})]) as mock_get, \
+             patch('ratelimit.time.sleep'):
+            dogobj = dogger.Dogger()
+            res = [x for x in dogobj.metrics(10, 20, 'query')]
+        self.assertEqual(mock_get.call_count, 4)
+        self.assertEqual((res, dogobj.errors), ([1], 0))
+
+    def testMetricsErrorNotRetried(self):
+        """
+        Test the metrics function with a (non rate limit) error response
+        """
+        for status in (200, 400):
+            with self.patch_get({'errors': ['bad query']},
+                                status=status) as mock_get:
+                dogobj = dogger.Dogger()
+                res = [x for x in dogobj.metrics(10, 20, 'query')]
+            mock_get.assert_called_once()
+            self.assertEqual(res, [])
+
+    def testMetricsCache(self):
+        """
+        Test the metrics function with a response cache: a settled window
+        is only asked for once
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with patch.dict(self._env_dict, {'datadog_cache_dir': tmpdir}), \
+             self.patch_get(*[{'series': [1]}] * 3) as mock_get:
+            dogobj = dogger.Dogger()
+            for _ in range(2):
+                res = [x for x in dogobj.metrics(0, 100, 'query')]
+                self.assertEqual(res, [1])
+            now = int(time.time())
+            [x for x in dogobj.metrics(now - 100, now, 'query')]
+            [x for x in dogobj.metrics(now - 100, now, 'query')]
+        self.assertEqual(mock_get.call_count, 3)
+        # the unsettled windows are not looked up
+        self.assertEqual((dogobj.cache.hits, dogobj.cache.misses), (1, 1))
+
+    def testMetricsCacheWriteFailure(self):
+        """
+        Test the metrics function: a failed cache write does not fail the
+        window
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with patch.dict(self._env_dict, {'datadog_cache_dir': tmpdir}), \
+             patch('response_cache.ResponseCache.put', side_effect=OSError), \
+             self.patch_get({'series': [1]}):
+            dogobj = dogger.Dogger()
+            res = [x for x in dogobj.metrics(0, 100, 'query')]
+        self.assertEqual(res, [1])
+        self.assertEqual(dogobj.errors, 0)
+
+    def stream_response(self, body, status=200, headers=None):
+        response = MagicMock(status_code=status, headers=headers or {},
+                             text=body.decode())
+        response.iter_content.side_effect = lambda size: (
+            body[offset:offset + 5] for offset in range(0, len(body), 5))
+        return response
+
+    def testStreamMetrics(self):
+        """
+        Test the metrics function in streaming mode
+        """
+        series = [{'scope': 'foundry:a', 'pointlist': [[1, 2], [3, 4]]},
+                  {'scope': 'foundry:b', 'pointlist': [[5, 6]]}]
+        body = json.dumps({'status': 'ok', 'series': series}).encode()
+        response = self.stream_response(body, headers={'X-RateLimit-Remaining': '5'})
+        stats = {}
+        with patch.dict(self._env_dict, {'datadog_response_mode': 'streaming'}), \
+             patch('requests.Session.get', return_value=response) as mock_get:
+            dogobj = dogger.Dogger()
+            dogobj.scheduler.update = MagicMock()
+            res = [x for x in dogobj.metrics(10, 20, 'query', stats)]
+        self.assertEqual(res, series)
+        self.assertEqual(mock_get.call_args[1]['params'],
+                         {'from': 10, 'to': 20, 'query': 'query'})
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        dogobj.scheduler.update.assert_called_once_with(response.headers)
+        response.close.assert_called_once()
+        self.assertEqual((stats['series'], stats['points'], stats['bytes']),
+                         (2, 3, len(body)))
+
+    def testStreamMetricsErrors(self):
+        """
+        Test the metrics function in streaming mode: a rate limited query
+        is retried, an error response and a truncated body fail the query
+        """
+        series = [{'scope': 'foundry:a', 'pointlist': [[1, 2]]}]
+        body = json.dumps({'series': series}).encode()
+        with patch.dict(self._env_dict, {'datadog_response_mode': 'streaming'}), \
+             patch('requests.Session.get') as mock_get, \
+             patch('ratelimit.time.sleep'):
+            dogobj = dogger.Dogger()
+            dogobj.scheduler.pause = MagicMock()
+            mock_get.side_effect = [self.stream_response(b'{"errors": []}', 429),
+                                    self.stream_response(body)]
+            self.assertEqual([x for x in dogobj.metrics(0, 1, 'q')], series)
+
+            mock_get.side_effect = [self.stream_response(
+                b'{"errors": ["bad query"]}', 400)]
+            stats = {}
+            self.assertEqual([x for x in dogobj.metrics(0, 1, 'q', stats)], [])
+            self.assertTrue(stats['error'])
+
+            mock_get.side_effect = [self.stream_response(body[:-2])]
+            stats = {}
+            self.assertEqual([x for x in dogobj.metrics(0, 1, 'q', stats)],
+                             series)
+            self.assertTrue(stats['error'])
+        self.assertEqual(dogobj.errors, 2)
@@ -0,0 +1,94 @@
+"""
+Unit tests for the datadog-exporter foundry index module
+"""
+from mock import patch
+import unittest
+
+import foundry_index
+
+
+class TestFoundryIndex(unittest.TestCase):
+    """
+    Test the foundry name to tag set index.
+    """
+    source_info = {'foundations': [{'foundry': 'px-prd01',
+                                    'environment': 'production',
+                                    'region': 'px-01',
+                                    'dc': 'Polaris',
+                                    'context': 'EIT',
+                                    'extra': 'ignored'},
+                                   {'foundry': 'px-prd02',
+                                    'environment': 'production'},
+                                  ]}
+
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        self.mock_logger = patch('commonpy.logger.Logger.logger').start()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def testLookupFound(self):
+        """
+        A known foundry returns its tag set
+        """
+        index = foundry_index.FoundryIndex(self.source_info)
+        self.assertEqual(dict(index.lookup('px-prd01')),
+                         {'foundry': 'px-prd01',
+                          'environment': 'production',
+                          'region': 'px-01',
+                          'dc': 'Polaris',
+                          'context': 'EIT'})
+        self.assertIn('px-prd01', index)
+
+    def testTagsReadOnly(self):
+        """
+        Tag sets cannot be modified
+        """
+        tags = foundry_index.FoundryIndex(self.source_info).lookup('px-prd01')
+        with self.assertRaises(TypeError):
+            tags['dc'] = 'elsewhere'
+
+    def testMalformedEntrySkipped(self):
+        """
+        An entry missing tags is logged and left out of the index
+        """
+        index = foundry_index.FoundryIndex(self.source_info)
+        self.assertEqual(len(index), 1)
+        self.assertNotIn('px-prd02', index)
+        self.mock_logger.error.assert_called_once()
+
+    def testMissingLoggedOnce(self):
+        """
+        Unknown foundries are logged once, however often looked up
+        """
+        index = foundry_index.FoundryIndex(self.source_info)
+        self.mock_logger.reset_mock()
+        for _ in range(5):
+            self.assertIsNone(index.lookup('nowhere'))
+        self.mock_logger.error.assert_called_once()
+        self.assertEqual(index.missing, frozenset(['nowhere']))
+
+    def testMalformedFile(self):
+        """
+        A file without a foundations list raises KeyError
+        """
+        with self.assertRaises(KeyError):
+            foundry_index.FoundryIndex({'foo': []})
+
+    def testTagSets(self):
+        """
+        Compiled tag sets round trip through plain dictionaries
+        """
+        index = foundry_index.FoundryIndex(self.source_info)
+        tag_sets = index.tag_sets()
+        self.assertIsInstance(tag_sets['px-prd01'], dict)
+        copy = foundry_index.FoundryIndex.from_tag_sets(tag_sets)
+        self.assertEqual(copy.lookup('px-prd01'), index.lookup('px-prd01'))
+        with self.assertRaises(TypeError):
+            copy.lookup('px-prd01')['dc'] = 'elsewhere'
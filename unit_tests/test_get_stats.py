@@ -1,12 +1,21 @@
 """
 Unit tests for the datadog-exporter get_stats module
 """
+import json
 from mock import patch, MagicMock, PropertyMock, mock_open, call
+import os
 import pytest
+import shutil
+import tempfile
 import unittest
 
+import dogger
+import foundry_index
 import influx_help
 import get_stats
+import planner
+import rollup
+import watermarks
 
 
 class TestSupportFunctions(unittest.TestCase):
@@ -20,6 +29,8 @@ class TestSupportFunctions(unittest.TestCase):
         patch('commonpy.logger.Logger.logger').start()
         patch('commonpy.parameters.SysParams.params',
               new_callable=PropertyMock).start()
+        patch('get_stats.Exporter.make_clients',
+              return_value=(MagicMock(), MagicMock())).start()
 
     def tearDown(self):
         """
@@ -71,6 +82,24 @@ class TestSupportFunctions(unittest.TestCase):
         self.assertEqual(foundry, None)
         self.assertEqual(info, {})
 
+    def testGetFoundationObjectIndex(self):
+        """
+        Test get_foundation_object with a compiled FoundryIndex
+        """
+        source_info = {"foundations": [{"foundry": "mumble1",
+                                        "environment": "env",
+                                        "dc": "dc",
+                                        "region": "region",
+                                        "context": "context",
+                                       }]}
+        index = foundry_index.FoundryIndex(source_info)
+        exporter = get_stats.Exporter()
+        foundry, info = exporter.get_foundation_object("mumble1", index)
+        self.assertEqual(foundry, "mumble1")
+        self.assertEqual(info['dc'], "dc")
+        self.assertEqual(exporter.get_foundation_object("foobar", index),
+                         (None, {}))
+
     def testLoadJsonSuccess(self):
         """
         Test load_json_file (success)
@@ -106,6 +135,38 @@ class TestSupportFunctions(unittest.TestCase):
         mk_open.assert_called_once_with('some_filename', 'r')
 
 
+    def testLoadConfigSnapshot(self):
+        """
+        Test load_config: the files are parsed once, then read from the
+        snapshot until they change
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        files = {'foundations_file': os.path.join(tmpdir, 'foundations.json'),
+                 'queries_file': os.path.join(tmpdir, 'queries.json')}
+        foundry = {'foundry': 'f1', 'environment': 'e', 'dc': 'd',
+                   'region': 'r', 'context': 'c'}
+        with open(files['foundations_file'], 'w') as out:
+            json.dump({'foundations': [foundry]}, out)
+        with open(files['queries_file'], 'w') as out:
+            json.dump({'queries': [{'metric': 'm', 'query': 'q'}]}, out)
+
+        exporter = get_stats.Exporter()
+        exporter.params = dict(files, config_snapshot=os.path.join(tmpdir,
+                                                                   'snap'))
+        sources = []
+        for _ in range(2):
+            index, queries = exporter.load_config()
+            sources.append(exporter.config_source)
+            self.assertEqual(index.lookup('f1')['dc'], 'd')
+            self.assertEqual(queries, [{'metric': 'm', 'query': 'q'}])
+        with open(files['queries_file'], 'w') as out:
+            json.dump({'queries': []}, out)
+        self.assertEqual(exporter.load_config()[1], [])
+        sources.append(exporter.config_source)
+        self.assertEqual(sources, ['files', 'snapshot', 'files'])
+
+
 class TestSendFunctions(unittest.TestCase):
     """
     Test the exporter influx/datadog sending functions
@@ -126,6 +187,7 @@ class TestSendFunctions(unittest.TestCase):
         self.mock_dogger = patch('dogger.Dogger').start()
         self.mock_helper = patch.object(influx_help, 'InfluxHelper',
                                         autospec=True).start()
+        self.mock_helper.return_value.lost.return_value = []
 
     def tearDown(self):
         """
@@ -137,7 +199,7 @@ class TestSendFunctions(unittest.TestCase):
         """
         Simple success path through send_results()
         """
-        metlist = [{'scope': 'a:foundry', 'pointlist': ['123']},]
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},]
         def my_metrics(*args, **kwargs):
           for rtn in metlist:
             yield rtn
@@ -149,14 +211,15 @@ class TestSendFunctions(unittest.TestCase):
             exporter.send_results(0, 'metric', 'why not', 'info')
 
         mock_get.assert_called_once_with('foundry', 'info')
-        exporter.datadog.metrics.assert_called_once_with(0, 1, 'why not')
+        exporter.datadog.metrics.assert_called_once_with(0, 1, 'why not',
+                                                         stats={})
         exporter.helper.send_points.assert_called_once()
 
     def testSendResultsFoundationError(self):
         """
         get_foundation_object failure in send_results()
         """
-        metlist = [{'scope': 'a:foundry', 'pointlist': ['123']},]
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},]
         def my_metrics(*args, **kwargs):
           for rtn in metlist:
             yield rtn
@@ -169,9 +232,238 @@ class TestSendFunctions(unittest.TestCase):
             exporter.send_results(0, 'metric', 'why not', 'info')
 
         mock_get.assert_called_once_with('foundry', 'info')
-        exporter.datadog.metrics.assert_called_once_with(0, 1, 'why not')
+        exporter.datadog.metrics.assert_called_once_with(0, 1, 'why not',
+                                                         stats={})
         exporter.helper.send_points.assert_not_called()
 
+    def testSendResultsWriterError(self):
+        """
+        send_results() fails once the pipeline writers are done if a
+        series failed to write
+        """
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},]
+        with patch('time.time', return_value=1), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(return_value=iter(metlist))
+            exporter.helper.send_points = MagicMock(side_effect=KeyError)
+            with self.assertRaises(influx_help.InfluxWritesLost):
+                exporter.send_results(0, 'metric', 'why not', 'info')
+        exporter.helper.send_points.assert_called_once()
+
+    def testSendResultsNoPipeline(self):
+        """
+        send_results() writes inline when the pipeline is disabled
+        """
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},]
+        with patch.dict(self._env_dict, {'pipeline_writers': 0}), \
+             patch('time.time', return_value=1), \
+             patch('pipeline.WritePipeline') as mock_pipe, \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(return_value=iter(metlist))
+            exporter.helper.send_points = MagicMock()
+            res = exporter.send_results(0, 'metric', 'why not', 'info')
+
+        mock_pipe.assert_not_called()
+        exporter.helper.send_points.assert_called_once_with('metric',
+                                                            ('foundry', {}),
+                                                            [[123, 1.0]], None)
+        self.assertEqual(res, 1)
+
+
+    def testSendResultsWatermark(self):
+        """
+        send_results() passes each series' watermark on with its points
+        """
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},]
+        with patch.dict(self._env_dict, {'pipeline_writers': 0}), \
+             patch('time.time', return_value=1), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.watermarks = watermarks.Watermarks({('metric', 'foundry'): 7})
+            exporter.datadog.metrics = MagicMock(return_value=iter(metlist))
+            exporter.helper.send_points = MagicMock()
+            exporter.send_results(0, 'metric', 'why not', 'info')
+
+        exporter.helper.send_points.assert_called_once_with('metric',
+                                                            ('foundry', {}),
+                                                            [[123, 1.0]], 7)
+
+    def testSendResultsDedup(self):
+        """
+        send_results() trims points repeated by adjacent windows
+        """
+        windows = [[{'scope': 'a:foundry', 'pointlist': [[0, 1], [1000, 2]]}],
+                   [{'scope': 'a:foundry', 'pointlist': [[1000, 2]]}],
+                   [{'scope': 'a:foundry', 'pointlist': [[1000, 2], [2000, 3]]}]]
+        with patch.dict(self._env_dict, {'pipeline_writers': 0}), \
+             patch('time.time', return_value=3), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(side_effect=windows)
+            exporter.helper.send_points = MagicMock()
+            self.assertEqual(exporter.send_results(0, 'metric', 'q', 'info'), 2)
+
+        self.assertEqual([args[0][2] for args in
+                          exporter.helper.send_points.call_args_list],
+                         [[[0, 1], [1000, 2]], [[2000, 3]]])
+        self.assertEqual(exporter.dedup_stats.overlap, 2)
+
+    def testSendResultsFanOut(self):
+        """
+        send_results() queues every series on the additional sinks too
+        """
+        metlist = [{'scope': 'a:foundry', 'pointlist': [[123, 1.0]]},
+                   {'scope': 'a:foundry', 'pointlist': [[456, 2.0]]}]
+        with patch.dict(self._env_dict, {'pipeline_writers': 0}), \
+             patch('time.time', return_value=1), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.sinks = [MagicMock(), MagicMock()]
+            exporter.datadog.metrics = MagicMock(return_value=iter(metlist))
+            exporter.helper.send_points = MagicMock()
+            self.assertEqual(exporter.send_results(0, 'metric', 'q', 'info'), 2)
+
+        for sink in exporter.sinks:
+            self.assertEqual(sink.put.call_args_list,
+                             exporter.helper.send_points.call_args_list)
+        self.assertEqual(exporter.helper.send_points.call_count, 2)
+
+    def testSendResultsRollup(self):
+        """
+        send_results() with a rollup starts on a bucket boundary and sends
+        the buckets, the last one once the export gets past its end
+        """
+        windows = [[{'scope': 'a:foundry',
+                     'pointlist': [[60000, 1], [90000, 3], [120000, 5]]}],
+                   [{'scope': 'a:foundry', 'pointlist': [[150000, 7]]}],
+                   []]
+        with patch.dict(self._env_dict, {'pipeline_writers': 0,
+                                         'datadog_time_range': 60}), \
+             patch('time.time', return_value=190), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(side_effect=windows)
+            exporter.helper.send_points = MagicMock()
+            exporter.send_results(100, 'metric', 'q', 'info',
+                                  rollup.Rollup(60, 'metric_1m'))
+
+        self.assertEqual(exporter.datadog.metrics.call_args_list,
+                         [call(60, 120, 'q', stats={}),
+                          call(120, 180, 'q', stats={}),
+                          call(180, 190, 'q', stats={})])
+        sent = [args[0][2] for args in
+                exporter.helper.send_points.call_args_list]
+        self.assertEqual([(list(buckets.times), list(buckets.fields[0][1]))
+                          for buckets in sent],
+                         [([60000], [2.0]), ([120000], [6.0])])
+
+    def testSendResultsWindowFailed(self):
+        """
+        send_results() fails the query on a failed window, without going
+        past it
+        """
+        calls = []
+        def my_metrics(start, end, query, stats):
+            calls.append((start, end))
+            if len(calls) == 2:
+                stats['error'] = True
+                return iter([])
+            return iter([{'scope': 'a:foundry',
+                          'pointlist': [[start * 1000, 1.0]]}])
+        with patch.dict(self._env_dict, {'pipeline_writers': 0,
+                                         'datadog_time_range': 100}), \
+             patch('time.time', return_value=300), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(side_effect=my_metrics)
+            exporter.helper.send_points = MagicMock()
+            with self.assertRaises(dogger.DatadogQueryFailed):
+                exporter.send_results(0, 'metric', 'q', 'info')
+
+        self.assertEqual(calls, [(0, 100), (100, 200)])
+        exporter.helper.send_points.assert_called_once()
+
+    def testFetchGroup(self):
+        """
+        fetch_group() makes one multi-query request per window and splits
+        the series back to their metrics
+        """
+        group = planner.QueryGroup()
+        group.add('q1', planner.Target(1, 'a', None))
+        group.add('q2', planner.Target(2, 'b', None))
+        group.add('q1', planner.Target(3, 'c', None))
+        metlist = [{'scope': 'a:foundry', 'query_index': 0,
+                    'pointlist': [[123, 1.0]]},
+                   {'scope': 'a:foundry', 'expression': 'q2',
+                    'pointlist': [[456, 2.0]]},
+                   {'scope': 'a:foundry', 'expression': 'other',
+                    'pointlist': [[789, 3.0]]}]
+        with patch('time.time', return_value=1), \
+             patch('get_stats.Exporter.get_foundation_object',
+                   return_value=('foundry', {})):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(return_value=iter(metlist))
+            send = MagicMock()
+            self.assertEqual(exporter.fetch_group(0, group, 'info', send),
+                             {1: 1, 2: 1, 3: 1})
+
+        exporter.datadog.metrics.assert_called_once_with(0, 1, 'q1,q2',
+                                                         stats={})
+        self.assertEqual([(args[0][0], args[0][2]) for args in
+                          send.call_args_list],
+                         [('a', [[123, 1.0]]), ('c', [[123, 1.0]]),
+                          ('b', [[456, 2.0]])])
+
+    def testSendResultsStopping(self):
+        """
+        send_results() stops between windows once the exporter is stopping
+        """
+        with patch.dict(self._env_dict, {'pipeline_writers': 0}), \
+             patch('time.time', return_value=1000):
+            exporter = get_stats.Exporter()
+            exporter.datadog.metrics = MagicMock(return_value=iter([]))
+            exporter.stopping.set()
+            self.assertEqual(exporter.send_results(0, 'metric', 'q', 'info'), 0)
+        exporter.datadog.metrics.assert_not_called()
+
+    def testSendResultsAdaptive(self):
+        """
+        send_results() with adaptive windows: a failed window is retried
+        smaller and the final size is remembered
+        """
+        calls = []
+        def my_metrics(start, end, query, stats):
+            calls.append((start, end))
+            if len(calls) == 1:
+                stats['error'] = True
+            else:
+                stats.update(series=1, points=1, latency=0)
+            return iter([])
+        env = {'pipeline_writers': 0, 'window_mode': 'adaptive',
+               'datadog_time_range': 100, 'window_min': 10,
+               'window_max': 400}
+        with patch.dict(self._env_dict, env), \
+             patch('time.time', return_value=250):
+            exporter = get_stats.Exporter()
+            exporter.checkpoints = MagicMock()
+            exporter.checkpoints.get_window.return_value = None
+            exporter.datadog.metrics = MagicMock(side_effect=my_metrics)
+            exporter.send_results(0, 'metric', 'why not', 'info')
+
+        # 100s window failed, retried as 50s, then grown (at most 4x)
+        self.assertEqual(calls, [(0, 100), (0, 50), (50, 250)])
+        exporter.checkpoints.record_window.assert_called_once_with('why not',
+                                                                   400)
+
 
 class TestExporterRun(unittest.TestCase):
     """
@@ -203,9 +495,14 @@ class TestExporterRun(unittest.TestCase):
               new_callable=PropertyMock,
               return_value=self._env_dict).start()
         patch('time.time', return_value=0).start()
+        patch('foundry_index.FoundryIndex', side_effect=lambda info: info).start()
         self.mock_dogger = patch('dogger.Dogger').start()
         self.mock_helper = patch.object(influx_help, 'InfluxHelper',
                                         autospec=True).start()
+        self.mock_helper.return_value.lost.return_value = []
+        # grouped watermark query fails: per metric start time queries
+        self.mock_helper.return_value.get_watermarks.side_effect = \
+            influx_help.InfluxStartQueryFailed
 
     def tearDown(self):
         """
@@ -245,11 +542,35 @@ class TestExporterRun(unittest.TestCase):
             exporter.helper.get_metric_start_time = MagicMock(return_value=42)
             res = exporter.run()
 
-        mock_send.assert_called_once_with(42, 'foo', 'why not', 'some foundation')
+        mock_send.assert_called_once_with(42, 'foo', 'why not', 'some foundation',
+                                          None)
         mock_load.assert_has_calls([call('found_file'), call('query_file')])
-        exporter.helper.get_metric_start_time.assert_called_once_with('foo')
+        exporter.helper.get_metric_start_time.assert_called_once_with('foo', None)
         self.assertEqual(res, 0)
 
+    def testRunLostPoints(self):
+        """
+        Test main: a query whose points were lost fails, its lost batches
+        forgotten at the start of the pass
+        """
+        json_load = ['some foundation',
+                     {'queries': [{'metric': 'foo', 'query': 'why not'}]}]
+        with patch('get_stats.Exporter.send_results', return_value=2), \
+             patch('get_stats.Exporter.log_summary') as mock_summary, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            exporter.helper.lost.return_value = ['f1']
+            res = exporter.run()
+
+        exporter.helper.reset_failed.assert_called_once_with('foo')
+        exporter.helper.lost.assert_called_once_with('foo')
+        result = mock_summary.call_args[0][0][0]
+        self.assertEqual((result.ok, result.nseries, result.error),
+                         (False, 2, 'lost points for f1'))
+        self.assertEqual(res, 1)
+
     def testRunGetStartTimeFail(self):
         """
         Test main: failure in get_metric_start_time()
@@ -264,7 +585,203 @@ class TestExporterRun(unittest.TestCase):
             exporter.helper.get_metric_start_time = mock_stime
             res = exporter.run()
 
-        mock_send.assert_called_once_with(99, 'foo', 'why not', 'some foundation')
+        mock_send.assert_called_once_with(99, 'foo', 'why not', 'some foundation',
+                                          None)
         mock_load.assert_has_calls([call('found_file'), call('query_file')])
-        exporter.helper.get_metric_start_time.assert_called_once_with('foo')
+        exporter.helper.get_metric_start_time.assert_called_once_with('foo', None)
+        self.assertEqual(res, 0)
+
+    def testRunAllQueries(self):
+        """
+        Test main: every query in the file is run, not just the first
+        """
+        queries = [{'metric': 'm{}'.format(nbr), 'query': 'q{}'.format(nbr)}
+                   for nbr in range(5)]
+        json_load = ['some foundation', {'queries': queries}]
+        with patch('get_stats.Exporter.send_results') as mock_send, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            res = exporter.run()
+
+        mock_send.assert_has_calls([call(42, q['metric'], q['query'],
+                                         'some foundation', None)
+                                    for q in queries], any_order=True)
+        self.assertEqual(mock_send.call_count, len(queries))
+        self.assertEqual(res, 0)
+
+    def testRunQueryFailureIsolated(self):
+        """
+        Test main: one failing query does not stop the others
+        """
+        queries = [{'metric': 'good1', 'query': 'q1'},
+                   {'metric': 'bad', 'query': 'q2'},
+                   {'metric': 'good2', 'query': 'q3'}]
+        json_load = ['some foundation', {'queries': queries}]
+        def my_send(start, metric, query, info, query_rollup=None):
+            if metric == 'bad':
+                raise RuntimeError('boom')
+            return 1
+        with patch('get_stats.Exporter.send_results',
+                   side_effect=my_send) as mock_send, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            res = exporter.run()
+
+        self.assertEqual(mock_send.call_count, 3)
+        self.assertEqual(res, 1)
+
+    def testRunSequential(self):
+        """
+        Test main: a single worker runs the queries in order
+        """
+        queries = [{'metric': 'm{}'.format(nbr), 'query': 'q{}'.format(nbr)}
+                   for nbr in range(3)]
+        json_load = ['some foundation', {'queries': queries}]
+        with patch.dict(self._env_dict, {'query_workers': 1}), \
+             patch('get_stats.Exporter.send_results') as mock_send, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            res = exporter.run()
+
+        self.assertEqual(mock_send.call_args_list,
+                         [call(42, q['metric'], q['query'], 'some foundation',
+                               None)
+                          for q in queries])
         self.assertEqual(res, 0)
+
+    def testRunWatermarks(self):
+        """
+        Test main: start times come from the grouped watermark query
+        """
+        queries = [{'metric': 'foo', 'query': 'q1'},
+                   {'metric': 'new', 'query': 'q2'}]
+        json_load = ['some foundation', {'queries': queries}]
+        marks = watermarks.Watermarks({('foo', 'f1'): 42000,
+                                       ('foo', 'f2'): 50000}, loaded=True)
+        with patch('get_stats.Exporter.send_results') as mock_send, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_watermarks = MagicMock(return_value=marks)
+            res = exporter.run()
+
+        exporter.helper.get_watermarks.assert_called_once_with(['foo', 'new'], None)
+        exporter.helper.get_metric_start_time.assert_not_called()
+        mock_send.assert_has_calls([call(42, 'foo', 'q1', 'some foundation',
+                                         None),
+                                    call(99, 'new', 'q2', 'some foundation',
+                                         None)],
+                                   any_order=True)
+        self.assertEqual(res, 0)
+
+    def testRunPlanned(self):
+        """
+        Test main: with query_batch the queries are run as planned groups,
+        one result per entry
+        """
+        queries = [{'metric': 'a', 'query': 'q1'},
+                   {'metric': 'b', 'query': 'q1'},
+                   {'metric': 'c', 'query': 'q2'},
+                   {'metric': 'd'}]
+        json_load = ['some foundation', {'queries': queries}]
+        def fetch(start, group, foundation_info, send):
+            return dict((target.qnbr, 1) for target in group.all_targets())
+        with patch.dict(self._env_dict, {'query_batch': 4}), \
+             patch('get_stats.Exporter.fetch_group',
+                   side_effect=fetch) as mock_fetch, \
+             patch('get_stats.Exporter.log_summary') as mock_summary, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            res = exporter.run()
+
+        mock_fetch.assert_called_once()
+        start, group = mock_fetch.call_args[0][:2]
+        self.assertEqual((start, group.query), (42, 'q1,q2'))
+        results = sorted(mock_summary.call_args[0][0])
+        self.assertEqual([(result.qnbr, result.ok, result.nseries)
+                          for result in results],
+                         [(1, True, 1), (2, True, 1), (3, True, 1),
+                          (4, False, 0)])
+        self.assertEqual(res, 1)
+
+    def testRunDeduped(self):
+        """
+        Test main: identical queries share a fetch without query_batch,
+        a query of its own is run as a plain query
+        """
+        queries = [{'metric': 'a', 'query': 'q1'},
+                   {'metric': 'b', 'query': 'q1'},
+                   {'metric': 'c', 'query': 'q2'}]
+        json_load = ['some foundation', {'queries': queries}]
+        def fetch(start, group, foundation_info, send):
+            return dict((target.qnbr, 1) for target in group.all_targets())
+        with patch('get_stats.Exporter.fetch_group',
+                   side_effect=fetch) as mock_fetch, \
+             patch('get_stats.Exporter.send_results',
+                   return_value=1) as mock_send, \
+             patch('get_stats.Exporter.load_json_file',
+                   side_effect=json_load):
+            exporter = get_stats.Exporter()
+            exporter.helper.get_metric_start_time = MagicMock(return_value=42)
+            res = exporter.run()
+
+        mock_fetch.assert_called_once()
+        self.assertEqual(mock_fetch.call_args[0][1].query, 'q1')
+        mock_send.assert_called_once_with(42, 'c', 'q2', 'some foundation',
+                                          None)
+        self.assertEqual(res, 0)
+
+    def testLoadWatermarksRollup(self):
+        """
+        Test load_watermarks: a rollup's watermark is the end of the last
+        bucket in its measurement, found with LAST of one of its fields
+        """
+        exporter = get_stats.Exporter()
+        exporter.rollups = {'m1': rollup.Rollup(60, 'm1_1m', ('avg', 'count'))}
+        exporter.helper.get_watermarks = MagicMock(side_effect=[
+            watermarks.Watermarks({('m2', 'f1'): 7000}, loaded=True),
+            watermarks.Watermarks({('m1_1m', 'f1'): 60000}, loaded=True)])
+        marks = exporter.load_watermarks(['m1', 'm2'])
+        self.assertEqual(exporter.helper.get_watermarks.call_args_list,
+                         [call(['m2'], None), call(['m1_1m'], 'avg')])
+        self.assertEqual(marks.as_dict(), {('m1', 'f1'): 119999,
+                                           ('m2', 'f1'): 7000})
+        self.assertTrue(marks.loaded)
+
+    def testLoadWatermarksCheckpoints(self):
+        """
+        Test load_watermarks: stored checkpoints first, Influx for the rest
+        """
+        exporter = get_stats.Exporter()
+        exporter.checkpoints = MagicMock()
+        exporter.checkpoints.load.return_value = {('m1', 'f1'): 5000}
+        exporter.helper.get_watermarks = MagicMock(
+            return_value=watermarks.Watermarks({('m2', 'f1'): 7000},
+                                               loaded=True))
+        marks = exporter.load_watermarks(['m1', 'm2'])
+
+        exporter.helper.get_watermarks.assert_called_once_with(['m2'], None)
+        self.assertTrue(marks.loaded)
+        self.assertEqual(marks.as_dict(), {('m1', 'f1'): 5000,
+                                           ('m2', 'f1'): 7000})
+
+    def testLoadWatermarksAllStored(self):
+        """
+        Test load_watermarks: no Influx query when all metrics are stored
+        """
+        exporter = get_stats.Exporter()
+        exporter.checkpoints = MagicMock()
+        exporter.checkpoints.load.return_value = {('m1', 'f1'): 5000}
+        exporter.helper.get_watermarks = MagicMock()
+        marks = exporter.load_watermarks(['m1'])
+
+        exporter.helper.get_watermarks.assert_not_called()
+        self.assertEqual(marks.start_time('m1'), 5)
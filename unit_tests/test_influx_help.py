@@ -5,8 +5,11 @@ from mock import patch, MagicMock, PropertyMock
 import pytest
 import unittest
 import influxdb
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 
 import influx_help
+import rollup
+import telemetry
 
 
 class TestObject(unittest.TestCase):
@@ -131,13 +134,15 @@ class TestObject(unittest.TestCase):
         """
         metric = 'a metric'
         points = [(4, 2)]
-        with patch('influxdb.InfluxDBClient'), \
-             patch('influxdb.SeriesHelper.commit') as mock_commit, \
-             patch('influx_help.InfluxHelper.is_number', return_value=True):
+        with patch('influxdb.InfluxDBClient'):
             helper = influx_help.InfluxHelper()
             helper.dbclient = MagicMock()
-            helper.send_points(metric, self.test_info, points)
-        mock_commit.assert_called_once()
+            res = helper.send_points(metric, self.test_info, points)
+        helper.dbclient.write_points.assert_called_once_with(
+            ['a\\ metric,context=testing,dc=ac,environment=green,'
+             'foundry=foundation\\ name,region=out\\ there value=2.0 4'],
+            time_precision='ms', protocol='line')
+        self.assertEqual(res, 1)
 
     def testSendPointsMultiPoint(self):
         """
@@ -145,13 +150,33 @@ class TestObject(unittest.TestCase):
         """
         metric = 'a metric'
         points = [('1', 2), ('3', 4), ('5', 6), ('7', 8)]
-        with patch('influxdb.InfluxDBClient'), \
-             patch('influxdb.SeriesHelper.commit') as mock_commit, \
-             patch('influx_help.InfluxHelper.is_number', return_value=True):
+        with patch('influxdb.InfluxDBClient'):
             helper = influx_help.InfluxHelper()
             helper.dbclient = MagicMock()
-            helper.send_points(metric, self.test_info, points)
-        mock_commit.assert_called_once()
+            res = helper.send_points(metric, self.test_info, points)
+        helper.dbclient.write_points.assert_called_once()
+        lines = helper.dbclient.write_points.call_args[0][0]
+        self.assertEqual([' '.join(line.rsplit(' ', 2)[1:]) for line in lines],
+                         ['value=2.0 1', 'value=4.0 3',
+                          'value=6.0 5', 'value=8.0 7'])
+        self.assertEqual(res, 4)
+
+    def testSendPointsBatches(self):
+        """
+        Validate send_points() splits the points into batches
+        """
+        metric = 'a metric'
+        points = [(nbr, nbr) for nbr in range(5)]
+        with patch.dict(self._env_dict, {'influx_batch_size': 2,
+                                         'influx_batch_max': 2}), \
+             patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            res = helper.send_points(metric, self.test_info, points)
+        self.assertEqual([len(call[0][0]) for call in
+                          helper.dbclient.write_points.call_args_list],
+                         [2, 2, 1])
+        self.assertEqual(res, 5)
 
     def testSendPointsNoPoints(self):
         """
@@ -159,27 +184,37 @@ class TestObject(unittest.TestCase):
         """
         metric = 'a metric'
         points = []
-        with patch('influxdb.InfluxDBClient'), \
-             patch('influxdb.SeriesHelper.commit') as mock_commit, \
-             patch('influx_help.InfluxHelper.is_number', return_value=True):
+        with patch('influxdb.InfluxDBClient'):
             helper = influx_help.InfluxHelper()
             helper.dbclient = MagicMock()
-            helper.send_points(metric, self.test_info, points)
-        mock_commit.assert_called_once()
+            res = helper.send_points(metric, self.test_info, points)
+        helper.dbclient.write_points.assert_not_called()
+        self.assertEqual(res, 0)
 
     def testSendPointsPointError(self):
         """
         Validate send_points() point constructed incorrectly
         """
         metric = 'a metric'
-        points = [('99',)]
-        with patch('influxdb.InfluxDBClient'), \
-             patch('influxdb.SeriesHelper.commit') as mock_commit, \
-             patch('influx_help.InfluxHelper.is_number', return_value=True):
+        points = [('99',), ('1', None), ('2', 'joe')]
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            res = helper.send_points(metric, self.test_info, points)
+        helper.dbclient.write_points.assert_not_called()
+        self.assertEqual(res, 0)
+
+    def testSendPointsMissingTags(self):
+        """
+        Validate send_points() with incomplete foundation info
+        """
+        with patch('influxdb.InfluxDBClient'):
             helper = influx_help.InfluxHelper()
             helper.dbclient = MagicMock()
-            helper.send_points(metric, self.test_info, points)
-        mock_commit.assert_not_called()
+            res = helper.send_points('metric', ('foundry', {'dc': 'ac'}),
+                                     [(1, 2)])
+        helper.dbclient.write_points.assert_not_called()
+        self.assertEqual(res, 0)
 
     def testSendPointsCommitException(self):
         """
@@ -187,11 +222,292 @@ class TestObject(unittest.TestCase):
         """
         metric = 'a metric'
         points = [('4', 2)]
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            helper.dbclient.write_points.side_effect = Exception
+            res = helper.send_points(metric, self.test_info, points)
+        helper.dbclient.write_points.assert_called_once()
+        self.assertEqual(res, 0)
+
+    def testSendPointsAfter(self):
+        """
+        Validate send_points() only sends points after the watermark
+        """
+        points = [(1, 1), (2, 2), (3, 3)]
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            res = helper.send_points('metric', self.test_info, points, after=2)
+        lines = helper.dbclient.write_points.call_args[0][0]
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith('value=3.0 3'))
+        self.assertEqual(res, 1)
+
+    def testGetWatermarks(self):
+        """
+        Validate get_watermarks() success path
+        """
+        class QueryReturn:
+            raw = {'series': [{'name': 'm1', 'tags': {'foundry': 'f1'},
+                               'values': [[1000, 1]]}]}
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.database = 'my data'
+            helper.dbclient.query.return_value = QueryReturn
+            res = helper.get_watermarks(['m1', 'm2'])
+        helper.dbclient.query.assert_called_once_with(
+            'SELECT LAST(*) FROM "m1", "m2" GROUP BY "foundry"',
+            database='my data', epoch="ms")
+        self.assertEqual(res.get('m1', 'f1'), 1000)
+        self.assertTrue(res.loaded)
+
+    def testGetWatermarksField(self):
+        """
+        Validate get_watermarks() of a multi-field (rollup) measurement
+        takes the last point of one field
+        """
+        class QueryReturn:
+            raw = {'series': [{'name': 'm1_1m', 'tags': {'foundry': 'f1'},
+                               'columns': ['time', 'last'],
+                               'values': [[60000, 1.5]]}]}
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.database = 'my data'
+            helper.dbclient.query.return_value = QueryReturn
+            res = helper.get_watermarks(['m1_1m'], 'avg')
+        helper.dbclient.query.assert_called_once_with(
+            'SELECT LAST("avg") FROM "m1_1m" GROUP BY "foundry"',
+            database='my data', epoch="ms")
+        self.assertEqual(res.get('m1_1m', 'f1'), 60000)
+
+    def testGetWatermarksException(self):
+        """
+        Validate get_watermarks() with query raising exception
+        """
         with patch('influxdb.InfluxDBClient'), \
-             patch('influxdb.SeriesHelper.commit',
-                   side_effect=Exception) as mock_commit, \
-             patch('influx_help.InfluxHelper.is_number', return_value=True):
+             pytest.raises(influx_help.InfluxStartQueryFailed):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient.query.side_effect = Exception
+            helper.get_watermarks(['m1'])
+
+    def testSendPointsSpool(self):
+        """
+        Validate send_points() spools batches Influx fails to take, and
+        later batches while the spool has a backlog
+        """
+        points = [(nbr, nbr) for nbr in range(1, 6)]
+        with patch.dict(self._env_dict, {'influx_batch_size': 2,
+                                         'influx_batch_max': 2}), \
+             patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            helper.dbclient.write_points.side_effect = [True, Exception]
+            helper.spool = MagicMock()
+            helper.spool.pending = False
+            helper.spool.append.side_effect = \
+                lambda lines: setattr(helper.spool, 'pending', True)
+            res = helper.send_points('metric', self.test_info, points)
+        self.assertEqual(res, 5)
+        self.assertEqual(helper.errors, 0)
+        self.assertEqual(helper.dbclient.write_points.call_count, 2)
+        self.assertEqual([len(args[0][0]) for args in
+                          helper.spool.append.call_args_list], [2, 1])
+
+    def testSendPointsCheckpoint(self):
+        """
+        Validate send_points() records committed batches, up to a failure
+        """
+        points = [(nbr, nbr) for nbr in range(1, 6)]
+        written = telemetry.POINTS_WRITTEN.value('metric')
+        failed = telemetry.POINTS_DROPPED.value('metric', 'write_failed')
+        with patch.dict(self._env_dict, {'influx_batch_size': 2,
+                                         'influx_batch_max': 2}), \
+             patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            helper.dbclient.write_points.side_effect = [True, Exception, True]
+            helper.checkpoints = MagicMock()
+            helper.watermarks = MagicMock()
+            res = helper.send_points('metric', self.test_info, points)
+        helper.checkpoints.record.assert_called_once_with('metric',
+                                                          'foundation name', 2)
+        helper.watermarks.advance.assert_called_once_with('metric',
+                                                          'foundation name', 2)
+        self.assertEqual(res, 3)
+        self.assertEqual(telemetry.POINTS_WRITTEN.value('metric') - written, 3)
+        self.assertEqual(telemetry.POINTS_DROPPED.value('metric', 'write_failed')
+                         - failed, 2)
+
+    def testSendPointsFailedWindow(self):
+        """
+        Validate a series whose window failed to write is not committed
+        by the next window, until the next pass over its metric
+        """
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            helper.dbclient.write_points.side_effect = [Exception, True, True,
+                                                        True]
+            helper.checkpoints = MagicMock()
+            helper.watermarks = MagicMock()
+            self.assertEqual(helper.send_points('metric', self.test_info,
+                                                [(1, 1)]), 0)
+            self.assertEqual(helper.send_points('metric', self.test_info,
+                                                [(2, 2)]), 1)
+            helper.send_points('other', self.test_info, [(2, 2)])
+        self.assertEqual(helper.failed, set([('metric', 'foundation name')]))
+        helper.checkpoints.record.assert_called_once_with('other',
+                                                          'foundation name', 2)
+        helper.watermarks.advance.assert_called_once_with('other',
+                                                          'foundation name', 2)
+
+        helper.reset_failed('metric')
+        self.assertEqual(helper.failed, set())
+        helper.send_points('metric', self.test_info, [(3, 3)])
+        helper.checkpoints.record.assert_called_with('metric',
+                                                     'foundation name', 3)
+
+    def testSendPointsNamedSink(self):
+        """
+        Validate a named sink's helper counts into the per sink metrics
+        only, with its own parameters
+        """
+        points = [(nbr, nbr) for nbr in range(1, 4)]
+        written = telemetry.POINTS_WRITTEN.value('metric')
+        sink_written = telemetry.SINK_POINTS.value('dr', 'written')
+        with patch('influxdb.InfluxDBClient') as mock_client:
+            helper = influx_help.InfluxHelper(dict(self._env_dict,
+                                                   influx_host='dr-host'),
+                                              'dr')
+            helper.dbclient = MagicMock()
+            self.assertEqual(helper.send_points('metric', self.test_info,
+                                                points), 3)
+        self.assertEqual(mock_client.call_args[1]['host'], 'dr-host')
+        self.assertEqual(telemetry.POINTS_WRITTEN.value('metric'), written)
+        self.assertEqual(telemetry.SINK_POINTS.value('dr', 'written')
+                         - sink_written, 3)
+
+    def testSendBuckets(self):
+        """
+        Validate send_points() writes rollup buckets to their measurement
+        and retention policy, committed up to the end of the buckets
+        """
+        buckets = rollup.Buckets([0, 60000], [('avg', [1.5, 2.0]),
+                                              ('count', [2, 1])],
+                                 'm_1m', 'weeks', 60000)
+        with patch.dict(self._env_dict, {'influx_precision': 's'}), \
+             patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient = MagicMock()
+            helper.spool = MagicMock()
+            helper.checkpoints = MagicMock()
+            res = helper.send_points('m', ('f1', {'foundry': 'f1'}), buckets)
+        helper.dbclient.write_points.assert_called_once_with(
+            ['m_1m,foundry=f1 avg=1.5,count=2i 0',
+             'm_1m,foundry=f1 avg=2.0,count=1i 60'],
+            time_precision='s', protocol='line', retention_policy='weeks')
+        helper.spool.append.assert_not_called()
+        helper.checkpoints.record.assert_called_once_with('m', 'f1', 119999)
+        self.assertEqual(res, 2)
+
+    def testSendPointsNoCommit(self):
+        """
+        Validate send_points() can leave the checkpoints alone
+        """
+        with patch('influxdb.InfluxDBClient'):
             helper = influx_help.InfluxHelper()
             helper.dbclient = MagicMock()
-            helper.send_points(metric, self.test_info, points)
-        mock_commit.assert_called_once()
+            helper.checkpoints = MagicMock()
+            self.assertEqual(helper.send_points('m', self.test_info,
+                                                [(1, 1)], None, False), 1)
+        helper.checkpoints.record.assert_not_called()
+
+    def testWriteLinesRetry(self):
+        """
+        Validate write_lines() retries 5xx and 429 responses, shrinking the
+        batch size
+        """
+        with patch.dict(self._env_dict, {'influx_batch_size': 1000}), \
+             patch('influxdb.InfluxDBClient'), \
+             patch('influx_help.time.sleep') as mock_sleep:
+            helper = influx_help.InfluxHelper()
+            helper.dbclient.write_points.side_effect = [
+                InfluxDBServerError('down'),
+                InfluxDBClientError('slow down', 429),
+                True]
+            self.assertEqual(helper.write_lines(['a', 'b']), 2)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(helper.retries, 2)
+        self.assertEqual(helper.encoder.batch_size, 250)
+
+    def testWriteLinesGiveUp(self):
+        """
+        Validate write_lines() gives up after max retries, and does not
+        retry other errors
+        """
+        with patch.dict(self._env_dict, {'influx_max_retries': 1}), \
+             patch('influxdb.InfluxDBClient'), \
+             patch('influx_help.time.sleep'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient.write_points.side_effect = \
+                InfluxDBServerError('down')
+            with pytest.raises(InfluxDBServerError):
+                helper.write_lines(['a'])
+            self.assertEqual(helper.dbclient.write_points.call_count, 2)
+            helper.dbclient.write_points.reset_mock()
+            helper.dbclient.write_points.side_effect = \
+                InfluxDBClientError('no such database', 404)
+            with pytest.raises(InfluxDBClientError):
+                helper.write_lines(['a'])
+            helper.dbclient.write_points.assert_called_once()
+
+    def testWriteLinesSplit(self):
+        """
+        Validate write_lines() splits a rejected batch to drop the bad point
+        """
+        def write_points(lines, **kwargs):
+            if 'bad' in lines:
+                raise InfluxDBClientError('unable to parse', 400)
+        with patch('influxdb.InfluxDBClient'):
+            helper = influx_help.InfluxHelper()
+            helper.dbclient.write_points.side_effect = write_points
+            self.assertEqual(helper.write_lines(['a', 'b', 'bad', 'c']), 3)
+        self.assertEqual(helper.rejected, 1)
+        written = [args[0][0] for args in
+                   helper.dbclient.write_points.call_args_list]
+        self.assertEqual(written, [['a', 'b', 'bad', 'c'], ['a', 'b'],
+                                   ['bad', 'c'], ['bad'], ['c']])
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+    """
+    Test the adaptive write batch size.
+    """
+    def testGrowShrink(self):
+        """
+        Fast writes grow the batch (at most x2), slow ones and errors
+        shrink it, within the bounds
+        """
+        sizer = influx_help.AdaptiveBatchSize(1000, 100, 10000, 1.0)
+        sizer.observe(1000, 0.1)
+        self.assertEqual(sizer.size, 2000)
+        sizer.observe(2000, 1.6)
+        self.assertEqual(sizer.size, 1250)
+        sizer.observe(10, 0.0001)
+        self.assertEqual(sizer.size, 1250)
+        sizer.observe(1250, error=True)
+        self.assertEqual(sizer.size, 625)
+        for _ in range(10):
+            sizer.observe(sizer.size, error=True)
+        self.assertEqual(sizer.size, 100)
+        for _ in range(10):
+            sizer.observe(sizer.size, 0.0)
+        self.assertEqual(sizer.size, 10000)
+
+    def testFixed(self):
+        """
+        A size outside the bounds widens them; equal bounds fix the size
+        """
+        sizer = influx_help.AdaptiveBatchSize(2, 100, 2, 1.0)
+        sizer.observe(2, 0.0)
+        self.assertEqual(sizer.size, 2)
@@ -0,0 +1,112 @@
+"""
+Unit tests for the datadog-exporter line protocol module
+"""
+import unittest
+
+import line_protocol
+
+
+class TestEncoding(unittest.TestCase):
+    """
+    Test the line protocol encoding functions.
+    """
+    def testEscapes(self):
+        """
+        Measurement and tag escaping
+        """
+        self.assertEqual(line_protocol.escape_measurement('a b,c=d'),
+                         'a\\ b\\,c=d')
+        self.assertEqual(line_protocol.escape_tag('a b,c=d'),
+                         'a\\ b\\,c\\=d')
+
+    def testSeriesPrefix(self):
+        """
+        Tags are sorted and empty tags left out
+        """
+        prefix = line_protocol.series_prefix('cpu', {'z': 1, 'a': 'x y',
+                                                     'm': '', 'n': None})
+        self.assertEqual(prefix, 'cpu,a=x\\ y,z=1')
+
+    def testFormatValue(self):
+        """
+        Only finite numbers are valid values
+        """
+        self.assertEqual(line_protocol.format_value(2), '2.0')
+        self.assertEqual(line_protocol.format_value('0.5'), '0.5')
+        self.assertIsNone(line_protocol.format_value(None))
+        self.assertIsNone(line_protocol.format_value('joe'))
+        self.assertIsNone(line_protocol.format_value(float('nan')))
+        self.assertIsNone(line_protocol.format_value(float('inf')))
+
+    def testEncodePoints(self):
+        """
+        Points become lines, bad points are skipped
+        """
+        points = [[1000.0, 1.5], [2000.0, None], [3000.0], 'x', [4000.0, 2]]
+        self.assertEqual(list(line_protocol.encode_points('m', points)),
+                         ['m value=1.5 1000', 'm value=2.0 4000'])
+
+
+class TestLineEncoder(unittest.TestCase):
+    """
+    Test the batch encoder.
+    """
+    def testPrefixCached(self):
+        """
+        The prefix is built once per (measurement, foundry)
+        """
+        encoder = line_protocol.LineEncoder(10)
+        first = encoder.prefix('m', 'f1', {'foundry': 'f1'})
+        # a different tag set for the same key is not looked at again
+        self.assertIs(encoder.prefix('m', 'f1', {'foundry': 'other'}), first)
+        self.assertEqual(encoder.prefix('m', 'f2', {'foundry': 'f2'}),
+                         'm,foundry=f2')
+
+    def testBatches(self):
+        """
+        Points are split into batch_size batches
+        """
+        encoder = line_protocol.LineEncoder(2)
+        batches = list(encoder.batches('m', [[nbr, nbr] for nbr in range(5)]))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(batches[2], ['m value=4.0 4'])
+
+    def testNoBatches(self):
+        """
+        No points, no batches
+        """
+        self.assertEqual(list(line_protocol.LineEncoder(2).batches('m', [])), [])
+
+    def testColumnBatches(self):
+        """
+        Columns are encoded in batch_size batches
+        """
+        encoder = line_protocol.LineEncoder(2)
+        batches = list(encoder.column_batches('m', [1, 2, 3], [1.0, 2.5, 3.0]))
+        self.assertEqual(batches, [['m value=1.0 1', 'm value=2.5 2'],
+                                   ['m value=3.0 3']])
+
+    def testFieldBatches(self):
+        """
+        Several fields per line, integer columns as integer fields
+        """
+        encoder = line_protocol.LineEncoder(1)
+        batches = list(encoder.field_batches('m', [1, 2],
+                                             [('avg', [1.5, 2.0]),
+                                              ('count', [2, 1])]))
+        self.assertEqual(batches, [['m avg=1.5,count=2i 1'],
+                                   ['m avg=2.0,count=1i 2']])
+
+    def testBracedTags(self):
+        """
+        Braces in tag values are written as they are
+        """
+        encoder = line_protocol.LineEncoder(10)
+        prefix = encoder.prefix('m', 'f1', {'foundry': 'f1', 'env': '{x}{0}'})
+        self.assertEqual(list(line_protocol.encode_points(prefix, [[1, 1.5]])),
+                         ['m,env={x}{0},foundry=f1 value=1.5 1'])
+        self.assertEqual(list(encoder.column_batches(prefix, [1], [1.5])),
+                         [['m,env={x}{0},foundry=f1 value=1.5 1']])
+        self.assertEqual(list(encoder.field_batches(prefix, [1],
+                                                    [('a{vg}', [1.5])])),
+                         [['m,env={x}{0},foundry=f1 a{vg}=1.5 1']])
@@ -0,0 +1,137 @@
+"""
+Unit tests for the commonpy logger module
+"""
+from mock import patch
+import io
+import json
+import logging
+import os
+import threading
+import unittest
+
+import commonpy.singleton
+from commonpy import logger
+
+
+def make_record(msg='hello %s', args=('world',), lineno=1, **extra):
+    record = logging.LogRecord('app', logging.DEBUG, 'file.py', lineno, msg,
+                               args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestLogger(unittest.TestCase):
+    """
+    Test the Logger setup.
+    """
+    def tearDown(self):
+        commonpy.singleton.Singleton._instances.clear()
+        logging.getLogger('test-app').handlers = []
+        logging.getLogger('test-app').filters = []
+
+    def testNoDuplicateHandlers(self):
+        """
+        Constructing the Logger again replaces its handler and filter
+        """
+        for use_async in (True, False, True):
+            commonpy.singleton.Singleton._instances.clear()
+            log = logger.Logger('test-app', 'DEBUG',
+                                use_async=use_async).logger
+        self.assertEqual(len(log.handlers), 1)
+        self.assertIsInstance(log.handlers[0], logger.AsyncHandler)
+        self.assertEqual(len(log.filters), 1)
+
+    def testJsonFormat(self):
+        """
+        LOG_FORMAT json writes one JSON object per line
+        """
+        stream = io.StringIO()
+        with patch('sys.stdout', stream), \
+             patch.dict(os.environ, {'LOG_FORMAT': 'json'}):
+            log = logger.Logger('test-app', 'INFO', use_async=False).logger
+        log.info("%d points", 3)
+        entry = json.loads(stream.getvalue())
+        self.assertEqual((entry['level'], entry['logger'], entry['message']),
+                         ('INFO', 'test-app', '3 points'))
+
+
+class TestAsyncHandler(unittest.TestCase):
+    """
+    Test the background writer.
+    """
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.target = logging.StreamHandler(self.stream)
+
+    def testWrite(self):
+        """
+        Records are written by the writer thread, in order
+        """
+        handler = logger.AsyncHandler(self.target)
+        for nbr in range(3):
+            handler.handle(make_record(args=(nbr,)))
+        handler.flush()
+        self.assertEqual(self.stream.getvalue(),
+                         'hello 0\nhello 1\nhello 2\n')
+        handler.close()
+        self.assertFalse(handler._thread.is_alive())
+
+    def testDrop(self):
+        """
+        Records are dropped rather than waited for when the queue is full,
+        and the drops are reported
+        """
+        blocked = threading.Event()
+        write = self.target.emit
+        self.target.emit = lambda record: (blocked.wait(), write(record))
+        handler = logger.AsyncHandler(self.target, capacity=2)
+        for nbr in range(6):
+            handler.handle(make_record(args=(nbr,)))
+        self.assertGreaterEqual(handler.dropped, 3)
+        blocked.set()
+        handler.flush()
+        handler.handle(make_record(args=('last',)))
+        handler.close()
+        lines = self.stream.getvalue().splitlines()
+        self.assertIn('{} log records dropped'.format(handler.dropped), lines)
+        self.assertEqual(lines[-1], 'hello last')
+
+
+class TestRateLimitFilter(unittest.TestCase):
+    """
+    Test the per call site rate limit and sampling.
+    """
+    def testRateLimit(self):
+        """
+        A call site over its rate is suppressed, the count reported later
+        """
+        log_filter = logger.RateLimitFilter(rate=2)
+        with patch('time.monotonic', return_value=0):
+            kept = [log_filter.filter(make_record()) for _ in range(5)]
+            # another call site has its own budget
+            self.assertTrue(log_filter.filter(make_record(lineno=2)))
+        self.assertEqual(kept, [True, True, False, False, False])
+        record = make_record()
+        with patch('time.monotonic', return_value=1):
+            self.assertTrue(log_filter.filter(record))
+        self.assertEqual(record.getMessage(),
+                         'hello world (3 similar messages suppressed)')
+
+    def testNoLimit(self):
+        """
+        A rate of 0 lets everything through
+        """
+        log_filter = logger.RateLimitFilter(rate=0)
+        self.assertTrue(all(log_filter.filter(make_record())
+                            for _ in range(100)))
+
+    def testSample(self):
+        """
+        Hot loop records are sampled, the others are not
+        """
+        log_filter = logger.RateLimitFilter(rate=0, sample=3)
+        self.assertEqual([log_filter.filter(make_record(**logger.HOT_LOOP))
+                          for _ in range(7)],
+                         [True, False, False, True, False, False, True])
+        self.assertTrue(all(log_filter.filter(make_record(lineno=2))
+                            for _ in range(5)))
@@ -0,0 +1,103 @@
+"""
+Unit tests for the datadog-exporter pipeline module
+"""
+from mock import patch
+import queue
+import threading
+import time
+import unittest
+
+import pipeline
+
+
+class TestWritePipeline(unittest.TestCase):
+    """
+    Test the bounded fetch/write pipeline.
+    """
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def testAllItemsWritten(self):
+        """
+        Everything put on the pipeline is written by close()
+        """
+        written = []
+        lock = threading.Lock()
+        def writer(metric, info, points):
+            with lock:
+                written.append((metric, info, points))
+        with pipeline.WritePipeline(writer, depth=2, writers=3) as stage:
+            for nbr in range(20):
+                stage.put('metric', 'info', [nbr])
+        self.assertEqual(sorted(item[2][0] for item in written),
+                         list(range(20)))
+        self.assertEqual(stage.written, 20)
+        self.assertEqual(stage.errors, 0)
+
+    def testWriteErrorCounted(self):
+        """
+        A failing write is counted and does not stop the writer
+        """
+        def writer(value):
+            if value % 2:
+                raise ValueError(value)
+        with pipeline.WritePipeline(writer, depth=1) as stage:
+            for nbr in range(6):
+                stage.put(nbr)
+        self.assertEqual(stage.written, 3)
+        self.assertEqual(stage.errors, 3)
+
+    def testBackpressure(self):
+        """
+        put() blocks while the queue is full
+        """
+        release = threading.Event()
+        def writer(value):
+            release.wait()
+        stage = pipeline.WritePipeline(writer, depth=1, writers=1)
+        stage.put(1)        # taken by the writer, which then blocks
+        time.sleep(0.05)
+        stage.put(2)        # fills the queue
+        blocked = threading.Thread(target=stage.put, args=(3,))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        stage.close()
+        self.assertEqual(stage.written, 3)
+
+    def testPutNoWait(self):
+        """
+        put(block=False) raises queue.Full rather than waiting
+        """
+        release = threading.Event()
+        stage = pipeline.WritePipeline(lambda value: release.wait(),
+                                       depth=1, writers=1)
+        stage.put(1)
+        time.sleep(0.05)
+        stage.put(2, block=False)
+        with self.assertRaises(queue.Full):
+            stage.put(3, block=False)
+        release.set()
+        stage.close()
+        self.assertEqual(stage.written, 2)
+
+    def testPutAfterClose(self):
+        """
+        put() on a closed pipeline raises
+        """
+        stage = pipeline.WritePipeline(lambda x: x, depth=1)
+        stage.close()
+        with self.assertRaises(RuntimeError):
+            stage.put(1)
@@ -0,0 +1,90 @@
+"""
+Unit tests for the datadog-exporter planner module
+"""
+from mock import patch
+import unittest
+
+import planner
+
+
+def entry(qnbr, query, start=100):
+    return query, planner.Target(qnbr, 'm{}'.format(qnbr), None), start
+
+
+class TestPlan(unittest.TestCase):
+    """
+    Test the grouping of queries file entries into fetches.
+    """
+    def _plan(self, entries, batch=10, spread=3600):
+        return [(group.query, group.start,
+                 [[target.qnbr for target in targets]
+                  for targets in group.targets])
+                for group in planner.plan(entries, batch, spread)]
+
+    def testDedupe(self):
+        """
+        Identical queries share one fetch, from the earliest start, when
+        their starts are within a window
+        """
+        self.assertEqual(self._plan([entry(1, 'q1', 500), entry(2, 'q1', 100)],
+                                    batch=1),
+                         [('q1', 100, [[2, 1]])])
+        self.assertEqual(self._plan([entry(1, 'q1', 9000), entry(2, 'q1', 100),
+                                     entry(3, 'q1', 9500)], batch=1),
+                         [('q1', 100, [[2]]), ('q1', 9000, [[1, 3]])])
+
+    def testBatch(self):
+        """
+        Up to 'batch' distinct queries per group
+        """
+        self.assertEqual(self._plan([entry(1, 'q1'), entry(2, 'q2'),
+                                     entry(3, 'q3'), entry(4, 'q1')], batch=2),
+                         [('q1,q2', 100, [[1, 4], [2]]),
+                          ('q3', 100, [[3]])])
+
+    def testSpread(self):
+        """
+        Distinct queries with start times too far apart are not batched
+        """
+        self.assertEqual(self._plan([entry(1, 'q1', 0), entry(2, 'q2', 4000),
+                                     entry(3, 'q3', 3000)]),
+                         [('q1,q3', 0, [[1], [3]]), ('q2', 4000, [[2]])])
+
+    def testLength(self):
+        """
+        A combined query stays within MAX_QUERY_CHARS
+        """
+        with patch('planner.MAX_QUERY_CHARS', 5):
+            self.assertEqual(len(self._plan([entry(1, 'q1'), entry(2, 'q2'),
+                                             entry(3, 'q3')])), 2)
+
+
+class TestQueryGroup(unittest.TestCase):
+    """
+    Test the mapping of returned series to their entries.
+    """
+    def setUp(self):
+        self.group = planner.QueryGroup()
+        for query, target, start in (entry(1, 'q1'), entry(2, 'q2'),
+                                     entry(3, 'q1')):
+            self.group.add(query, target, start)
+
+    def testTargetsOf(self):
+        """
+        Series are matched by query_index, then expression
+        """
+        qnbrs = lambda series: [target.qnbr for target in
+                                self.group.targets_of(series)]
+        self.assertEqual(qnbrs({'query_index': 0, 'expression': 'q2'}), [1, 3])
+        self.assertEqual(qnbrs({'expression': 'q2'}), [2])
+        self.assertEqual(qnbrs({'query_index': 5}), [])
+        self.assertEqual(qnbrs({'expression': 'x'}), [])
+
+    def testSingleQuery(self):
+        """
+        Every series of a single query group is for its entries
+        """
+        group = planner.QueryGroup()
+        group.add('q1', planner.Target(1, 'm1', None))
+        self.assertEqual(group.targets_of({}), [planner.Target(1, 'm1', None)])
+        self.assertIsNone(group.start)
@@ -0,0 +1,131 @@
+"""
+Unit tests for the datadog-exporter pointlist module
+"""
+from mock import patch
+import unittest
+
+import pointlist
+
+
+class TestToColumns(unittest.TestCase):
+    """
+    Test the point list to columns conversion, with and without NumPy.
+    """
+    points = [[1000.0, 1.5], [2000.0, None], [3000.0, float('nan')],
+              [4000.0, 2], [5000.0, float('inf')], [6000.0, -0.25]]
+
+    def _columns(self, points, precision='ms'):
+        times, values = pointlist.to_columns(points, precision)
+        return list(times), list(values)
+
+    def testPython(self):
+        """
+        Pure Python conversion drops points without finite values
+        """
+        with patch('pointlist.numpy', None):
+            self.assertEqual(self._columns(self.points),
+                             ([1000, 4000, 6000], [1.5, 2.0, -0.25]))
+
+    @unittest.skipIf(pointlist.numpy is None, "NumPy not installed")
+    def testNumpy(self):
+        """
+        Vectorized conversion gives the same result
+        """
+        times, values = pointlist.numpy_columns(self.points)
+        self.assertEqual(times.dtype, pointlist.numpy.int64)
+        self.assertEqual((times.tolist(), values.tolist()),
+                         ([1000, 4000, 6000], [1.5, 2.0, -0.25]))
+
+    def testPrecision(self):
+        """
+        Timestamps are converted to the write precision
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                self.assertEqual(self._columns([[1500.0, 1]], 'n')[0],
+                                 [1500000000])
+                self.assertEqual(self._columns([[1500.0, 1]], 'u')[0],
+                                 [1500000])
+                self.assertEqual(self._columns([[1500.0, 1]], 's')[0], [1])
+
+    def testBadPrecision(self):
+        """
+        Unknown precisions are rejected
+        """
+        with self.assertRaises(ValueError):
+            pointlist.to_columns([], 'h')
+
+    def testFallback(self):
+        """
+        Point lists NumPy cannot convert fall back to pure Python
+        """
+        points = [[1000.0, 'joe'], [2000.0], [3000.0, '4']]
+        self.assertEqual(self._columns(points), ([3000], [4.0]))
+
+    def testEmpty(self):
+        """
+        An empty point list gives empty columns
+        """
+        self.assertEqual(self._columns([]), ([], []))
+
+    def testAfter(self):
+        """
+        Points at or before 'after' are dropped
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                times, _ = pointlist.to_columns(self.points, after=4000)
+                self.assertEqual(list(times), [6000])
+
+
+class TestSeries(unittest.TestCase):
+    """
+    Test the compact series container, with and without NumPy.
+    """
+    points = [[1000.0, 1.5], [2000.0, None], [3000.0, 2], [4000.0, -0.25]]
+
+    def testFromPoints(self):
+        """
+        Only valid points are kept, in 16 bytes each
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                series = pointlist.Series.from_points(self.points)
+                self.assertEqual(len(series), 3)
+                self.assertEqual(series, [[1000, 1.5], [3000, 2.0],
+                                          [4000, -0.25]])
+                self.assertEqual(series[-1], (4000, -0.25))
+                self.assertEqual(series.nbytes, 48)
+
+    def testSlices(self):
+        """
+        Time slices are Series with the same tags and leading points
+        are counted
+        """
+        tags = {'foundry': 'f1'}
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                series = pointlist.Series.from_points(self.points, tags)
+                self.assertIsInstance(series[1:], pointlist.Series)
+                self.assertIs(series[1:].tags, tags)
+                self.assertEqual(series[1:], [[3000, 2.0], [4000, -0.25]])
+                self.assertEqual([series.count_upto(stamp) for stamp in
+                                  (float('-inf'), 999, 1000, 3500, 9000)],
+                                 [0, 0, 1, 2, 3])
+
+    def testColumns(self):
+        """
+        Columns match to_columns() in every precision
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                series = pointlist.Series.from_points(self.points)
+                for precision in ('n', 'u', 'ms', 's'):
+                    for after in (None, 1000):
+                        times, values = series.columns(precision, after)
+                        expected = pointlist.to_columns(self.points,
+                                                        precision, after)
+                        self.assertEqual((list(times), list(values)),
+                                         tuple(list(col) for col in expected))
+                with self.assertRaises(ValueError):
+                    series.columns('h')
@@ -0,0 +1,155 @@
+"""
+Unit tests for the datadog-exporter ratelimit module
+"""
+import asyncio
+from mock import patch, MagicMock
+import threading
+import time
+import unittest
+
+import ratelimit
+
+
+class TestRequestScheduler(unittest.TestCase):
+    """
+    Test the rate limited request scheduler.
+    """
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.mock_sleep = patch('ratelimit.time.sleep').start()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def testBurst(self):
+        """
+        The bucket allows 'burst' requests back to back, then waits
+        """
+        sched = ratelimit.RequestScheduler(limit=20, period=1, burst=3)
+        started = time.monotonic()
+        for _ in range(4):
+            sched.acquire('q')
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        self.assertEqual(sched.requests, 4)
+
+    def testFairness(self):
+        """
+        Waiting keys are served round robin
+        """
+        sched = ratelimit.RequestScheduler(limit=50, period=1, burst=1)
+        sched.acquire('warmup')
+        order = []
+        lock = threading.Lock()
+        def worker(key):
+            sched.acquire(key)
+            with lock:
+                order.append(key)
+        threads = [threading.Thread(target=worker, args=(key,))
+                   for key in ['a', 'a', 'a', 'b']]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.005)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(len(order), 4)
+        # 'b' does not wait behind all of the 'a' requests
+        self.assertLess(order.index('b'), 3)
+
+    def testHeaders(self):
+        """
+        Rate limit headers set the rate and cap the tokens
+        """
+        sched = ratelimit.RequestScheduler(limit=1, period=1, burst=10)
+        sched.update({'X-RateLimit-Limit': '100', 'X-RateLimit-Period': '10',
+                      'X-RateLimit-Remaining': '2', 'X-RateLimit-Reset': '5'})
+        self.assertEqual(sched.rate, 10)
+        self.assertLessEqual(sched._tokens, 2)
+        # one of four processes sharing the allowance
+        sched = ratelimit.RequestScheduler(limit=1, period=1, share=0.25)
+        sched.update({'X-RateLimit-Limit': '100', 'X-RateLimit-Period': '10'})
+        self.assertEqual(sched.rate, 2.5)
+
+    def testHeadersExhausted(self):
+        """
+        No requests remaining pauses until the reset
+        """
+        sched = ratelimit.RequestScheduler(limit=1, period=1)
+        sched.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '30'})
+        self.assertGreater(sched._paused_until, time.monotonic() + 25)
+
+    def testRetryAfter(self):
+        """
+        A 429's delay is Retry-After, else X-RateLimit-Reset
+        """
+        self.assertEqual(ratelimit.retry_after({'Retry-After': '7',
+                                                'X-RateLimit-Reset': '30'}), 7)
+        self.assertEqual(ratelimit.retry_after({'Retry-After': 'Wed, 21 Oct',
+                                                'X-RateLimit-Reset': '30'}), 30)
+        self.assertIsNone(ratelimit.retry_after({}))
+
+    def testRetry(self):
+        """
+        Rate limited and listed errors are retried with backoff
+        """
+        sched = ratelimit.RequestScheduler(limit=1000, period=1, burst=10,
+                                           retry_on=(IOError,))
+        func = MagicMock(side_effect=[ratelimit.RateLimited('429'),
+                                      IOError, 'done'])
+        self.assertEqual(sched.call('q', func, 1, two=2), 'done')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sched.retries, 2)
+        self.assertEqual(self.mock_sleep.call_count, 2)
+
+    def testRetryAsync(self):
+        """
+        call_async() schedules and retries coroutines on the event loop
+        """
+        sched = ratelimit.RequestScheduler(limit=1000, period=1, burst=1,
+                                           backoff=0.001, retry_on=(IOError,))
+        func = MagicMock(side_effect=[ratelimit.RateLimited('429'),
+                                      IOError, 'done'])
+
+        async def request(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(
+            sched.call_async(request, 1, two=2)), 'done')
+        func.assert_called_with(1, two=2)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sched.retries, 2)
+        self.assertEqual(sched.requests, 3)
+        self.mock_sleep.assert_not_called()
+
+    def testTryAcquire(self):
+        """
+        try_acquire() takes a token or tells how long until one
+        """
+        sched = ratelimit.RequestScheduler(limit=10, period=1, burst=1)
+        self.assertEqual(sched.try_acquire(), 0)
+        self.assertGreater(sched.try_acquire(), 0)
+        self.assertEqual(sched.requests, 1)
+
+    def testRetryGiveUp(self):
+        """
+        Retries stop after max_retries, other errors are not retried
+        """
+        sched = ratelimit.RequestScheduler(limit=1000, period=1, burst=10,
+                                           max_retries=2)
+        func = MagicMock(side_effect=ratelimit.RateLimited('429'))
+        with patch.object(sched, 'pause'):
+            with self.assertRaises(ratelimit.RateLimited):
+                sched.call('q', func)
+        self.assertEqual(func.call_count, 3)
+
+        func = MagicMock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            sched.call('q', func)
+        func.assert_called_once()
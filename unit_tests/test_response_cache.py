@@ -0,0 +1,82 @@
+"""
+Unit tests for the datadog-exporter response_cache module
+"""
+from mock import patch
+import os
+import shutil
+import tempfile
+import unittest
+
+import response_cache
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Test the Datadog response cache.
+    """
+    def setUp(self):
+        """
+        Test setups: temporary cache directory, patch out logging.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up patches and the cache.
+        """
+        patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def testHitMiss(self):
+        """
+        A cached response is read back, also by a later cache object
+        """
+        cache = response_cache.ResponseCache(self.tmpdir, 1 << 20, 60)
+        response = {'series': [{'pointlist': [[1000.0, 1.5]]}]}
+        self.assertIsNone(cache.get('q', 0, 100))
+        self.assertTrue(cache.put('q', 0, 100, response))
+        self.assertEqual(cache.get('q', 0, 100), response)
+        self.assertIsNone(cache.get('q', 0, 101))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache = response_cache.ResponseCache(self.tmpdir, 1 << 20, 60)
+        self.assertEqual(cache.get('q', 0, 100), response)
+        self.assertGreater(cache.size, 0)
+
+    def testImmutableAfter(self):
+        """
+        Windows ending less than immutable_after ago are not cached
+        """
+        cache = response_cache.ResponseCache(self.tmpdir, 1 << 20, 60)
+        with patch('response_cache.time.time', return_value=1000):
+            self.assertFalse(cache.put('q', 900, 941, {}))
+            self.assertTrue(cache.put('q', 900, 940, {}))
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+
+    def testLruEviction(self):
+        """
+        The least recently used entries are evicted to stay under max_bytes
+        """
+        cache = response_cache.ResponseCache(self.tmpdir, 1 << 20, 0)
+        cache.put('q', 0, 1, {'n': 0})
+        entry = cache.size
+        cache.max_bytes = entry * 2
+        cache.put('q', 1, 2, {'n': 1})
+        cache.get('q', 0, 1)
+        cache.put('q', 2, 3, {'n': 2})
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get('q', 1, 2))
+        self.assertEqual(cache.get('q', 0, 1), {'n': 0})
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+    def testCorruptEntry(self):
+        """
+        An unreadable entry is a miss and is removed
+        """
+        cache = response_cache.ResponseCache(self.tmpdir, 1 << 20, 0)
+        cache.put('q', 0, 1, {'n': 0})
+        name = response_cache.cache_key('q', 0, 1) + '.json.gz'
+        with open(os.path.join(self.tmpdir, name), 'wb') as entry:
+            entry.write(b'not gzip')
+        self.assertIsNone(cache.get('q', 0, 1))
+        self.assertEqual(os.listdir(self.tmpdir), [])
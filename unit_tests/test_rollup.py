@@ -0,0 +1,166 @@
+"""
+Unit tests for the datadog-exporter rollup module
+"""
+from mock import patch, MagicMock
+import unittest
+
+import pointlist
+import rollup
+
+
+def series(points):
+    return pointlist.Series.from_points(points)
+
+
+class TestAggregate(unittest.TestCase):
+    """
+    Test the bucket aggregation, with and without NumPy.
+    """
+    points = [[1000, 1.0], [59000, 3.0], [60000, 5.0], [185000, -1.0],
+              [190000, 2.0]]
+
+    def _aggregate(self, aggregates=rollup.AGGREGATES):
+        times, fields = rollup.aggregate(*series(self.points).columns(),
+                                         interval=60000, aggregates=aggregates)
+        return list(times), [(name, list(column)) for name, column in fields]
+
+    def testAggregate(self):
+        """
+        Points are aggregated per bucket, the buckets aligned on the interval
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                self.assertEqual(self._aggregate(),
+                                 ([0, 60000, 180000],
+                                  [('avg', [2.0, 5.0, 0.5]),
+                                   ('min', [1.0, 5.0, -1.0]),
+                                   ('max', [3.0, 5.0, 2.0]),
+                                   ('sum', [4.0, 5.0, 1.0]),
+                                   ('count', [2, 1, 2])]))
+
+    def testAggregateSome(self):
+        """
+        Only the configured aggregates are computed, in their order
+        """
+        self.assertEqual(self._aggregate(('count', 'max'))[1],
+                         [('count', [2, 1, 2]), ('max', [3.0, 5.0, 2.0])])
+
+    def testJoin(self):
+        """
+        Series are joined in order
+        """
+        for numpy in (pointlist.numpy, None):
+            with patch('pointlist.numpy', numpy):
+                self.assertEqual(rollup.join(series(self.points[:2]),
+                                             series(self.points[2:])),
+                                 self.points)
+
+
+class TestRollup(unittest.TestCase):
+    """
+    Test the rollup settings.
+    """
+    def testFromQuery(self):
+        """
+        Missing settings take their defaults
+        """
+        self.assertIsNone(rollup.Rollup.from_query({'metric': 'm'}))
+        res = rollup.Rollup.from_query({'metric': 'm',
+                                        'rollup': {'interval': 300}})
+        self.assertEqual((res.interval, res.measurement, res.aggregates,
+                          res.retention_policy, res.keep_raw),
+                         (300, 'm', ('avg',), None, False))
+        self.assertEqual(res.align(1000), 900)
+
+    def testFromQueryBad(self):
+        """
+        Malformed rollups raise ValueError
+        """
+        for spec in ('300', {'interval': 0}, {'interval': 'x'},
+                     {'interval': 60, 'aggregates': ['median']},
+                     {'interval': 60, 'aggregates': 'avg'},
+                     {'interval': 60, 'period': 1},
+                     {'interval': 60, 'keep_raw': True}):
+            with self.assertRaises(ValueError):
+                rollup.Rollup.from_query({'metric': 'm', 'rollup': spec})
+
+    def testParseRollups(self):
+        """
+        parse_rollups() keeps the well formed rollups, by metric
+        """
+        res = rollup.parse_rollups([{'metric': 'a'},
+                                    {'metric': 'b', 'rollup': {'interval': 60}},
+                                    {'metric': 'c', 'rollup': {}},
+                                    {'metric': 'd', 'rollup': {'interval': -1}},
+                                    'junk'])
+        self.assertEqual(list(res), ['b'])
+
+    def testWatermarks(self):
+        """
+        Watermarks are looked up in the rollup measurements and moved to the
+        end of the last bucket
+        """
+        rollups = rollup.parse_rollups([
+            {'metric': 'cpu', 'rollup': {'interval': 60,
+                                         'measurement': 'cpu_1m'}},
+            {'metric': 'disk', 'rollup': {'interval': 60,
+                                          'aggregates': ['max', 'count'],
+                                          'measurement': 'disk_1m'}}])
+        self.assertEqual(rollup.watermark_measurements(['mem', 'cpu', 'disk'],
+                                                       rollups),
+                         [(None, ['mem']), ('avg', ['cpu_1m']),
+                          ('max', ['disk_1m'])])
+        self.assertEqual(rollup.watermark_marks({('mem', 'f1'): 5,
+                                                 ('cpu_1m', 'f1'): 60000},
+                                                rollups),
+                         {('mem', 'f1'): 5, ('cpu', 'f1'): 119999})
+
+
+class TestRollupStage(unittest.TestCase):
+    """
+    Test the stage between the fetched series and the writers.
+    """
+    info = ('f1', {})
+
+    def setUp(self):
+        self.send = MagicMock()
+        self.rollup = rollup.Rollup(60, 'm_1m', ('avg', 'count'), 'weeks')
+        self.stage = self.rollup.stage(self.send)
+
+    def _sent(self):
+        return [(args[0], list(args[2].times), list(args[2].fields[0][1]))
+                for args, _ in self.send.call_args_list]
+
+    def testHoldOpenBucket(self):
+        """
+        The open bucket is held over to the next window, closed ones sent
+        """
+        self.stage.put('m', self.info, series([[0, 1], [30000, 3],
+                                               [60000, 5]]), None)
+        self.assertEqual(self._sent(), [('m', [0], [2.0])])
+        self.stage.put('m', self.info, series([[90000, 7], [120000, 9]]), None)
+        self.assertEqual(self._sent()[1:], [('m', [60000], [6.0])])
+        buckets = self.send.call_args[0][2]
+        self.assertEqual((buckets.measurement, buckets.retention_policy,
+                          buckets.span, len(buckets)), ('m_1m', 'weeks', 60000, 1))
+
+    def testFlush(self):
+        """
+        flush() sends the buckets closed by then, and forgets the others
+        """
+        self.stage.put('m', self.info, series([[0, 1]]), None)
+        self.stage.put('m', ('f2', {}), series([[60000, 2]]), None)
+        self.send.assert_not_called()
+        self.stage.flush(60000)
+        self.assertEqual(self._sent(), [('m', [0], [1.0])])
+        self.stage.flush(200000)
+        self.assertEqual(self.send.call_count, 1)
+
+    def testKeepRaw(self):
+        """
+        With keep_raw the points are sent too, without committing
+        """
+        self.rollup.keep_raw = True
+        points = series([[0, 1]])
+        self.stage.put('m', self.info, points, 7)
+        self.send.assert_called_once_with('m', self.info, points, 7, False)
@@ -0,0 +1,83 @@
+"""
+Unit tests for the datadog-exporter series_stream module
+"""
+import json
+import unittest
+
+import series_stream
+
+
+def response(nseries, npoints=3):
+    return {'status': 'ok', 'res_type': 'time_series',
+            'query': 'avg:a{"series":[}by{foundry}',
+            'series': [{'scope': 'foundry:f{}'.format(nbr),
+                        'display_name': u'café ]}',
+                        'pointlist': [[1000.0 * pnt, pnt + 0.5]
+                                      for pnt in range(npoints)]}
+                       for nbr in range(nseries)],
+            'from_date': 0, 'to_date': 1000}
+
+
+def parse(body, size):
+    parser = series_stream.SeriesParser()
+    found = []
+    for offset in range(0, len(body), size):
+        found.extend(parser.feed(body[offset:offset + size]))
+    found.extend(parser.flush())
+    return parser, found, parser.close()
+
+
+class TestSeriesParser(unittest.TestCase):
+    """
+    Test the incremental response parser.
+    """
+    def testChunkSizes(self):
+        """
+        Test every chunking of a response gives the same series, the
+        response metadata and the counts
+        """
+        expected = response(4)
+        body = json.dumps(expected).encode('utf-8')
+        for size in (1, 2, 7, 64, len(body)):
+            parser, series, result = parse(body, size)
+            self.assertEqual(series, expected['series'])
+            self.assertEqual(result, dict(expected, series=[]))
+            self.assertEqual((parser.nseries, parser.npoints, parser.nbytes),
+                             (4, 12, len(body)))
+
+    def testIncremental(self):
+        """
+        Test a series is returned as soon as it is complete
+        """
+        body = json.dumps(response(2, 1000))
+        cut = body.index('{"scope": "foundry:f1"')
+        parser = series_stream.SeriesParser()
+        first = parser.feed(body[:cut])
+        self.assertEqual([entry['scope'] for entry in first], ['foundry:f0'])
+        self.assertEqual(len(parser.feed(body[cut:])), 1)
+
+    def testEmptyAndErrors(self):
+        """
+        Test responses with no series and error responses
+        """
+        for payload in ({'status': 'ok', 'series': []},
+                        {'errors': ['bad query']}):
+            _, series, result = parse(json.dumps(payload).encode(), 5)
+            self.assertEqual(series, [])
+            self.assertEqual(result, payload)
+
+    def testTruncated(self):
+        """
+        Test a truncated body raises ValueError
+        """
+        body = json.dumps(response(2)).encode()
+        for cut in (10, len(body) // 2, len(body) - 2):
+            parser = series_stream.SeriesParser()
+            parser.feed(body[:cut])
+            parser.flush()
+            with self.assertRaises(ValueError):
+                parser.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
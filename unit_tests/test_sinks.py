@@ -0,0 +1,151 @@
+"""
+Unit tests for the datadog-exporter sinks module
+"""
+import json
+from mock import patch
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import sinks
+import telemetry
+
+
+class TestParseSinks(unittest.TestCase):
+    """
+    Test the influx_sinks setting parser.
+    """
+    targets = [{'name': 'dr', 'host': 'influx-dr', 'depth': 8},
+               {'name': 'analytics', 'database': 'other'}]
+
+    def testSources(self):
+        """
+        The setting is a JSON list, a JSON file or empty
+        """
+        self.assertEqual(sinks.parse_sinks(''), [])
+        self.assertEqual(sinks.parse_sinks(None), [])
+        self.assertEqual(sinks.parse_sinks(json.dumps(self.targets)),
+                         self.targets)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sinks.json')
+        with open(path, 'w') as out:
+            json.dump(self.targets, out)
+        self.assertEqual(sinks.parse_sinks(path), self.targets)
+
+    def testMalformed(self):
+        """
+        Malformed settings raise ValueError
+        """
+        for value in ('{"name": "dr"}', [{'host': 'x'}], ['dr'],
+                      [{'name': 'dr', 'hots': 'x'}],
+                      [{'name': 'dr'}, {'name': 'dr'}],
+                      [{'name': 'dr', 'overflow': 'lose'}],
+                      [{'name': 'primary'}]):
+            with self.assertRaises(ValueError):
+                sinks.parse_sinks(value)
+
+
+class TestSink(unittest.TestCase):
+    """
+    Test an additional sink's writers.
+    """
+    _params = {'influx_database': 'db', 'influx_host': 'primary-host',
+               'influx_port': 8086, 'influx_user': 'joe',
+               'influx_password': 'secret', 'influx_timeout': 5}
+
+    def setUp(self):
+        """
+        Test setups: patch out functions across all tests.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.mock_client = patch('influxdb.InfluxDBClient').start()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def testTargetOverrides(self):
+        """
+        A sink's keys override the primary's, the rest are inherited
+        """
+        sink = sinks.Sink({'name': 'dr', 'host': 'dr-host', 'port': 9999},
+                          self._params)
+        sink.close()
+        kwargs = self.mock_client.call_args[1]
+        self.assertEqual((kwargs['host'], kwargs['port'], kwargs['database']),
+                         ('dr-host', 9999, 'db'))
+        self.assertEqual(sink.helper.name, 'dr')
+        self.assertFalse(sink.helper.primary)
+
+    def _overflow(self, sink):
+        """
+        Put six series on a sink of depth 2 whose writer is stuck on the
+        first one, then let it go and close the sink.
+
+        :return: the series the writer got
+        """
+        started = threading.Event()
+        release = threading.Event()
+        sent = []
+        def send_points(metric, info, points, after):
+            started.set()
+            release.wait(5)
+            sent.append(points)
+        sink.pipeline.writer = send_points
+        sink.put('m', ('f1', {'foundry': 'f1'}), [[0, 1.0]], None)
+        self.assertTrue(started.wait(5))
+        for nbr in range(1, 6):
+            sink.put('m', ('f1', {'foundry': 'f1'}), [[nbr, 1.0]], None)
+        release.set()
+        sink.close()
+        return sent
+
+    def testBacklogSpooled(self):
+        """
+        Series put on a sink that is 'depth' series behind go to the
+        sink's own spool, replayed into its Influx
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        params = dict(self._params, spool_dir=tmpdir,
+                      spool_drain_interval=60)
+        sink = sinks.Sink({'name': 'slow', 'depth': 2, 'writers': 1}, params)
+        self.assertEqual(sink.overflow, 'spool')
+        sent = self._overflow(sink)
+        # one being written, two queued, the other three spooled
+        self.assertEqual(len(sent), 3)
+        self.assertEqual((sink.spooled, sink.backlog), (3, 0))
+        replayed = [args[0][0] for args in
+                    self.mock_client.return_value.write_points.call_args_list]
+        self.assertEqual([[line.split(' ')[-1] for line in lines]
+                          for lines in replayed], [['3'], ['4'], ['5']])
+        self.assertFalse(sink.helper.spool.pending)
+        self.assertTrue(os.path.isdir(os.path.join(tmpdir, 'sink-slow')))
+
+    def testNoSpoolBlocks(self):
+        """
+        Without a spool directory a full sink is waited for
+        """
+        sink = sinks.Sink({'name': 'dr'}, self._params)
+        sink.close()
+        self.assertEqual(sink.overflow, 'block')
+
+    def testBacklogDropped(self):
+        """
+        With overflow 'drop', series put on a sink that is 'depth' series
+        behind are dropped and counted, without waiting
+        """
+        sink = sinks.Sink({'name': 'slow', 'depth': 2, 'writers': 1,
+                           'overflow': 'drop'}, self._params)
+        before = telemetry.SINK_POINTS.value('slow', 'backlog')
+        sent = self._overflow(sink)
+        # one being written, two queued, the other three dropped
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(sink.backlog, 3)
+        self.assertEqual(telemetry.SINK_POINTS.value('slow', 'backlog') - before,
+                         3)
@@ -0,0 +1,116 @@
+"""
+Unit tests for the datadog-exporter spool module
+"""
+from mock import patch, MagicMock
+import os
+import shutil
+import tempfile
+import unittest
+
+import spool
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test the write-ahead spool and its drainer.
+    """
+    def setUp(self):
+        """
+        Test setups: temporary spool directory, patch out logging.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up patches and the spool.
+        """
+        patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def read_all(self, influx_spool):
+        batches = []
+        while True:
+            path = influx_spool.next_segment()
+            if path is None:
+                return batches
+            batches.extend(influx_spool.records(path))
+            influx_spool.remove(path)
+
+    def testAppendAndRead(self):
+        """
+        Batches are read back in order, across segments
+        """
+        influx_spool = spool.Spool(self.directory, segment_bytes=40)
+        self.assertFalse(influx_spool.pending)
+        batches = [['m,foundry=f{} value={} {}'.format(nbr, nbr, nbr),
+                    'm value=1.0 1']
+                   for nbr in range(5)]
+        for batch in batches:
+            influx_spool.append(batch)
+        self.assertTrue(influx_spool.pending)
+        self.assertGreater(len(os.listdir(self.directory)), 1)
+        self.assertEqual(self.read_all(influx_spool), batches)
+        self.assertFalse(influx_spool.pending)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testReopen(self):
+        """
+        Segments left by an earlier run are replayed, new segments are
+        numbered after them
+        """
+        influx_spool = spool.Spool(self.directory, segment_bytes=1024)
+        influx_spool.append(['one'])
+        influx_spool.close()
+        influx_spool = spool.Spool(self.directory, segment_bytes=1024)
+        self.assertTrue(influx_spool.pending)
+        influx_spool.append(['two'])
+        self.assertEqual(self.read_all(influx_spool), [['one'], ['two']])
+
+    def testTornRecord(self):
+        """
+        A partly written record at the end of a segment is dropped
+        """
+        influx_spool = spool.Spool(self.directory, segment_bytes=1024)
+        influx_spool.append(['good'])
+        influx_spool.close()
+        path = influx_spool.next_segment()
+        with open(path, 'ab') as segment:
+            segment.write(spool._HEADER.pack(100, 0) + b'partial')
+        self.assertEqual(list(influx_spool.records(path)), [['good']])
+
+    def testDrainer(self):
+        """
+        The drainer replays the spool, resuming after a failure without
+        writing a batch twice
+        """
+        influx_spool = spool.Spool(self.directory, segment_bytes=1024)
+        for nbr in range(3):
+            influx_spool.append([str(nbr)])
+        writer = MagicMock(side_effect=[None, Exception('down'), None, None])
+        drainer = spool.SpoolDrainer(influx_spool, writer, interval=3600)
+        self.assertFalse(drainer.drain())
+        self.assertTrue(influx_spool.pending)
+        self.assertTrue(drainer.drain())
+        self.assertFalse(influx_spool.pending)
+        self.assertEqual([args[0][0] for args in writer.call_args_list],
+                         [['0'], ['1'], ['1'], ['2']])
+        self.assertEqual(drainer.replayed, 3)
+        drainer.close()
+
+    def testDrainerThread(self):
+        """
+        The drainer thread empties the spool in the background
+        """
+        influx_spool = spool.Spool(self.directory, segment_bytes=1024)
+        influx_spool.append(['line'])
+        writer = MagicMock()
+        drainer = spool.SpoolDrainer(influx_spool, writer, interval=0.01)
+        for _ in range(200):
+            if not influx_spool.pending:
+                break
+            drainer._stop.wait(0.01)
+        drainer.close(drain=False)
+        writer.assert_called_once_with(['line'])
+        self.assertFalse(influx_spool.pending)
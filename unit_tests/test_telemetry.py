@@ -0,0 +1,90 @@
+"""
+Unit tests for the datadog-exporter telemetry module
+"""
+from mock import patch
+from urllib.request import urlopen
+import unittest
+
+import telemetry
+
+
+class TestTelemetry(unittest.TestCase):
+    """
+    Test the runtime metrics and their endpoint.
+    """
+    def setUp(self):
+        """
+        Test setups: patch out logging.
+        """
+        patch('commonpy.logger.Logger.logger').start()
+
+    def tearDown(self):
+        """
+        Test teardowns: clean up test-wide patches.
+        """
+        patch.stopall()
+
+    def testCounter(self):
+        """
+        Counters add up per label set
+        """
+        counter = telemetry.Counter('c_total', 'A counter', ('metric',))
+        counter.inc(2, 'm1')
+        counter.inc(3, 'm1')
+        counter.inc(1, 'm"2')
+        self.assertEqual(counter.value('m1'), 5)
+        self.assertEqual(counter.render(),
+                         ['# HELP c_total A counter', '# TYPE c_total counter',
+                          'c_total{metric="m\\"2"} 1.0',
+                          'c_total{metric="m1"} 5.0'])
+
+    def testHistogram(self):
+        """
+        Histograms render cumulative buckets, sum and count
+        """
+        histogram = telemetry.Histogram('h', 'A histogram', (1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.value(), (4, 56.5))
+        self.assertEqual(histogram.render()[2:],
+                         ['h_bucket{le="1"} 2', 'h_bucket{le="10"} 3',
+                          'h_bucket{le="+Inf"} 4', 'h_sum 56.5', 'h_count 4'])
+
+    def testLag(self):
+        """
+        A metric's lag is the age of its most lagging foundry
+        """
+        lag = telemetry.Lag('lag', 'Lag')
+        lag.mark('m', 'f1', 100000)
+        lag.mark('m', 'f2', 50000)
+        lag.mark('m', 'f2', 40000)
+        with patch('telemetry.time.time', return_value=150):
+            self.assertEqual(lag.render()[2:], ['lag{metric="m"} 100.0'])
+
+    def testLagLabels(self):
+        """
+        Extra lag labels come before the metric and are tracked apart
+        """
+        lag = telemetry.Lag('lag', 'Lag', ('sink',))
+        lag.mark('m', 'f1', 100000, 'dr')
+        lag.mark('m', 'f1', 140000, 'primary')
+        with patch('telemetry.time.time', return_value=150):
+            self.assertEqual(lag.render()[2:],
+                             ['lag{sink="dr",metric="m"} 50.0',
+                              'lag{sink="primary",metric="m"} 10.0'])
+
+    def testServe(self):
+        """
+        The endpoint serves the registry in the text format
+        """
+        registry = telemetry.Registry()
+        registry.add(telemetry.Gauge('g', 'A gauge')).set(7)
+        server = telemetry.serve(0, host='127.0.0.1', registry=registry)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            with urlopen(url) as response:
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('# TYPE g gauge\ng 7.0\n', body)
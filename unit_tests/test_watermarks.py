@@ -0,0 +1,85 @@
+"""
+Unit tests for the datadog-exporter watermarks module
+"""
+import unittest
+
+import watermarks
+
+
+class TestWatermarks(unittest.TestCase):
+    """
+    Test the watermark query and map.
+    """
+    raw = {'statement_id': 0,
+           'series': [{'name': 'm1', 'tags': {'foundry': 'f1'},
+                       'columns': ['time', 'last_value'],
+                       'values': [[1500000, 1.0]]},
+                      {'name': 'm1', 'tags': {'foundry': 'f2'},
+                       'columns': ['time', 'last_value'],
+                       'values': [[2500000, 1.0]]},
+                      {'name': 'm2', 'tags': {'foundry': 'f1'},
+                       'values': []},
+                     ]}
+
+    def testLastQuery(self):
+        """
+        One grouped query for all metrics
+        """
+        self.assertEqual(watermarks.last_query(['m1', 'a "b"']),
+                         'SELECT LAST(*) FROM "m1", "a \\"b\\"" '
+                         'GROUP BY "foundry"')
+        self.assertEqual(watermarks.last_query(['m1_1m'], 'avg'),
+                         'SELECT LAST("avg") FROM "m1_1m" GROUP BY "foundry"')
+
+    def testFromResult(self):
+        """
+        Parse the grouped query result, skipping empty series
+        """
+        marks = watermarks.Watermarks.from_result(self.raw)
+        self.assertTrue(marks.loaded)
+        self.assertEqual(len(marks), 2)
+        self.assertEqual(marks.get('m1', 'f1'), 1500000)
+        self.assertEqual(marks.get('m1', 'f2'), 2500000)
+        self.assertIsNone(marks.get('m2', 'f1'))
+
+    def testStartTime(self):
+        """
+        A metric starts from its most lagging foundry
+        """
+        marks = watermarks.Watermarks.from_result(self.raw)
+        self.assertEqual(marks.start_time('m1'), 1500)
+        self.assertIsNone(marks.start_time('m2'))
+
+    def testStartTimeStaleFoundry(self):
+        """
+        A foundry far behind the metric's newest watermark (retired) does
+        not hold its start back
+        """
+        day = 24 * 3600
+        marks = watermarks.Watermarks({('m1', 'retired'): 1000 * 1000,
+                                       ('m1', 'f1'): (400 * day) * 1000,
+                                       ('m1', 'f2'): (401 * day) * 1000})
+        self.assertEqual(marks.start_time('m1', 7 * day), 400 * day)
+        self.assertEqual(marks.start_time('m1'), 1000)
+        self.assertEqual(marks.start_time('m1', 500 * day), 1000)
+
+    def testEmpty(self):
+        """
+        An empty result is loaded but has no watermarks
+        """
+        marks = watermarks.Watermarks.from_result({'statement_id': 0})
+        self.assertTrue(marks.loaded)
+        self.assertFalse(watermarks.Watermarks().loaded)
+        self.assertIsNone(marks.start_time('m1'))
+
+    def testAdvance(self):
+        """
+        Watermarks only move forward
+        """
+        marks = watermarks.Watermarks({('m', 'f'): 100})
+        marks.advance('m', 'f', 50)
+        self.assertEqual(marks.get('m', 'f'), 100)
+        marks.advance('m', 'f', 150)
+        self.assertEqual(marks.get('m', 'f'), 150)
+        marks.advance('m', 'new', 10)
+        self.assertEqual(marks.get('m', 'new'), 10)
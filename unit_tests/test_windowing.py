@@ -0,0 +1,82 @@
+"""
+Unit tests for the datadog-exporter windowing module
+"""
+import unittest
+
+import windowing
+
+
+class TestWindows(unittest.TestCase):
+    """
+    Test the fixed and adaptive window sizers.
+    """
+    def _window(self, size=1000):
+        return windowing.AdaptiveWindow(size, minimum=100, maximum=10000,
+                                        target_points=100,
+                                        max_bytes=1000, max_latency=10)
+
+    def testFixed(self):
+        """
+        Fixed windows never change
+        """
+        window = windowing.FixedWindow(75)
+        window.observe(75, {'error': True})
+        self.assertEqual(window.size, 75)
+        self.assertFalse(window.adaptive)
+
+    def testClampInitial(self):
+        """
+        The initial size is kept within bounds
+        """
+        self.assertEqual(self._window(1).size, 100)
+        self.assertEqual(self._window(10 ** 6).size, 10000)
+
+    def testTargetDensity(self):
+        """
+        The window aims at target_points per series
+        """
+        window = self._window()
+        # 2 series of 200 points over 1000s: 0.2 points/s -> 500s
+        window.observe(1000, {'series': 2, 'points': 400, 'latency': 1})
+        self.assertEqual(window.size, 500)
+        # sparse: 10 points per series -> grows, at most 4x
+        window.observe(500, {'series': 1, 'points': 10, 'latency': 1})
+        self.assertEqual(window.size, 2000)
+
+    def testEmptyGrows(self):
+        """
+        Empty windows grow up to the maximum
+        """
+        window = self._window()
+        for _ in range(5):
+            window.observe(window.size, {'series': 0, 'points': 0})
+        self.assertEqual(window.size, 10000)
+
+    def testSlowAndLargeShrink(self):
+        """
+        Slow or large responses shrink the window
+        """
+        window = self._window()
+        window.observe(1000, {'series': 1, 'points': 100, 'latency': 20})
+        self.assertEqual(window.size, 500)
+        window.observe(500, {'series': 1, 'points': 50, 'latency': 1,
+                             'bytes': 2000})
+        self.assertEqual(window.size, 250)
+
+    def testErrorHalves(self):
+        """
+        A failed query halves the window, down to the minimum
+        """
+        window = self._window(300)
+        window.observe(300, {'error': True})
+        self.assertEqual(window.size, 150)
+        window.observe(150, {'error': True})
+        self.assertEqual(window.size, 100)
+
+    def testShortWindowIgnored(self):
+        """
+        A zero length window tells nothing
+        """
+        window = self._window()
+        window.observe(0, {'series': 1, 'points': 1})
+        self.assertEqual(window.size, 1000)
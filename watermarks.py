@@ -0,0 +1,131 @@
+"""
+Export watermarks
+
+Note(s):
+    1. Requires Python 3
+    2. A watermark is the last timestamp (ms) already in Influx for a
+       (measurement, foundry) pair.  They are discovered for every
+       configured metric with a single grouped query at startup:
+         SELECT LAST(*) FROM "m1", "m2", ... GROUP BY "foundry"
+       and kept for the run, so each series can start exactly where it
+       left off.
+    3. LAST(*) over a measurement with several fields (a rollup's) returns
+       time 0, not the time of its last point, so those are queried
+       apart with LAST of one of their fields (see rollup.py).
+    4. A metric is fetched from its most lagging foundry's watermark,
+       leaving out foundries more than watermark_max_lag behind its
+       newest one: a retired foundry's old watermark would otherwise
+       hold every run's start back for good.
+
+"""
+import threading
+
+
+def last_selector(field=None):
+    """
+    Build the selector of a last timestamp query.
+
+    :param field: the field to take the last point of, None for all
+                  (measurements with a single field)
+    :return: InfluxQL selector
+    """
+    if field is None:
+        return 'LAST(*)'
+    return 'LAST("{}")'.format(field.replace('"', '\\"'))
+
+
+def last_query(metrics, field=None):
+    """
+    Build the grouped watermark query for a list of metrics.
+
+    :param metrics: measurement names
+    :param field: as for last_selector()
+    :return: InfluxQL query string
+    """
+    measurements = ', '.join('"{}"'.format(metric.replace('"', '\\"'))
+                             for metric in metrics)
+    return 'SELECT {} FROM {} GROUP BY "foundry"'.format(last_selector(field),
+                                                        measurements)
+
+
+class Watermarks(object):
+    """
+    (measurement, foundry) to last exported timestamp (ms) map.
+    """
+    def __init__(self, marks=None, loaded=False):
+        """
+        :param marks: dictionary of (metric, foundry): timestamp (ms)
+        :param loaded: True if the marks are the complete result of a
+                       watermark query (a missing metric has no data)
+        """
+        super().__init__()
+        self._marks = dict(marks or {})
+        self.loaded = loaded
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_result(cls, raw):
+        """
+        Build the watermarks from a raw (epoch='ms') watermark query
+        result: {'series': [{'name': metric, 'tags': {'foundry': ...},
+        'values': [[time, ...]]}, ...]}
+
+        :param raw: the statement result
+        :return: Watermarks
+        """
+        marks = {}
+        for series in raw.get('series') or []:
+            try:
+                key = (series['name'], (series.get('tags') or {}).get('foundry'))
+                marks[key] = int(series['values'][0][0])
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        return cls(marks, loaded=True)
+
+    def __len__(self):
+        return len(self._marks)
+
+    def as_dict(self):
+        """
+        Copy of the (metric, foundry): timestamp (ms) map.
+        """
+        with self._lock:
+            return dict(self._marks)
+
+    def get(self, metric, foundry):
+        """
+        Get the watermark for one series.
+
+        :return: timestamp (ms), or None if nothing was exported yet
+        """
+        return self._marks.get((metric, foundry))
+
+    def start_time(self, metric, max_lag=0):
+        """
+        Get the time to start fetching a metric from: the oldest of its
+        foundry watermarks, so the most lagging foundry is caught up.
+
+        :param metric: measurement name
+        :param max_lag: leave out the watermarks more than this many
+                        seconds behind the metric's newest (0: keep all)
+        :return: start time (epoch seconds), or None if unknown
+        """
+        marks = [mark for (name, _), mark in self._marks.items()
+                 if name == metric]
+        if not marks:
+            return None
+        if max_lag > 0:
+            oldest = max(marks) - max_lag * 1000
+            marks = [mark for mark in marks if mark >= oldest]
+        return int(min(marks) / 1000)
+
+    def advance(self, metric, foundry, timestamp):
+        """
+        Move a watermark forward (never back).
+
+        :param timestamp: last exported timestamp (ms)
+        """
+        key = (metric, foundry)
+        with self._lock:
+            if timestamp > self._marks.get(key, timestamp - 1):
+                self._marks[key] = timestamp
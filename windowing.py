@@ -0,0 +1,96 @@
+"""
+Datadog query window sizing
+
+Note(s):
+    1. Requires Python 3
+    2. FixedWindow always asks Datadog for 'datadog_time_range' seconds.
+    3. AdaptiveWindow sizes each query's windows from what the previous
+       window returned: the point density per series is used to aim at
+       'target_points' points per series, and the window is cut back when
+       a response is too large or too slow (or fails).  The size always
+       stays within [minimum, maximum] and moves at most a factor of 4
+       per window.
+
+"""
+
+
+class FixedWindow(object):
+    """
+    Constant window size.
+    """
+    adaptive = False
+
+    def __init__(self, size):
+        """
+        :param size: window size (seconds)
+        """
+        super().__init__()
+        self.size = int(size)
+
+    def observe(self, length, stats):
+        """
+        Fixed windows ignore observations.
+        """
+
+
+class AdaptiveWindow(object):
+    """
+    Window size adapted to the observed response size and latency.
+    """
+    adaptive = True
+
+    def __init__(self, size, minimum, maximum, target_points,
+                 max_bytes, max_latency):
+        """
+        :param size: initial window size (seconds)
+        :param minimum: smallest window (seconds)
+        :param maximum: largest window (seconds)
+        :param target_points: points per series to aim for
+        :param max_bytes: largest acceptable response (bytes)
+        :param max_latency: slowest acceptable response (seconds)
+        """
+        super().__init__()
+        self.minimum = int(minimum)
+        self.maximum = max(int(maximum), self.minimum)
+        self.target_points = target_points
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.size = self._clamp(size)
+
+    def _clamp(self, size):
+        return int(min(max(size, self.minimum), self.maximum))
+
+    def observe(self, length, stats):
+        """
+        Adjust the window size after a query.
+
+        :param length: length of the window just queried (seconds)
+        :param stats: the query's statistics (see dogger.Dogger.metrics):
+                      'error', 'latency', 'bytes', 'series', 'points'
+        """
+        if stats.get('error'):
+            self.size = self._clamp(self.size / 2)
+            return
+        if length <= 0:
+            return
+
+        series = stats.get('series', 0)
+        points = stats.get('points', 0)
+        if not series or not points:
+            # nothing there: cover more ground with the next call
+            wanted = self.size * 4
+        else:
+            density = points / series / length     # points per second
+            wanted = self.target_points / density
+
+        # cut back (proportionally) anything too big or too slow
+        latency = stats.get('latency', 0)
+        if latency > self.max_latency:
+            wanted = min(wanted, length * self.max_latency / latency)
+        nbytes = stats.get('bytes', 0)
+        if nbytes > self.max_bytes:
+            wanted = min(wanted, length * self.max_bytes / nbytes)
+
+        # damp the change to avoid oscillating on noisy metrics
+        wanted = min(max(wanted, self.size / 4), self.size * 4)
+        self.size = self._clamp(wanted)